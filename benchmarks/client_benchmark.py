@@ -0,0 +1,221 @@
+"""
+benchmarks of the client hot paths against touchworks.api.simulator.
+
+micro benchmarks time envelope construction (_magic_json), request
+serialization, response parsing of a small and a very large payload and
+find_document_type_by_name over a large dictionary, both a memoized search and
+a cold search of a different text each call. the macro benchmark sends
+GetPatient calls from several threads at each concurrency level and reports
+throughput and latency percentiles.
+
+results are written as JSON. given a baseline written by an earlier run, every
+metric is compared to it and the exit status is 1 when one got worse by more
+than --threshold.
+
+    python benchmarks/client_benchmark.py --output baseline.json
+    python benchmarks/client_benchmark.py --baseline baseline.json --threshold 0.1
+"""
+from __future__ import print_function
+from touchworks.api.http import TouchWorks, TouchWorksMagicConstants
+from touchworks.api.simulator import TouchWorksSimulator
+import argparse
+import itertools
+import json
+import platform
+import random
+import sys
+import threading
+import time
+import timeit
+
+LOWER = 'lower'
+HIGHER = 'higher'
+
+
+class _Response(object):
+    def __init__(self, content):
+        self.content = content
+
+
+def measure(fn, number, repeat):
+    """
+    :return: best seconds per call of repeat measurements of number calls
+    """
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def result(value, unit, better=LOWER):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def micro(tw, simulator, args):
+    results = {}
+    number, repeat = args.number, args.repeat
+
+    def envelope():
+        return tw._magic_json(action=TouchWorksMagicConstants.ACTION_GET_DOCUMENTS,
+                              user_id='jmedici', patient_id='22', app_name='benchmark',
+                              parameter1='01/01/2015', parameter2='12/31/2015',
+                              parameter5='N')
+    results['magic_json'] = result(measure(envelope, number, repeat) * 1e6, 'us/call')
+
+    magic = envelope()
+    results['serialize'] = result(
+        measure(lambda: tw._codec.dumps(magic), number, repeat) * 1e6, 'us/call')
+
+    key = TouchWorksMagicConstants.RESULT_GET_PATIENT_INFO
+    small = _Response(json.dumps([{key: [simulator.patient(1)]}]).encode('utf-8'))
+    results['parse_small'] = result(
+        measure(lambda: tw._get_results_or_raise_if_magic_invalid(magic, small, key),
+                number, repeat) * 1e6, 'us/call')
+
+    key = TouchWorksMagicConstants.RESULT_GET_DOCUMENTS
+    rows = []
+    patient_id = 1
+    while len(rows) < args.large_rows:
+        rows.extend(simulator._getdocuments({'PatientID': patient_id}))
+        patient_id = patient_id % simulator.patients + 1
+    large = _Response(json.dumps([{key: rows[:args.large_rows]}]).encode('utf-8'))
+    results['parse_large'] = result(
+        measure(lambda: tw._get_results_or_raise_if_magic_invalid(magic, large, key),
+                max(number // 100, 1), repeat) * 1e3, 'ms/call')
+    results['parse_large_bytes'] = result(len(large.content), 'bytes')
+
+    index = tw.get_dictionary_index('Document_Type_DE')
+    tw.find_document_type_by_name('Consult', match_case=False)
+    results['find_document_type_by_name_memo'] = result(
+        measure(lambda: tw.find_document_type_by_name('Consult', match_case=False),
+                number, repeat) * 1e6, 'us/call')
+
+    # a different text every call, a text only comes back after every other name
+    names = [(e.get('EntryName') or '').lower() for e in index.entries]
+    random.Random(0).shuffle(names)
+    texts = itertools.cycle(names)
+    results['find_document_type_by_name_cold'] = result(
+        measure(lambda: tw.find_document_type_by_name(next(texts), match_case=False),
+                max(number // 10, 1), repeat) * 1e6, 'us/call')
+    return results
+
+
+def macro(tw, simulator, args):
+    results = {}
+    for concurrency in args.concurrency:
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        calls = max(args.calls // concurrency, 1)
+
+        def worker(seed):
+            rng = random.Random(seed)
+            mine = []
+            failed = 0
+            for _ in range(calls):
+                started = time.time()
+                try:
+                    tw.get_patient('jmedici', rng.randint(1, simulator.patients))
+                except Exception:
+                    failed += 1
+                mine.append(time.time() - started)
+            with lock:
+                latencies.extend(mine)
+                errors[0] += failed
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        latencies.sort()
+        name = 'e2e_c%d' % concurrency
+        results[name + '_throughput'] = result(len(latencies) / elapsed, 'calls/s', HIGHER)
+        for q in (50, 95, 99):
+            index = min(int(len(latencies) * q / 100.0), len(latencies) - 1)
+            results['%s_p%d' % (name, q)] = result(latencies[index] * 1e3, 'ms')
+        results[name + '_errors'] = result(errors[0], 'calls')
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: list of (name, baseline value, value, relative change) of every metric
+        worse than baseline by more than threshold
+    """
+    regressions = []
+    print('%-36s %12s %12s %9s' % ('metric', 'baseline', 'current', 'change'),
+          file=sys.stderr)
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], results[name]['value']
+        if old:
+            change = (new - old) / float(old)
+        else:
+            # errors going up from none
+            change = float('inf') if new > old else 0.0
+        worse = change if results[name]['better'] == LOWER else -change
+        flag = ''
+        if worse > threshold and results[name]['unit'] != 'bytes':
+            regressions.append((name, old, new, change))
+            flag = ' REGRESSION'
+        print('%-36s %12.3f %12.3f %+8.1f%%%s' % (name, old, new, change * 100, flag),
+              file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--number', type=int, default=2000, help='calls per micro measurement')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements, best is kept')
+    parser.add_argument('--large-rows', type=int, default=20000,
+                        help='rows of the large parse payload')
+    parser.add_argument('--dictionary-size', type=int, default=20000)
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='seconds the simulator adds to each request')
+    parser.add_argument('--calls', type=int, default=2000,
+                        help='calls per concurrency level of the macro benchmark')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--skip-macro', action='store_true')
+    parser.add_argument('--output', help='file the JSON results are written to, default stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    simulator = TouchWorksSimulator(patients=args.patients,
+                                    dictionary_size=args.dictionary_size,
+                                    latency=args.latency)
+    with simulator:
+        tw = TouchWorks(simulator.url, simulator.username, simulator.password, 'benchmark',
+                        app_username='jmedici', pool_size=max(args.concurrency))
+        results = micro(tw, simulator, args)
+        if not args.skip_macro:
+            results.update(macro(tw, simulator, args))
+
+    report = {'python': platform.python_version(),
+              'implementation': platform.python_implementation(),
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'parameters': vars(args),
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('%d regression(s) beyond %.0f%%' % (len(regressions), args.threshold * 100),
+                  file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
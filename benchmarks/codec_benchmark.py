@@ -0,0 +1,78 @@
+"""
+micro-benchmark of the per-call JSON cost of a magic json request: encoding
+the envelope and decoding a GetDocuments response.
+
+'legacy' is the previous path: json.dumps of the body, a second json.dumps for
+the debug log and response.json() decoding via text. the other rows use a
+touchworks.api.codec codec the way TouchWorks does now.
+
+    python benchmarks/codec_benchmark.py --rows 500 --number 2000
+"""
+from __future__ import print_function
+from touchworks.api.codec import CODECS
+import argparse
+import json
+import timeit
+
+
+def make_envelope():
+    return {'Action': 'GetDocuments', 'AppUserID': 'jmedici', 'Appname': 'app',
+            'PatientID': '22', 'Token': '4b6f5e8a-2c1d-4f3e-9a7b-6c5d4e3f2a1b',
+            'Parameter1': '01/01/2015', 'Parameter2': '12/31/2015', 'Parameter3': '',
+            'Parameter4': '', 'Parameter5': 'N', 'Parameter6': '', 'Data': ''}
+
+
+def make_response(rows):
+    documents = [{'DocumentID': str(1000 + i),
+                  'DocumentType': 'Progress Note',
+                  'DocumentDate': '03/14/2015 10:%02d AM' % (i % 60),
+                  'Status': 'Final',
+                  'AuthorName': u'Müller, Anna',
+                  'Description': 'Follow up visit, patient doing well. ' * 3}
+                 for i in range(rows)]
+    return json.dumps([{'getdocumentsinfo': documents}]).encode('utf-8')
+
+
+def legacy_call(envelope, content):
+    body = json.dumps(envelope)
+    json.dumps(envelope)
+    json.loads(content.decode('utf-8'))
+    return body
+
+
+def codec_call(codec, envelope, content):
+    body = codec.dumps(envelope)
+    codec.loads(content)
+    return body
+
+
+def measure(fn, number, repeat):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rows', type=int, default=100, help='rows in the response')
+    parser.add_argument('--number', type=int, default=1000, help='calls per measurement')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements, best is kept')
+    args = parser.parse_args()
+
+    envelope = make_envelope()
+    content = make_response(args.rows)
+    legacy = measure(lambda: legacy_call(envelope, content), args.number, args.repeat)
+    print('%d rows, %d byte response' % (args.rows, len(content)))
+    print('%-8s %12s %10s' % ('codec', 'us/call', 'saving'))
+    print('%-8s %12.1f %10s' % ('legacy', legacy * 1e6, '-'))
+    for codec_class in CODECS:
+        try:
+            codec = codec_class()
+        except ImportError:
+            print('%-8s %12s' % (codec_class.name, 'n/a'))
+            continue
+        took = measure(lambda: codec_call(codec, envelope, content), args.number, args.repeat)
+        print('%-8s %12.1f %9.0f%%' % (codec.name, took * 1e6,
+                                       100.0 * (legacy - took) / legacy))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,12 +23,17 @@ setup(
     url="https://github.com/farshidce/touchworks-python",
     download_url="https://github.com/farshidce/touchworks-python/tarball/0.3",
     description="Allscripts Touchworks API Client for Python",
-    packages=["touchworks"],
+    packages=["touchworks", "touchworks.api"],
     platforms="any",
     zip_safe=False,
     install_requires=[
-        "requests>=2.3.0"
+        "requests>=2.3.0",
+        "futures>=3.0; python_version < '3.0'"
     ],
+    extras_require={
+        "async": ["aiohttp>=3.3"],
+        "fast": ["orjson>=3.0; python_version >= '3.6'"]
+    },
     tests_require=[
         "nose>=1.3.7"
     ],
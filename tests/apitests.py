@@ -83,6 +83,24 @@ class TestAPIs(unittest.TestCase):
                                      patient_id=patient['ID'])
                 logger.debug(pprint.pformat(patient))
 
+    def test_batch_get_patients(self):
+        self.api = TouchWorks(base_url=self.url,
+                              username=self.svc_username,
+                              password=self.svc_password,
+                              app_username=self.config['ehr_username'],
+                              app_name=self.app_name,
+                              cache_token=True)
+        patients = self.api.search_patients('J*', 'N')
+        calls = [('get_patient', {'ehr_username': self.config['ehr_username'],
+                                  'patient_id': patient['ID']})
+                 for patient in patients[0:10]]
+        calls.append(('get_patient', {'ehr_username': self.config['ehr_username']}))
+        results = list(self.api.batch(calls, max_workers=4, ordered=True))
+        self.assertEqual(len(calls), len(results))
+        self.assertEqual(list(range(len(calls))), [r.index for r in results])
+        self.assertTrue(all(r.ok for r in results[:-1]))
+        self.assertFalse(results[-1].ok)
+
     def test_get_document_types(self):
         self.api = TouchWorks(base_url=self.url,
                               username=self.svc_username,
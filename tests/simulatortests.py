@@ -0,0 +1,778 @@
+from touchworks.api.http import TouchWorks, TouchWorksEndPoints, TouchWorksException, \
+    TouchWorksCircuitOpenException, TouchWorksDeadlineExceededException
+from touchworks.api.cache import ResponseCache
+from touchworks.api.cassette import CassetteRecorder, CassetteReplayer, load
+from touchworks.api.codec import get_codec
+from touchworks.api.dictionary import DictionaryIndex
+from touchworks.api.ratelimit import RateLimiter
+from touchworks.api.requestlog import RequestLog
+from touchworks.api.resilience import CircuitBreaker, RetryPolicy
+from touchworks.api.scheduler import Priority, RequestScheduler
+from touchworks.api.simulator import TouchWorksSimulator
+from touchworks.api.summary import ClinicalSummaryAggregator
+from touchworks.api.sync import PatientSync, SqliteSyncStore
+from touchworks.api.tasks import TaskEvent, TaskWatcher
+from touchworks.api.tracing import Tracer
+from touchworks.api.writebehind import WriteBehindQueue, SqliteWriteJournal, \
+    WriteOutcomeUnknownError
+
+try:
+    import asyncio
+    import aiohttp
+    from touchworks.api.async_http import AsyncTouchWorks
+except ImportError:
+    aiohttp = None
+import datetime
+import logging
+import os
+import requests
+import tempfile
+import threading
+import time
+import unittest
+
+
+class TestSimulator(unittest.TestCase):
+    """
+    runs the client against the local simulator, no TouchWorks server needed
+    """
+
+    def setUp(self):
+        self.simulator = TouchWorksSimulator(patients=50, dictionary_size=100, seed=7)
+        self.simulator.start()
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def client(self, **kwargs):
+        return TouchWorks(base_url=self.simulator.url,
+                          username=self.simulator.username,
+                          password=self.simulator.password,
+                          app_name='simulator',
+                          app_username='jmedici',
+                          **kwargs)
+
+    def test_reads(self):
+        api = self.client()
+        patients = api.search_patients('*')
+        self.assertEqual(len(patients), 50)
+        patient = api.get_patient('jmedici', patients[0]['ID'])
+        self.assertEqual(patient, [patients[0]])
+        self.assertEqual(len(api.get_documents('jmedici', patients[0]['ID'])), 10)
+        self.assertEqual(len(api.get_encounter_list_for_patient(patients[0]['ID'])), 3)
+        self.assertEqual(len(api.get_dictionary('Document_Type_DE')), 100)
+        self.assertTrue(api.find_document_type_by_name('Consult'))
+        schedule = api.get_schedule('jmedici', '01/01/2020', '', 'N', end_date='01/02/2020')
+        self.assertEqual(len(schedule), 2 * self.simulator.appointments_per_day)
+
+    def test_data_is_deterministic(self):
+        other = TouchWorksSimulator(patients=50, seed=7)
+        self.assertEqual(other.patient(5), self.simulator.patient(5))
+
+    def test_invalid_password(self):
+        with self.assertRaises(TouchWorksException):
+            TouchWorks(base_url=self.simulator.url, username=self.simulator.username,
+                       password='wrong', app_name='simulator')
+
+    def test_expired_token_is_replaced(self):
+        api = self.client()
+        api.get_patient('jmedici', 1)
+        self.simulator.expire_tokens()
+        self.assertTrue(api.get_patient('jmedici', 2))
+        self.assertEqual(self.simulator.requests['GetToken'], 2)
+
+    def test_other_errors_mentioning_a_token_are_not_replayed(self):
+        api = self.client()
+        handle = self.simulator.handle
+
+        def reject_note(path, body):
+            if b'SaveNote' in body:
+                with self.simulator._lock:
+                    self.simulator.requests['SaveNote'] = \
+                        self.simulator.requests.get('SaveNote', 0) + 1
+                return 200, {}, b'[{"Error": "Error: Parameter3 is not a valid token list."}]'
+            return handle(path, body)
+
+        self.simulator.handle = reject_note
+        with self.assertRaises(TouchWorksException) as context:
+            api.save_note('text', 1, 'Progress Note')
+        self.assertIn('not a valid token list', str(context.exception))
+        self.assertEqual(self.simulator.requests['SaveNote'], 1)
+        self.assertEqual(self.simulator.requests['GetToken'], 1)
+
+    def test_failures_are_retried(self):
+        self.simulator.error_rate = 0.5
+        api = self.client(retry_policy=RetryPolicy(max_retries=20, backoff_base=0.001))
+        for patient_id in range(1, 11):
+            self.assertTrue(api.get_patient('jmedici', patient_id))
+        self.assertTrue(self.simulator.errors)
+
+    def test_failures_without_retries(self):
+        api = self.client(retry_policy=RetryPolicy(max_retries=0))
+        self.simulator.error_rate = 1.0
+        with self.assertRaises(requests.HTTPError):
+            api.get_patient('jmedici', 1)
+
+    def test_throttling(self):
+        self.simulator.throttle_rate = 1
+        self.simulator.retry_after = 0
+        api = self.client(retry_policy=RetryPolicy(max_retries=0))
+        with self.assertRaises(requests.HTTPError) as raised:
+            for patient_id in range(1, 4):
+                api.get_patient('jmedici', patient_id)
+        self.assertEqual(raised.exception.response.status_code, 429)
+        self.assertTrue(self.simulator.throttled)
+
+    def test_response_cache(self):
+        api = self.client(response_cache=ResponseCache())
+        for _ in range(3):
+            api.get_patient('jmedici', 1)
+        self.assertEqual(self.simulator.requests['GetPatient'], 1)
+
+    def test_writes_succeed(self):
+        api = self.client()
+        result = api.save_note('hello there', document_type='Consult', patient_id=1,
+                               document_status='Final', wrapped_in_rtf='Y')
+        self.assertEqual(result[0]['Status'], 'Success')
+
+    def test_streaming_holds_slots_until_read(self):
+        scheduler = RequestScheduler(max_concurrency=2, reserved_interactive=1)
+        api = self.client(scheduler=scheduler, max_in_flight=2)
+        api.get_patient('jmedici', 1)
+        rows = api.get_documents('jmedici', 1, stream=True)
+        first = next(rows)
+        self.assertEqual(scheduler.in_flight(), 1)
+        self.assertEqual(api._rate_limiter.in_flight, 1)
+        rest = list(rows)
+        self.assertEqual(scheduler.in_flight(), 0)
+        self.assertEqual(api._rate_limiter.in_flight, 0)
+        self.assertEqual([first] + rest, api.get_documents('jmedici', 1))
+
+    def test_limiter_latency_target(self):
+        api = self.client(max_in_flight=8, adaptive_concurrency=True, latency_target=0.01)
+        self.assertEqual(api._rate_limiter.latency_target, 0.01)
+        self.simulator.latency = 0.03
+        api.get_patient('jmedici', 1)
+        self.assertEqual(api._rate_limiter.limit, 4)
+        with self.assertRaises(ValueError):
+            self.client(max_in_flight=4)
+        limiter = RateLimiter(max_in_flight=4)
+        self.assertIs(self.client(max_in_flight=4, rate_limiter=limiter)._rate_limiter, limiter)
+
+    def test_half_open_trial_missing_its_deadline(self):
+        scheduler = RequestScheduler(max_concurrency=1, reserved_interactive=0)
+        api = self.client(retry_policy=RetryPolicy(max_retries=0), scheduler=scheduler,
+                          circuit_breaker_threshold=1, circuit_breaker_reset_timeout=0.1)
+        breaker = api._circuit_breakers[TouchWorksEndPoints.MAGIC_JSON]
+        self.simulator.error_rate = 1.0
+        with self.assertRaises(requests.HTTPError):
+            api.get_patient('jmedici', 1)
+        self.simulator.error_rate = 0
+        time.sleep(0.15)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+        # the trial times out waiting for the slot held here
+        scheduler.acquire(Priority.INTERACTIVE)
+        with self.assertRaises(TouchWorksDeadlineExceededException):
+            with api.priority(Priority.INTERACTIVE, timeout=0.05):
+                api.get_patient('jmedici', 1)
+        scheduler.release(Priority.INTERACTIVE)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(api.get_patient('jmedici', 1))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_record_and_replay(self):
+        fd, path = tempfile.mkstemp(suffix='.cassette')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with CassetteRecorder(path) as recorder:
+            api = self.client(recorder=recorder)
+            for patient_id in (1, 2, 1):
+                api.get_patient('jmedici', patient_id)
+        records = load(path)
+        self.assertEqual([r['action'] for r in records],
+                         ['GetToken', 'GetPatient', 'GetPatient', 'GetPatient'])
+        text = open(path).read()
+        self.assertNotIn('Password', text)
+        self.assertNotIn('jmedici', text)
+        self.assertFalse([r for r in records[1:] if 'Token' in r['env']])
+        patients = [r['env']['PatientID'] for r in records[1:]]
+        self.assertEqual(patients[0], patients[2])
+        self.assertNotEqual(patients[0], patients[1])
+
+        report = CassetteReplayer(self.client(), records, speed=10, patients=50).run()
+        self.assertEqual(report['calls'], 3)
+        self.assertFalse(report['errors'])
+        self.assertEqual(self.simulator.requests['GetPatient'], 6)
+
+    def test_request_log(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        log = logging.getLogger('touchworks.requests.test')
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        self.addCleanup(log.removeHandler, handler)
+        api = self.client(request_log=RequestLog(logger=log, max_length=80))
+        api.save_note('hello there', document_type='Consult', patient_id=1)
+        self.assertEqual([r.touchworks_request['action'] for r in records],
+                         ['GetToken', 'SaveNote'])
+        for record in records:
+            message = record.getMessage()
+            self.assertTrue(len(message) <= 80)
+            self.assertNotIn('hello there', message)
+        self.assertNotIn('env', records[0].touchworks_request)
+        self.assertEqual(records[1].touchworks_request['env']['Parameter1'], '[redacted]')
+
+    def test_sinks_redact_the_same_fields(self):
+        fd, path = tempfile.mkstemp(suffix='.cassette')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        magic = {'Action': 'SaveNote ', 'Appname': 'simulator', 'Token': 'secret',
+                 'AppUserID': 'jmedici', 'PatientID': '1', 'Parameter1': 'hello there',
+                 'Parameter2': ''}
+        with CassetteRecorder(path) as recorder:
+            recorded = recorder.envelope(magic)
+        logged = RequestLog().envelope(magic)
+        traced = Tracer().envelope_attributes(magic)
+        self.assertEqual(sorted(logged), sorted(recorded))
+        self.assertEqual(sorted(f.lower() for f in logged), sorted(traced))
+        for field, value in logged.items():
+            if value == '[redacted]':
+                self.assertNotEqual(recorded[field], magic[field])
+                self.assertEqual(traced[field.lower()], '[redacted]')
+            else:
+                self.assertEqual(recorded[field], value)
+        self.assertEqual(traced['action'], 'SaveNote')
+
+    def test_write_behind(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        api = self.client(retry_policy=RetryPolicy(max_retries=0))
+        delivered = []
+        save_note = api.save_note
+
+        def recording_save_note(**kwargs):
+            result = save_note(**kwargs)
+            delivered.append((kwargs['patient_id'], kwargs['note_text']))
+            return result
+        api.save_note = recording_save_note
+        journal = SqliteWriteJournal(path)
+
+        # journaled while stopped, delivered by the next queue
+        WriteBehindQueue(api, journal).save_note('first', 1, 'Consult', write_id='first')
+        queue = WriteBehindQueue(api, journal, backoff_base=0.001)
+        # answered before the note is processed, safe to send again
+        self.simulator.error_status = 503
+        self.simulator.error_rate = 0.3
+        futures = [queue.save_note('note %02d' % i, i % 3, 'Consult') for i in range(20)]
+        self.assertIs(queue.save_note('first', 1, 'Consult', write_id='first'),
+                      queue.handle('first'))
+        with queue:
+            self.assertTrue(queue.flush(30))
+        self.assertEqual(queue.handle('first').result()[0]['Status'], 'Success')
+        for future in futures:
+            self.assertEqual(future.result()[0]['Status'], 'Success')
+        self.assertEqual(len(delivered), 21)
+        for patient_id in range(3):
+            notes = [note for pid, note in delivered if pid == patient_id]
+            self.assertEqual(notes, sorted(notes))
+        self.assertFalse(journal.pending())
+
+    def test_write_behind_does_not_resend_writes_that_may_have_been_saved(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        api = self.client()
+        save_note = api.save_note
+        timeouts = ['lost']
+
+        def save_note_timing_out(**kwargs):
+            result = save_note(**kwargs)
+            if timeouts:
+                timeouts.pop()
+                raise requests.ReadTimeout('read timed out')
+            return result
+        api.save_note = save_note_timing_out
+        journal = SqliteWriteJournal(path)
+        with WriteBehindQueue(api, journal, backoff_base=0.001) as queue:
+            future = queue.save_note('hello there', 1, 'Consult', write_id='note')
+            self.assertTrue(queue.flush(30))
+            self.assertRaises(WriteOutcomeUnknownError, future.result)
+            self.assertEqual(self.simulator.requests['SaveNote'], 1)
+            self.assertEqual([w.write_id for w in journal.unknown()], ['note'])
+            self.assertRaises(WriteOutcomeUnknownError, queue.handle('note').result)
+
+            # the server is found not to have it, send it again
+            self.assertEqual(queue.resend('note').result(30)[0]['Status'], 'Success')
+        self.assertEqual(self.simulator.requests['SaveNote'], 2)
+        self.assertFalse(journal.unknown())
+        self.assertRaises(KeyError, queue.resend, 'note')
+
+    def test_write_behind_queues_sharing_a_journal(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        api = self.client()
+        delivered = []
+        save_note = api.save_note
+
+        def recording_save_note(**kwargs):
+            delivered.append(kwargs['note_text'])
+            return save_note(**kwargs)
+        api.save_note = recording_save_note
+        self.simulator.latency = 0.01
+        first = WriteBehindQueue(api, SqliteWriteJournal(path), max_workers=4)
+        futures = [first.save_note('note %02d' % i, i % 5, 'Consult') for i in range(30)]
+        second = WriteBehindQueue(api, SqliteWriteJournal(path), max_workers=4)
+        with first, second:
+            self.assertTrue(first.flush(30))
+            self.assertTrue(second.flush(30))
+        self.assertEqual(sorted(delivered), ['note %02d' % i for i in range(30)])
+        self.assertEqual(first.delivered + second.delivered, 30)
+        for future in futures:
+            self.assertEqual(future.result()[0]['Status'], 'Success')
+        self.assertFalse(SqliteWriteJournal(path).pending())
+
+    def test_token_refreshed_before_expiry(self):
+        api = self.client(token_timeout=1, token_refresh_margin=0.5)
+        self.assertEqual(self.simulator.requests['GetToken'], 1)
+        time.sleep(0.8)
+        self.assertEqual(self.simulator.requests['GetToken'], 2)
+        api.get_patient('jmedici', 1)
+        self.assertEqual(self.simulator.requests['GetToken'], 2)
+        api.close()
+
+    def test_response_cache_invalidation(self):
+        cache = ResponseCache(ttls={'GetPatient': 60, 'GetDocuments': 60})
+        api = self.client(response_cache=cache)
+        documents = api.get_documents('jmedici', 1)
+        documents.append('changed by the caller')
+        self.assertEqual(api.get_documents('jmedici', 1), documents[:-1])
+        api.get_patient('jmedici', 1)
+        api.get_patient('jmedici', 2)
+        self.assertEqual(self.simulator.requests['GetDocuments'], 1)
+
+        # a write drops the reads of its patient
+        api.save_note('hello there', document_type='Consult', patient_id=1)
+        api.get_documents('jmedici', 1)
+        api.get_patient('jmedici', 2)
+        self.assertEqual(self.simulator.requests['GetDocuments'], 2)
+        self.assertEqual(self.simulator.requests['GetPatient'], 2)
+        api.invalidate_cache(patient_id=2)
+        api.get_patient('jmedici', 2)
+        self.assertEqual(self.simulator.requests['GetPatient'], 3)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_cache_hits_do_not_need_a_token(self):
+        api = self.client(response_cache=ResponseCache(ttls={'GetPatient': 60}))
+        patient = api.get_patient('jmedici', 1)
+        api._token_manager.invalidate()
+        self.assertEqual(api.get_patient('jmedici', 1), patient)
+        self.assertEqual(self.simulator.requests['GetToken'], 1)
+        api.get_patient('jmedici', 2)
+        self.assertEqual(self.simulator.requests['GetToken'], 2)
+
+    def test_concurrent_identical_calls_are_coalesced(self):
+        api = self.client(single_flight=True, pool_size=8)
+        self.simulator.latency = 0.3
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(api.get_patient('jmedici', 1)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.simulator.requests['GetPatient'], 1)
+        self.assertEqual(results, [[self.simulator.patient(1)]] * 8)
+
+    def test_retry_after_is_honored(self):
+        api = self.client(retry_policy=RetryPolicy(max_retries=3, backoff_base=0.001))
+        self.simulator.throttle_rate = 1
+        self.simulator.retry_after = 1
+        started = time.time()
+        for patient_id in range(1, 4):
+            self.assertTrue(api.get_patient('jmedici', patient_id))
+        self.assertTrue(self.simulator.throttled)
+        self.assertTrue(time.time() - started >= 0.9 * self.simulator.throttled)
+
+    def test_circuit_breaker(self):
+        api = self.client(retry_policy=RetryPolicy(max_retries=0),
+                          circuit_breaker_threshold=2, circuit_breaker_reset_timeout=0.2)
+        breaker = api._circuit_breakers[TouchWorksEndPoints.MAGIC_JSON]
+        self.simulator.error_rate = 1.0
+        for _ in range(2):
+            with self.assertRaises(requests.HTTPError):
+                api.get_patient('jmedici', 1)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(TouchWorksCircuitOpenException):
+            api.get_patient('jmedici', 1)
+        self.assertEqual(self.simulator.requests['GetPatient'], 2)
+
+        self.simulator.error_rate = 0
+        time.sleep(0.25)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(api.get_patient('jmedici', 1))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_limiter_backs_off_on_throttling(self):
+        api = self.client(retry_policy=RetryPolicy(max_retries=0),
+                          max_in_flight=8, adaptive_concurrency=True)
+        limiter = api._rate_limiter
+        self.simulator.throttle_rate = 1
+        self.simulator.retry_after = 0
+        with self.assertRaises(requests.HTTPError):
+            for patient_id in range(1, 4):
+                api.get_patient('jmedici', patient_id)
+        self.assertEqual(limiter.throttled, 1)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_streaming_matches_buffered_result(self):
+        api = self.client()
+        rows = api.get_schedule('jmedici', '01/01/2020', '', 'N', end_date='01/03/2020',
+                                stream=True)
+        self.assertEqual(list(rows), api.get_schedule('jmedici', '01/01/2020', '', 'N',
+                                                      end_date='01/03/2020'))
+
+    def test_sharded_schedule_is_merged_and_deduplicated(self):
+        get_schedule = self.simulator._getschedule
+
+        def overlapping_schedule(data):
+            # every window also returns the last appointment of the day before
+            first = (data.get('Parameter1') or '').split('|')[0]
+            day = datetime.datetime.strptime(first, '%m/%d/%Y') - datetime.timedelta(days=1)
+            previous = dict(data, Parameter1=day.strftime('%m/%d/%Y'))
+            return get_schedule(previous)[-1:] + get_schedule(data)
+        self.simulator._getschedule = overlapping_schedule
+        api = self.client()
+        schedule = api.get_schedule_range('jmedici', '01/01/2020', '01/07/2020',
+                                          max_workers=4)
+        self.assertEqual(self.simulator.requests['GetSchedule'], 7)
+        whole = api.get_schedule('jmedici', '01/01/2020', '', 'N', end_date='01/07/2020')
+        self.assertEqual(schedule, whole)
+        self.assertEqual(len(set(row['ID'] for row in schedule)), 7 * 40 + 1)
+
+    def test_batch(self):
+        api = self.client()
+        calls = [('get_patient', {'ehr_username': 'jmedici', 'patient_id': pid})
+                 for pid in range(1, 11)]
+        calls.append(('no_such_action', {}))
+        results = list(api.batch(calls, max_workers=4, ordered=True))
+        self.assertEqual([r.index for r in results], list(range(11)))
+        for pid, result in enumerate(results[:10], 1):
+            self.assertEqual(result.get(), [self.simulator.patient(pid)])
+        self.assertFalse(results[10].ok)
+        self.assertEqual(self.simulator.requests['GetPatient'], 10)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'os.fork is not available')
+    def test_forked_child_gets_its_own_session(self):
+        api = self.client()
+        api.get_patient('jmedici', 1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ok = api.get_patient('jmedici', 2) == [self.simulator.patient(2)]
+            except Exception:
+                ok = False
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.simulator.requests['GetToken'], 2)
+        self.assertTrue(api.get_patient('jmedici', 3))
+        self.assertEqual(self.simulator.requests['GetToken'], 2)
+
+    def test_fork_reset_happens_once(self):
+        api = self.client(pool_size=8)
+        api.get_patient('jmedici', 1)
+        transport = api._transport
+        created = []
+
+        def slow(fn):
+            def wrapper():
+                created.append(fn.__name__)
+                time.sleep(0.05)
+                return fn()
+            return wrapper
+        api._create_token_manager = slow(api._create_token_manager)
+        transport._open = slow(transport._open)
+
+        def run_in_threads(fn, *args):
+            threads = [threading.Thread(target=fn, args=args) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # as seen by the threads of a forked child
+        api._pid = transport._pid = -1
+        run_in_threads(api._check_pid)
+        run_in_threads(transport.post, self.simulator.url + '/json/GetToken', b'{}')
+        self.assertEqual(sorted(created), ['_create_token_manager', '_open'])
+        self.assertTrue(api.get_patient('jmedici', 2))
+        self.assertEqual(self.simulator.requests['GetToken'], 10)
+
+    def test_dictionary_index(self):
+        api = self.client()
+        index = api.get_dictionary_index('Document_Type_DE')
+        self.assertEqual(len(index), 100)
+        entry = index.entries[10]
+        self.assertEqual(index.find_by_code(entry['EntryCode']), [entry])
+        self.assertIn(entry, index.find_by_name(entry['EntryName'].upper(), match_case=False))
+        self.assertEqual(api.find_document_type_by_name('consult', match_case=False),
+                         [e for e in index.entries if 'consult' in e['EntryName'].lower() and
+                          e['Active'] == 'Y'])
+        api.get_dictionary('Document_Type_DE')[10]['EntryName'] = 'changed by the caller'
+        api.find_document_type_by_name(entry['EntryName'])[0]['Active'] = 'N'
+        self.assertEqual(index.entries[10], entry)
+        self.assertEqual(api.get_dictionary('Document_Type_DE'), index.entries)
+        self.assertEqual(self.simulator.requests['GetDictionary'], 1)
+        api.invalidate_dictionary('Document_Type_DE')
+        api.get_dictionary('Document_Type_DE')
+        self.assertEqual(self.simulator.requests['GetDictionary'], 2)
+
+    def test_dictionary_searches_are_bounded(self):
+        api = self.client()
+        index = DictionaryIndex('Document_Type_DE', api.get_dictionary('Document_Type_DE'),
+                                max_searches=3)
+        for text in ('Consult', 'Lab', 'Note', 'Consult', 'Radiology'):
+            index.search(text)
+        self.assertEqual(list(index._searches), [('Note', 'Y', True), ('Consult', 'Y', True),
+                                                 ('Radiology', 'Y', True)])
+
+    def test_codecs_agree(self):
+        results = []
+        for name in ('json', None):
+            api = self.client(json_codec=get_codec(name))
+            results.append((api.search_patients('*'), api.get_documents('jmedici', 3)))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(get_codec('json').loads(b'{"a": [1]}'), {'a': [1]})
+
+    def test_patient_sync(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        api = self.client()
+        delivered = []
+        sync = PatientSync(api, 'jmedici', delivered.extend, SqliteSyncStore(path),
+                           since=time.time() - 3600, page_size=1)
+        self.assertEqual(sync.run_once(), 2)
+        self.assertEqual(self.simulator.requests['GetChangedPatients'], 1)
+        for change in delivered:
+            self.assertEqual(change.patient, [self.simulator.patient(int(change.patient_id))])
+        self.assertTrue(sync.mark > time.time() - 60)
+
+        # a sink failing mid run has the rest delivered by the next run
+        def failing_sink(changes):
+            raise ValueError('sink is down')
+        failing = PatientSync(api, 'jmedici', failing_sink, SqliteSyncStore(path),
+                              page_size=1)
+        with self.assertRaises(ValueError):
+            failing.run_once()
+        resumed = []
+        sync = PatientSync(api, 'jmedici', resumed.extend, SqliteSyncStore(path), page_size=1)
+        self.assertEqual(sync.run_once(), 2)
+        self.assertEqual(self.simulator.requests['GetChangedPatients'], 2)
+
+    def test_task_watcher(self):
+        tasks = [{'TaskID': '1', 'Status': 'Active'},
+                 {'TaskID': '2', 'Status': 'Active'},
+                 {'TaskID': '3', 'Status': 'Completed'}]
+        self.simulator._gettasklist = lambda data: [dict(task) for task in tasks]
+        watcher = TaskWatcher(self.client())
+        new = []
+        watcher.subscribe(new.append, kinds=(TaskEvent.NEW,))
+        events = watcher.poll()
+        self.assertEqual([(e.kind, e.task_id) for e in events],
+                         [(TaskEvent.NEW, '1'), (TaskEvent.NEW, '2')])
+        self.assertEqual(new, events)
+        self.assertFalse(watcher.poll())
+
+        tasks[0]['Status'] = 'Pending'
+        tasks[1]['Status'] = 'Completed'
+        tasks.append({'TaskID': '4', 'Status': 'Active'})
+        events = watcher.poll()
+        self.assertEqual(sorted((e.kind, e.task_id, e.previous_status) for e in events),
+                         [(TaskEvent.CHANGED, '1', 'Active'),
+                          (TaskEvent.CLOSED, '2', 'Active'),
+                          (TaskEvent.NEW, '4', None)])
+        self.assertEqual(watcher.status_of(1), 'Pending')
+        self.assertEqual(len(new), 3)
+
+    def test_task_watcher_is_usable_during_a_slow_poll(self):
+        fetching = threading.Event()
+        answer = threading.Event()
+
+        def slow_task_list(data):
+            fetching.set()
+            answer.wait(10)
+            return [{'TaskID': '1', 'Status': 'Active'}]
+        self.simulator._gettasklist = slow_task_list
+        watcher = TaskWatcher(self.client())
+        poller = threading.Thread(target=watcher.poll)
+        poller.start()
+        self.assertTrue(fetching.wait(10))
+        subscribed = threading.Thread(target=watcher.subscribe, args=(lambda event: None,))
+        subscribed.start()
+        subscribed.join(2)
+        blocked = subscribed.is_alive()
+        answer.set()
+        poller.join(10)
+        self.assertFalse(blocked)
+        self.assertEqual(watcher.status_of(1), 'Active')
+
+    def test_clinical_summary(self):
+        api = self.client()
+        summary = ClinicalSummaryAggregator(api, ttls={'Vitals': 0})
+        chart = summary.get(1, ['Vitals', 'Problems'])
+        self.assertEqual(sorted(chart), ['Problems', 'Vitals'])
+        self.assertEqual(len(chart['Vitals']), 3)
+        self.assertEqual(self.simulator.requests['GetClinicalSummary'], 2)
+
+        # Vitals has expired, no activity since keeps it
+        self.assertEqual(summary.get(1, ['Vitals', 'Problems']), chart)
+        self.assertEqual(self.simulator.requests['GetClinicalSummary'], 2)
+        self.assertEqual(self.simulator.requests['GetPatientActivity'], 1)
+        self.assertEqual(summary.revalidations, 1)
+        summary.invalidate(1, ['Problems'])
+        summary.get(1, ['Problems'])
+        self.assertEqual(self.simulator.requests['GetClinicalSummary'], 3)
+
+    def test_clinical_summary_refreshes_expired_sections_only(self):
+        summary = ClinicalSummaryAggregator(self.client(), ttls={'Vitals': 0, 'Allergies': 0})
+        summary.get(1, ['Vitals', 'Problems'])
+        time.sleep(0.01)
+        summary.get(1, ['Allergies'])
+        self.assertEqual(self.simulator.requests['GetClinicalSummary'], 3)
+        self.simulator._getpatientactivity = lambda data: [{'section': 'Problems'},
+                                                           {'section': 'Vitals'}]
+
+        # one check per fetch time, fresh Problems is kept despite its activity
+        summary.get(1, ['Vitals', 'Problems', 'Allergies'])
+        self.assertEqual(self.simulator.requests['GetPatientActivity'], 2)
+        self.assertEqual(self.simulator.requests['GetClinicalSummary'], 4)
+        self.assertEqual(summary.revalidations, 1)
+
+    def test_metrics(self):
+        api = self.client()
+        api.get_patient('jmedici', 1)
+        api.get_patient('jmedici', 99999)
+        snapshot = api.metrics.snapshot()
+        self.assertEqual(snapshot['actions']['GetPatient']['count'], 2)
+        self.assertEqual(snapshot['actions']['GetPatient']['error_count'], 0)
+        self.assertEqual(snapshot['token_refreshes'], 1)
+        self.assertIn('touchworks_requests_total{action="GetPatient"} 2',
+                      api.metrics.to_prometheus())
+
+    def test_tracing(self):
+        spans = []
+        api = self.client(tracer=Tracer(on_end=spans.append))
+        api.get_patient('jmedici', 1)
+        api.get_patient('jmedici', 2)
+        calls = [s for s in spans if s.name == 'touchworks.call' and s.action == 'GetPatient']
+        self.assertEqual(len(calls), 2)
+        stages = set(s.name for s in spans if s.parent is calls[0])
+        self.assertTrue(set(['touchworks.token', 'touchworks.http', 'touchworks.parse']) <=
+                        stages, stages)
+        self.assertFalse([s for s in spans if s.name == 'touchworks.token' and
+                          (s.parent is None or s.parent.name != 'touchworks.call')])
+        for span in spans:
+            self.assertNotIn('jmedici', repr(span.attributes))
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncSimulator(unittest.TestCase):
+    """
+    AsyncTouchWorks against the local simulator. coroutines are run with
+    run_until_complete so this module still imports on Python 2
+    """
+
+    def setUp(self):
+        self.simulator = TouchWorksSimulator(patients=50, seed=7)
+        self.simulator.start()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.api.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.simulator.stop()
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def client(self, **kwargs):
+        self.api = AsyncTouchWorks(self.simulator.url, self.simulator.username,
+                                   self.simulator.password, 'simulator', **kwargs)
+        return self.api
+
+    def test_reads(self):
+        api = self.client()
+        self.assertEqual(self.run_async(api.get_patient('jmedici', 1)),
+                         [self.simulator.patient(1)])
+        self.simulator.expire_tokens()
+        documents = self.run_async(api.get_documents('jmedici', 1))
+        self.assertEqual(len(documents), self.simulator.documents_per_patient)
+        self.assertEqual(self.simulator.requests['GetToken'], 2)
+
+    def test_batch(self):
+        api = self.client()
+        calls = [('get_patient', {'ehr_username': 'jmedici', 'patient_id': pid})
+                 for pid in range(1, 21)]
+        calls.append(('no_such_action', {}))
+        results = self.run_async(api.batch(calls, max_workers=4, ordered=True))
+        self.assertEqual([r.index for r in results], list(range(21)))
+        for pid, result in enumerate(results[:20], 1):
+            self.assertEqual(result.get()[0]['ID'], str(pid))
+        self.assertFalse(results[20].ok)
+        self.assertEqual(self.simulator.requests['GetPatient'], 20)
+
+    def test_warm(self):
+        api = self.client()
+        self.run_async(api.warm())
+        self.assertEqual(self.simulator.requests['GetToken'], 1)
+        self.run_async(api.get_patient('jmedici', 1))
+        self.assertEqual(self.simulator.requests['GetToken'], 1)
+
+    def test_close_cancels_token_refresh(self):
+        api = self.client(token_refresh_margin=60)
+        self.run_async(api.connect())
+        get_token = self.simulator._get_token
+
+        def slow_get_token(data):
+            time.sleep(1)
+            return get_token(data)
+
+        self.simulator._get_token = slow_get_token
+        api._token.acquired_time -= api._token_timeout - 30
+        self.run_async(api.get_patient('jmedici', 1))
+        task = api._token_refresh_task
+        self.assertFalse(task.done())
+        self.run_async(api.close())
+        self.assertTrue(task.cancelled())
+        self.assertIsNone(api._token_refresh_task)
+
+    def test_dictionary_index(self):
+        api = self.client()
+        index = self.run_async(api.get_dictionary_index('Document_Type_DE'))
+        self.assertIs(self.run_async(api.get_dictionary_index('Document_Type_DE')), index)
+        self.assertEqual(self.simulator.requests['GetDictionary'], 1)
+        # the cache holds what the event loop fetched, it never loads by itself
+        self.assertRaises(ValueError, api._dictionary_cache.get, 'Other_DE')
+        api._dictionary_cache.revalidate_in_background('Document_Type_DE')
+        self.assertEqual(self.simulator.requests['GetDictionary'], 1)
+
+    def test_forked_child_drops_the_token(self):
+        api = self.client()
+        self.run_async(api.connect())
+        api._pid = -1
+        api._check_pid()
+        self.assertIsNone(api._token)
+        self.run_async(api.get_patient('jmedici', 1))
+        self.assertEqual(self.simulator.requests['GetToken'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
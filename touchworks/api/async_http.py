@@ -0,0 +1,778 @@
+"""
+asyncio flavour of the TouchWorks client. requires Python 3.5+ and aiohttp.
+
+every action of TouchWorks is available on AsyncTouchWorks and returns an
+awaitable instead of blocking the calling thread:
+
+    async with AsyncTouchWorks(url, username, password, app_name) as tw:
+        patient = await tw.get_patient(ehr_username, patient_id)
+"""
+from touchworks.logger import Logger
+from touchworks.api.http import (TouchWorks, TouchWorksEndPoints, TouchWorksException,
+                                 TouchWorksErrorMessages, TouchWorksTokenException,
+                                 TouchWorksDeadlineExceededException)
+from touchworks.api.transport import HttpTransport, release_on_close
+from touchworks.api.batch import BatchExecutor, BatchResult
+from touchworks.api.cache import ResponseCache
+from touchworks.api.dictionary import DictionaryCache, copy_entries
+from touchworks.api.singleflight import SingleFlight
+from touchworks.api.scheduler import Priority, current_priority
+from touchworks.api.streaming import ResultRowParser, MagicJsonError
+from touchworks.api import sharding
+import asyncio
+import collections
+import copy
+import json
+import os
+import requests
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = Logger.get_logger(__name__)
+
+# asyncio.Task.current_task was removed in 3.9, current_task was added in 3.7
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+class BufferedResponse(object):
+    """
+    response whose body has already been read. exposes the subset of
+    requests.Response that TouchWorks relies on
+    """
+
+    def __init__(self, url, status_code, content, headers=None, reason=''):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.reason = reason
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('%s Error: %s for url: %s' %
+                                     (self.status_code, self.reason, self.url),
+                                     response=self)
+
+
+class StreamingResponse(object):
+    """
+    successful response whose body has not been read yet. close() must be
+    called to hand the connection back to the pool
+    """
+
+    def __init__(self, url, resp):
+        self.url = url
+        self.status_code = resp.status
+        self.headers = dict(resp.headers)
+        self._resp = resp
+
+    def raise_for_status(self):
+        pass
+
+    async def read_chunk(self, chunk_size):
+        """
+        :return: the next bytes of the body, b'' at the end
+        """
+        try:
+            return await self._resp.content.read(chunk_size)
+        except asyncio.TimeoutError as ex:
+            raise requests.Timeout(str(ex) or 'reading %s timed out' % self.url)
+        except aiohttp.ClientError as ex:
+            raise requests.ConnectionError(str(ex))
+
+    def close(self):
+        self._resp.release()
+
+
+class AsyncHttpTransport(object):
+    """
+    pooled, keep-alive HTTP transport backed by an aiohttp.ClientSession.
+    the session is created on first use so it is bound to the running loop
+    """
+    DEFAULT_POOL_SIZE = 100
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=HttpTransport.DEFAULT_CONNECT_TIMEOUT_IN_SECS,
+                 read_timeout=HttpTransport.DEFAULT_READ_TIMEOUT_IN_SECS):
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for AsyncHttpTransport')
+        if pool_size < 1:
+            raise ValueError('pool_size must be greater than zero')
+        self._pool_size = pool_size
+        self._timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                              sock_read=read_timeout)
+        self._session = None
+
+    @property
+    def pool_size(self):
+        return self._pool_size
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size,
+                                             limit_per_host=self._pool_size)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=self._timeout)
+        return self._session
+
+    async def post(self, url, data, headers=None, stream=False):
+        """
+        posts data to url over a pooled connection
+        :param stream: optional - return a StreamingResponse as soon as the headers
+            are read, error responses are always buffered
+        :rtype : BufferedResponse
+        """
+        session = self._get_session()
+        # aiohttp errors are raised as their requests counterparts so that both
+        # clients share one retry policy
+        try:
+            if stream:
+                resp = await session.post(url, data=data, headers=headers)
+                if resp.status < 400:
+                    return StreamingResponse(url, resp)
+                try:
+                    content = await resp.read()
+                finally:
+                    resp.release()
+                return BufferedResponse(url, resp.status, content,
+                                        headers=dict(resp.headers), reason=resp.reason)
+            async with session.post(url, data=data, headers=headers) as resp:
+                content = await resp.read()
+                return BufferedResponse(url, resp.status, content,
+                                        headers=dict(resp.headers), reason=resp.reason)
+        except asyncio.TimeoutError as ex:
+            raise requests.Timeout(str(ex) or 'request to %s timed out' % url)
+        except aiohttp.ClientError as ex:
+            raise requests.ConnectionError(str(ex))
+
+    async def close(self):
+        if self._session is not None:
+            logger.debug('closing async http transport')
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class AsyncSingleFlight(SingleFlight):
+    """
+    SingleFlight for coroutines. tasks of one event loop asking for an envelope
+    that is already in flight await the same request
+    """
+
+    def __init__(self, actions=None):
+        super(AsyncSingleFlight, self).__init__(actions=actions)
+        self._waiters = {}
+
+    async def do(self, magic, coro_fn):
+        if not self.is_collapsible(magic.get('Action')):
+            return await coro_fn()
+        key = ResponseCache.key(magic)
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+            self._waiters[key] = self._waiters.get(key, 0) + 1
+            return copy.deepcopy(await asyncio.shield(task))
+        task = asyncio.ensure_future(coro_fn())
+        self._calls[key] = task
+        try:
+            # shielded so that a cancelled leader does not cancel its followers
+            result = await asyncio.shield(task)
+        finally:
+            if self._calls.get(key) is task:
+                del self._calls[key]
+            shared = self._waiters.pop(key, 0)
+        if shared:
+            return copy.deepcopy(result)
+        return result
+
+
+class AsyncTouchWorks(TouchWorks):
+    """
+    asyncio client for the TouchWorks Web Service. the security token is
+    acquired on the first call (or by awaiting connect()) and every call goes
+    through one pooled AsyncHttpTransport. at most max_concurrency requests
+    are in flight at any time, extra callers wait for a free slot
+    """
+    DEFAULT_MAX_CONCURRENCY = 100
+
+    def __init__(self, base_url, username, password, app_name,
+                 pool_size=AsyncHttpTransport.DEFAULT_POOL_SIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 **kwargs):
+        """
+        takes the same parameters as TouchWorks, a transport passed in must be
+        an AsyncHttpTransport
+        :param max_concurrency: optional - max number of requests in flight
+        """
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be greater than zero')
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+        self._token_lock = None
+        self._token_refresh_task = None
+        super(AsyncTouchWorks, self).__init__(base_url, username, password, app_name,
+                                              pool_size=pool_size, **kwargs)
+
+    def _create_transport(self, pool_size, connect_timeout, read_timeout):
+        return AsyncHttpTransport(pool_size=pool_size,
+                                  connect_timeout=connect_timeout,
+                                  read_timeout=read_timeout)
+
+    def _connect(self):
+        # the token is acquired on first use, there is no loop to run it on yet
+        self._token = None
+
+    def _check_pid(self):
+        """
+        a forked child must not reuse the token, or the refresh task, of the
+        process that created the client
+        """
+        if self._pid == os.getpid():
+            return
+        with self._pid_lock:
+            if self._pid != os.getpid():
+                logger.debug('process was forked, resetting security token')
+                self._token = None
+                self._token_lock = None
+                self._token_refresh_task = None
+                self._pid = os.getpid()
+
+    def _create_dictionary_cache(self, ttl, store):
+        # dictionaries are fetched by get_dictionary_index on the event loop, the
+        # cache only holds them and must never call a coroutine function itself
+        return DictionaryCache(None, ttl=ttl, store=store, scope=self._base_url)
+
+    async def connect(self):
+        """
+        acquires the security token ahead of the first call
+        """
+        await self._ensure_token()
+        return self
+
+    async def close(self):
+        """
+        releases the pooled connections held by this client
+        """
+        task = self._token_refresh_task
+        if task is not None:
+            self._token_refresh_task = None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception as ex:
+                logger.debug('background token refresh failed : %s', ex)
+        if self._owns_transport:
+            await self._transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def warm(self):
+        """
+        acquires the security token in a background task so that the first
+        call does not have to wait for it. must be called with a running loop
+        :return: the asyncio.Task
+        """
+        return asyncio.ensure_future(self._warm())
+
+    async def _warm(self):
+        try:
+            await self._ensure_token()
+        except Exception as ex:
+            # the next call acquires the token itself and raises if it still fails
+            logger.exception(ex)
+
+    async def batch(self, calls, max_workers=BatchExecutor.DEFAULT_MAX_WORKERS, ordered=False,
+                    priority=Priority.BULK):
+        """
+        runs many actions concurrently, at most max_workers at once. a failing
+        call does not stop the batch, its exception is captured in the BatchResult
+
+            calls = [('get_patient', {'ehr_username': user, 'patient_id': pid})
+                     for pid in patient_ids]
+            for r in await tw.batch(calls, max_workers=16):
+                if r.ok: ...
+
+        :param calls: iterable of (action name, kwargs)
+        :param max_workers: optional - calls in flight at once
+        :param ordered: optional - results in input order instead of completion order
+        :param priority: optional - scheduler priority of the calls
+        :return: list of touchworks.api.batch.BatchResult
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than zero')
+        semaphore = asyncio.Semaphore(max_workers)
+        results = []
+
+        async def call(index, action, kwargs):
+            async with semaphore:
+                try:
+                    method = self._batch_method(action)
+                    with self.priority(priority):
+                        result = await method(**kwargs)
+                    results.append(BatchResult(index, action, kwargs, result=result))
+                except Exception as ex:
+                    logger.debug('batch call #%s %s failed : %s', index, action, ex)
+                    results.append(BatchResult(index, action, kwargs, exception=ex))
+
+        await asyncio.gather(*[call(index, action, kwargs or {})
+                               for index, (action, kwargs) in enumerate(calls)])
+        if ordered:
+            results.sort(key=lambda r: r.index)
+        return results
+
+    def _batch_method(self, action):
+        if callable(action):
+            return action
+        if not action or action.startswith('_'):
+            raise ValueError('%s is not a TouchWorks action' % action)
+        method = getattr(self, action, None)
+        if not callable(method):
+            raise ValueError('%s is not a TouchWorks action' % action)
+        return method
+
+    async def get_token(self, appname, username, password):
+        """
+            get the security token by connecting to TouchWorks API
+        """
+        data = {'Username': username,
+                'Password': password}
+        started = time.time()
+        try:
+            with self._tracer.span('touchworks.call', action='GetToken'):
+                token = self._token_from_response(
+                    await self._http_request(TouchWorksEndPoints.GET_TOKEN, data))
+        except Exception as ex:
+            self._metrics.observe('GetToken', time.time() - started, error=ex)
+            raise
+        self._metrics.observe('GetToken', time.time() - started)
+        self._metrics.token_refreshed()
+        return token
+
+    def _token_valid(self):
+        if not self._cache_token or self._token is None:
+            return False
+        return time.time() - self._token.acquired_time <= self._token_timeout
+
+    def _token_needs_refresh(self):
+        age = time.time() - self._token.acquired_time
+        return age > self._token_timeout - self._token_refresh_margin
+
+    async def _ensure_token(self, stale_token=None):
+        token = self._token
+        if token is not None and self._token_valid() and token.token != stale_token:
+            if self._token_needs_refresh() and self._token_refresh_task is None:
+                # close to expiry, refresh in the background and keep using this one
+                self._token_refresh_task = asyncio.ensure_future(
+                    self._refresh_token(token.token))
+            return token
+        return await self._refresh_token(stale_token)
+
+    async def _refresh_token(self, stale_token=None):
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        try:
+            async with self._token_lock:
+                # another task may have refreshed the token while we were waiting
+                token = self._token
+                if token is None or not self._token_valid() or token.token == stale_token:
+                    token = await self.get_token(self._app_name,
+                                                 self._username, self._password)
+                    if self._cache_token:
+                        self._token = token
+                return token
+        finally:
+            # a foreground refresh must not drop the handle of a background one
+            if self._token_refresh_task is _current_task():
+                self._token_refresh_task = None
+
+    def _current_token(self):
+        # filled in by _invoke_magic once the token is known to be valid
+        return ''
+
+    async def _http_request(self, api, data, headers=None, stream=False):
+        """
+        internal method for handling request and response
+        and raising an exception is http return status code is not success
+
+        :param stream: optional - return a StreamingResponse for a successful request
+        :rtype : BufferedResponse
+        """
+        if not headers:
+            headers = {'Content-Type': 'application/json'}
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        with self._tracer.span('touchworks.serialize') as span:
+            body = self._codec.dumps(data)
+            span.set_attribute('request_bytes', len(body))
+        attempt = 0
+        while True:
+            breaker = self._check_circuit(api)
+            # a half-open trial that ends in neither outcome, say a missed
+            # deadline, must not keep the circuit from letting the next one through
+            settled = False
+            try:
+                response = None
+                started = time.time()
+                try:
+                    async with self._semaphore:
+                        response = await self._send(api, body, headers, stream)
+                    self._metrics.observe_sizes(self._action_name(api, data), len(body),
+                                                None if stream else len(response.content))
+                    response.raise_for_status()
+                except requests.RequestException as ex:
+                    if self._exchange_observers:
+                        self._record(api, data, attempt, started, body, response, stream, ex)
+                    delay = self._retry_delay(api, data, attempt, ex, breaker)
+                    settled = True
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    with self._tracer.span('touchworks.backoff', attempt=attempt, delay=delay):
+                        await asyncio.sleep(delay)
+                    continue
+                if self._exchange_observers:
+                    self._record(api, data, attempt, started, body, response, stream)
+                if breaker is not None:
+                    breaker.record_success()
+                settled = True
+                return response
+            finally:
+                if breaker is not None and not settled:
+                    breaker.release_trial()
+
+    async def _send(self, api, body, headers, stream=False):
+        scheduler = self._scheduler
+        if scheduler is None:
+            return await self._send_rate_limited(api, body, headers, stream)
+        priority, deadline = current_priority()
+        loop = asyncio.get_event_loop()
+        admitted = loop.create_future()
+
+        def wake():
+            # may be called from a thread releasing a slot of a shared scheduler
+            loop.call_soon_threadsafe(
+                lambda: admitted.done() or admitted.set_result(True))
+
+        waiter = scheduler.enqueue(priority, deadline, wake)
+        try:
+            timeout = max(deadline - time.time(), 0) if deadline is not None else None
+            with self._tracer.span('touchworks.scheduler', priority=priority):
+                await asyncio.wait_for(asyncio.shield(admitted), timeout)
+        except asyncio.CancelledError:
+            if not scheduler.cancel(waiter):
+                scheduler.release(priority)
+            raise
+        except asyncio.TimeoutError:
+            if scheduler.cancel(waiter):
+                raise TouchWorksDeadlineExceededException(
+                    '%s %s' % (TouchWorksErrorMessages.DEADLINE_EXCEEDED, api))
+            # admitted while timing out, the slot is ours to use
+        try:
+            response = await self._send_rate_limited(api, body, headers, stream)
+        except BaseException:
+            scheduler.release(priority)
+            raise
+        if isinstance(response, StreamingResponse):
+            # the body is yet to be downloaded, keep the slot until it is closed
+            return release_on_close(response, lambda: scheduler.release(priority))
+        scheduler.release(priority)
+        return response
+
+    async def _send_rate_limited(self, api, body, headers, stream):
+        limiter = self._rate_limiter
+        if limiter is None:
+            return await self._post(api, body, headers, stream)
+        with self._tracer.span('touchworks.rate_limit'):
+            wait = limiter.try_acquire()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = limiter.try_acquire()
+        started = time.time()
+        try:
+            response = await self._post(api, body, headers, stream)
+        except BaseException:
+            limiter.release(time.time() - started, congested=True)
+            raise
+        congested = response.status_code in self._retry_policy.retry_statuses
+        if isinstance(response, StreamingResponse):
+            return release_on_close(
+                response, lambda: limiter.release(time.time() - started, congested=congested))
+        limiter.release(time.time() - started, congested=congested)
+        return response
+
+    async def _post(self, api, body, headers, stream):
+        with self._tracer.span('touchworks.http', endpoint=api) as span:
+            response = await self._transport.post(self._base_url + '/' + api,
+                                                  data=body, headers=headers, stream=stream)
+            span.set_attribute('status_code', response.status_code)
+            return response
+
+    async def _invoke_magic(self, magic, result_key):
+        """
+        posts a magic json envelope to TouchWorksEndPoints.MAGIC_JSON and
+        returns the value stored under result_key in the response
+        """
+        with self._tracer.span('touchworks.call',
+                               **self._tracer.envelope_attributes(magic)) as span:
+            cache = self._response_cache
+            if cache is None:
+                return await self._call_magic(magic, result_key)
+            if cache.is_cacheable(magic['Action']):
+                hit, result = cache.get(magic)
+                self._metrics.cache_access('response', hit)
+                span.set_attribute('cache_hit', hit)
+                if not hit:
+                    result = await self._call_magic(magic, result_key)
+                    cache.put(magic, result)
+                return result
+            result = await self._call_magic(magic, result_key)
+            cache.on_write(magic)
+            return result
+
+    def _create_single_flight(self):
+        return AsyncSingleFlight()
+
+    async def _call_magic(self, magic, result_key):
+        if self._single_flight is not None:
+            return await self._single_flight.do(
+                magic, lambda: self._call_magic_with_token(magic, result_key))
+        return await self._call_magic_with_token(magic, result_key)
+
+    async def _call_magic_with_token(self, magic, result_key):
+        if not magic['Token']:
+            with self._tracer.span('touchworks.token'):
+                token = await self._ensure_token()
+            magic['Token'] = token.token
+        try:
+            return await self._post_magic(magic, result_key)
+        except TouchWorksTokenException:
+            # the token expired on the server, replay the call once with a new one
+            logger.debug('token rejected for %s, acquiring a new one', magic['Action'])
+            with self._tracer.span('touchworks.token', refresh=True):
+                token = await self._ensure_token(stale_token=magic['Token'])
+            magic['Token'] = token.token
+            return await self._post_magic(magic, result_key)
+
+    async def _post_magic(self, magic, result_key):
+        started = time.time()
+        try:
+            try:
+                response = await self._http_request(TouchWorksEndPoints.MAGIC_JSON,
+                                                    data=magic)
+            except requests.HTTPError as ex:
+                if ex.response is not None and ex.response.status_code == 401:
+                    raise TouchWorksTokenException(str(ex))
+                raise
+            with self._tracer.span('touchworks.parse'):
+                result = self._get_results_or_raise_if_magic_invalid(magic, response,
+                                                                     result_key)
+        except Exception as ex:
+            self._metrics.observe(magic['Action'], time.time() - started, error=ex)
+            raise
+        self._metrics.observe(magic['Action'], time.time() - started)
+        return result
+
+    def _stream_magic(self, magic, result_key):
+        """
+        :return: asynchronous iterator of the rows stored under result_key,
+            use with async for
+        """
+        return AsyncRowStream(self, magic, result_key)
+
+    async def _fetch_sharded(self, calls, id_fields, max_workers, window_retries):
+        results = [None] * len(calls)
+        pending = list(range(len(calls)))
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def fetch(index):
+            action, kwargs = calls[index]
+            async with semaphore:
+                return await getattr(self, action)(**kwargs)
+
+        for attempt in range(window_retries + 1):
+            outcomes = await asyncio.gather(*[fetch(i) for i in pending],
+                                            return_exceptions=True)
+            failed = []
+            for index, outcome in zip(pending, outcomes):
+                if isinstance(outcome, Exception):
+                    failed.append((index, outcome))
+                else:
+                    results[index] = outcome
+            if not failed:
+                return sharding.merge_rows(results, id_fields)
+            logger.debug('%s of %s windows failed', len(failed), len(calls))
+            pending = [index for index, _ in failed]
+        raise failed[0][1]
+
+    async def find_document_type_by_name(self, entity_name, active='Y',
+                                         match_case=True):
+        """
+        search document types by name and active(Y/N) status
+        :param entity_name: entity name
+        :return:
+        """
+        index = await self.get_dictionary_index('Document_Type_DE')
+        return copy_entries(index.search(entity_name, active=active, match_case=match_case))
+
+    async def get_dictionary(self, dictionary_name):
+        """
+        invokes TouchWorksMagicConstants.ACTION_GET_DICTIONARY action. results are
+        cached for dictionary_cache_ttl seconds, see invalidate_dictionary
+        :return: JSON response
+        """
+        index = await self.get_dictionary_index(dictionary_name)
+        return copy_entries(index.entries)
+
+    async def get_dictionary_index(self, dictionary_name):
+        cache = self._dictionary_cache
+        index, fresh = cache.peek(dictionary_name)
+        self._metrics.cache_access('dictionary', fresh)
+        if fresh:
+            return index
+        if index is not None and cache.store is not None:
+            # serve the stale snapshot and reload it without blocking the caller
+            if cache.start_revalidation(dictionary_name):
+                asyncio.ensure_future(self._revalidate_dictionary(dictionary_name))
+            return index
+        entries = await self._fetch_dictionary(dictionary_name)
+        return cache.put(dictionary_name, entries)
+
+    async def _revalidate_dictionary(self, dictionary_name):
+        try:
+            entries = await self._fetch_dictionary(dictionary_name)
+            self._dictionary_cache.put(dictionary_name, entries)
+        except Exception as ex:
+            logger.exception(ex)
+        finally:
+            self._dictionary_cache.finish_revalidation(dictionary_name)
+
+
+class AsyncRowStream(object):
+    """
+    yields the rows of a magic json response while it is being downloaded.
+    a rejected token is replaced and the call replayed once, which is safe
+    because the server reports it before any row
+    """
+
+    def __init__(self, client, magic, result_key):
+        self._client = client
+        self._magic = magic
+        self._result_key = result_key
+        self._response = None
+        self._parser = None
+        self._rows = collections.deque()
+        self._attempt = 0
+        self._done = False
+        self._started = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._started is None:
+            self._started = time.time()
+        try:
+            while not self._rows:
+                if self._done:
+                    raise StopAsyncIteration
+                if self._response is None:
+                    await self._open()
+                    continue
+                await self._read()
+            return self._rows.popleft()
+        except StopAsyncIteration:
+            self._observe()
+            raise
+        except Exception as ex:
+            self.close()
+            self._observe(ex)
+            raise
+        except BaseException:
+            self.close()
+            raise
+
+    def _observe(self, error=None):
+        if self._started is not None:
+            self._client.metrics.observe(self._magic['Action'], time.time() - self._started,
+                                         error=error)
+            self._started = None
+
+    async def _open(self):
+        client, magic = self._client, self._magic
+        try:
+            with client._tracer.span('touchworks.call', stream=True,
+                                     **client._tracer.envelope_attributes(magic)):
+                if not magic['Token']:
+                    with client._tracer.span('touchworks.token'):
+                        magic['Token'] = (await client._ensure_token()).token
+                self._response = await client._http_request(TouchWorksEndPoints.MAGIC_JSON,
+                                                            data=magic, stream=True)
+        except requests.HTTPError as ex:
+            if self._attempt == 0 and ex.response is not None and \
+                    ex.response.status_code == 401:
+                await self._replay()
+                return
+            raise
+        self._parser = ResultRowParser(self._result_key)
+
+    async def _replay(self):
+        self._attempt += 1
+        token = await self._client._ensure_token(stale_token=self._magic['Token'])
+        self._magic['Token'] = token.token
+
+    async def _read(self):
+        chunk = await self._response.read_chunk(self._client.STREAM_CHUNK_SIZE)
+        try:
+            if chunk:
+                self._rows.extend(self._parser.feed(chunk))
+                return
+            self._rows.extend(self._parser.close())
+            self._done = True
+        except MagicJsonError as ex:
+            error = str(ex)
+            self.close()
+            if self._attempt == 0 and self._client._is_token_error(error):
+                logger.debug('token rejected for %s, acquiring a new one',
+                             self._magic['Action'])
+                await self._replay()
+                return
+            if error:
+                raise TouchWorksException(self._magic['Action'] + ' API failed' + ' : ' + error)
+            raise TouchWorksException(TouchWorksErrorMessages.MAGIC_JSON_FAILED)
+        except ValueError as ex:
+            logger.exception(ex)
+            raise TouchWorksException(TouchWorksErrorMessages.MAGIC_JSON_FAILED)
+        finally:
+            if self._done:
+                self.close()
+
+    def close(self):
+        """
+        hands the connection back to the pool, needed only when iteration is
+        stopped early
+        """
+        if self._response is not None:
+            self._response.close()
+            self._response = None
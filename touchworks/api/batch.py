@@ -0,0 +1,133 @@
+from touchworks.logger import Logger
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import collections
+
+logger = Logger.get_logger(__name__)
+
+
+class BatchResult(object):
+    """
+    outcome of one call made by BatchExecutor. exactly one of result and
+    exception is set
+    """
+
+    def __init__(self, index, action, kwargs, result=None, exception=None):
+        self.index = index
+        self.action = action
+        self.kwargs = kwargs
+        self.result = result
+        self.exception = exception
+
+    @property
+    def ok(self):
+        return self.exception is None
+
+    def get(self):
+        """
+        :return: the result of the call or raises the exception it failed with
+        """
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def __repr__(self):
+        if self.ok:
+            return '<BatchResult #%s %s ok>' % (self.index, self.action)
+        return '<BatchResult #%s %s failed: %r>' % (self.index, self.action, self.exception)
+
+
+class BatchExecutor(object):
+    """
+    runs many TouchWorks actions concurrently on a bounded thread pool.
+    every worker uses the same client so the security token and the pooled
+    connections are shared. the client pool_size should be at least
+    max_workers or workers will open connections that are not kept alive
+    """
+    DEFAULT_MAX_WORKERS = 8
+
+    def __init__(self, client, max_workers=DEFAULT_MAX_WORKERS, priority=None):
+        """
+        :param client: TouchWorks
+        :param max_workers: optional - number of worker threads
+        :param priority: optional - scheduler priority the calls are made with
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than zero')
+        self._client = client
+        self._priority = priority
+        self._max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _resolve(self, action):
+        if callable(action):
+            return action
+        if not action or action.startswith('_'):
+            raise ValueError('%s is not a TouchWorks action' % action)
+        method = getattr(self._client, action, None)
+        if not callable(method):
+            raise ValueError('%s is not a TouchWorks action' % action)
+        return method
+
+    def _call(self, index, action, kwargs):
+        try:
+            method = self._resolve(action)
+            if self._priority is None:
+                return BatchResult(index, action, kwargs, result=method(**kwargs))
+            with self._client.priority(self._priority):
+                return BatchResult(index, action, kwargs, result=method(**kwargs))
+        except Exception as ex:
+            logger.debug('batch call #%s %s failed : %s', index, action, ex)
+            return BatchResult(index, action, kwargs, exception=ex)
+
+    def run(self, calls, ordered=False):
+        """
+        runs every call and yields a BatchResult for each. failures are captured
+        in the BatchResult and never stop the rest of the batch.
+        calls are submitted lazily so at most 2 * max_workers are queued at once,
+        which keeps memory flat for very large or generated batches
+        :param calls: iterable of (action, kwargs) where action is the name of a
+            TouchWorks method such as 'get_patient' or any callable
+        :param ordered: if True results are yielded in input order otherwise in
+            completion order
+        :return: generator of BatchResult
+        """
+        calls = enumerate(calls)
+        window = self._max_workers * 2
+        if ordered:
+            pending = collections.deque()
+        else:
+            pending = set()
+
+        def submit_more():
+            while len(pending) < window:
+                try:
+                    index, (action, kwargs) = next(calls)
+                except StopIteration:
+                    return
+                future = self._executor.submit(self._call, index, action, kwargs or {})
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+
+        submit_more()
+        while pending:
+            if ordered:
+                result = pending.popleft().result()
+                submit_more()
+                yield result
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                pending.difference_update(done)
+                submit_more()
+                for future in done:
+                    yield future.result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,143 @@
+from touchworks.logger import Logger
+import collections
+import copy
+import threading
+import time
+
+logger = Logger.get_logger(__name__)
+
+
+class ResponseCache(object):
+    """
+    size bounded, least-recently-used cache of Magic JSON results for read-only
+    actions. entries are keyed by the normalized envelope (action, user,
+    patient and parameters, never the token) and expire after a per-action ttl.
+
+    actions missing from ttls are never cached. actions listed in invalidates
+    are writes: once they succeed they drop the cached entries of their patient
+    and of the read actions listed for them
+    """
+    DEFAULT_MAX_ENTRIES = 1024
+    DEFAULT_TTLS = {
+        'GetPatient': 30,
+        'GetProvider': 5 * 60,
+        'GetProviderInfo': 5 * 60,
+        'GetUserPreferences': 5 * 60,
+        'GetDocumentType': 10 * 60,
+    }
+    DEFAULT_INVALIDATES = {
+        'SaveNote': ['GetDocuments'],
+        'SaveUnstructuredDocument': ['GetDocuments'],
+        'SetPatientLocationAndStatus': ['GetPatient', 'GetEncounter',
+                                        'GetEncounterListForPatient'],
+        'savetask': ['GetTask', 'GetTaskList', 'GetTaskListByView'],
+        'SaveTaskStatus': ['GetTask', 'GetTaskList', 'GetTaskListByView'],
+        'SaveTaskComent': ['GetTaskComments'],
+        'SetPatientMedHXFlag': [],
+        'SaveMsgFromPatPortal': [],
+    }
+
+    def __init__(self, ttls=None, max_entries=DEFAULT_MAX_ENTRIES, invalidates=None):
+        """
+        :param ttls: optional - dict of Action name to seconds its results are cached,
+            defaults to DEFAULT_TTLS
+        :param max_entries: optional - least recently used entries are evicted beyond this
+        :param invalidates: optional - dict of write Action name to the read Action names
+            whose entries it drops, defaults to DEFAULT_INVALIDATES
+        """
+        if max_entries < 1:
+            raise ValueError('max_entries must be greater than zero')
+        self._ttls = dict((self._action(a), t) for a, t in (ttls or self.DEFAULT_TTLS).items())
+        self._invalidates = dict(
+            (self._action(a), set(self._action(r) for r in reads))
+            for a, reads in (invalidates or self.DEFAULT_INVALIDATES).items())
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _action(action):
+        # some TouchWorksMagicConstants actions carry stray whitespace
+        return (action or '').strip()
+
+    @staticmethod
+    def key(magic):
+        """
+        :return: hashable key of a magic json envelope, ignoring the token
+        """
+        return tuple(sorted((k, v) for k, v in magic.items() if k != 'Token'))
+
+    def is_cacheable(self, action):
+        return self._action(action) in self._ttls
+
+    def get(self, magic):
+        """
+        :return: (True, result) on a hit, (False, None) on a miss
+        """
+        key = self.key(magic)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.time():
+                # most recently used entries live at the end
+                self._entries[key] = self._entries.pop(key)
+                self.hits += 1
+                result = entry[1]
+            else:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False, None
+        return True, copy.deepcopy(result)
+
+    def put(self, magic, result):
+        ttl = self._ttls.get(self._action(magic.get('Action')))
+        if not ttl:
+            return
+        key = self.key(magic)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, copy.deepcopy(result))
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def on_write(self, magic):
+        """
+        drops the entries a successful write action may have made stale
+        """
+        action = self._action(magic.get('Action'))
+        if action not in self._invalidates:
+            return
+        actions = self._invalidates[action]
+        patient_id = magic.get('PatientID') or None
+        if actions or patient_id is not None:
+            self.invalidate(actions=actions, patient_id=patient_id)
+
+    def invalidate(self, actions=None, patient_id=None):
+        """
+        drops the entries of any of actions and of patient_id. with neither given
+        the whole cache is cleared
+        """
+        actions = set(self._action(a) for a in actions or [])
+        if patient_id is not None:
+            patient_id = str(patient_id)
+        with self._lock:
+            if not actions and patient_id is None:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                fields = dict(key)
+                if self._action(fields.get('Action')) in actions or \
+                        (patient_id is not None and str(fields.get('PatientID')) == patient_id):
+                    del self._entries[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0}
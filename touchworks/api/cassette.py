@@ -0,0 +1,273 @@
+"""
+capture of the real call mix of a client and replay of it against a stand-in
+server such as touchworks.api.simulator.
+
+a CassetteRecorder passed as recorder= to TouchWorks appends one line per HTTP
+exchange to a file: when it started, the action, the attempt, how long it
+took, request and response sizes, the status and a redacted envelope.
+envelope values other than safe_fields are never written. PatientID and
+AppUserID are replaced by keyed hashes, so repeated calls for the same patient
+stay recognizable while the key, which is never written, is lost with the
+process. GetToken bodies are not recorded at all.
+
+    recorder = CassetteRecorder('/var/log/app/traffic.cassette')
+    tw = TouchWorks(..., recorder=recorder)
+
+CassetteReplayer re-issues the first attempt of every recorded Magic JSON call
+through a client at the recorded pace, or speed times faster. retries, tokens,
+caching and rate limiting are left to the replaying client
+
+    python -m touchworks.api.cassette traffic.cassette --speed 10
+"""
+from __future__ import print_function
+from touchworks.logger import Logger
+from touchworks.api.http import TouchWorks, TouchWorksEndPoints
+from touchworks.api.simulator import TouchWorksSimulator, result_keys
+from touchworks.api.tracing import REDACTED, Tracer, redact_envelope
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+logger = Logger.get_logger(__name__)
+
+PSEUDONYM_PREFIX = 'p:'
+
+
+class CassetteRecorder(object):
+    """
+    appends exchanges to path as JSON lines. thread safe, lines of several
+    clients or processes may share a file
+    """
+    DEFAULT_PSEUDONYMIZED_FIELDS = ('PatientID', 'AppUserID')
+
+    def __init__(self, path, safe_fields=Tracer.DEFAULT_SAFE_FIELDS,
+                 pseudonymized_fields=DEFAULT_PSEUDONYMIZED_FIELDS):
+        """
+        :param path: file the exchanges are appended to
+        :param safe_fields: optional - envelope fields recorded with their value
+        :param pseudonymized_fields: optional - envelope fields recorded as keyed hashes
+        """
+        self.path = path
+        self._safe_fields = frozenset(safe_fields)
+        self._pseudonymized_fields = frozenset(pseudonymized_fields)
+        self._key = os.urandom(16)
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+        self.records = 0
+
+    def pseudonym(self, value):
+        digest = hmac.new(self._key, str(value).encode('utf-8'), hashlib.sha256)
+        return PSEUDONYM_PREFIX + digest.hexdigest()[:12]
+
+    def envelope(self, data):
+        """
+        :return: copy of a magic json envelope without PHI
+        """
+        return redact_envelope(data, self._safe_fields, self._pseudonymize)
+
+    def _pseudonymize(self, field, value):
+        if field in self._pseudonymized_fields:
+            return self.pseudonym(value)
+        return REDACTED
+
+    def record(self, api, data, attempt, started, duration, request_bytes,
+               response_bytes=None, status=None, error=None):
+        """
+        appends one exchange
+        :param attempt: 0 for the first try, then the retry number
+        :param started: time.time() the exchange started at
+        :param response_bytes: optional - None for a streamed or failed exchange
+        :param error: optional - the exception the exchange failed with
+        """
+        line = {'t': round(started, 3),
+                'api': api,
+                'attempt': attempt,
+                'ms': round(duration * 1000, 2),
+                'req': request_bytes}
+        if api == TouchWorksEndPoints.MAGIC_JSON:
+            line['action'] = (data.get('Action') or '').strip()
+            line['env'] = self.envelope(data)
+        else:
+            line['action'] = api.rsplit('/', 1)[-1]
+        if response_bytes is not None:
+            line['resp'] = response_bytes
+        if status is not None:
+            line['status'] = status
+        if error is not None:
+            line['error'] = type(error).__name__
+        text = json.dumps(line, sort_keys=True, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(text)
+            self._file.flush()
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load(path):
+    """
+    :return: list of the recorded exchanges of path in order of their start time.
+        a line cut short by a crash is skipped
+    """
+    records = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning('skipping malformed line %d of %s', number, path)
+    records.sort(key=lambda r: r['t'])
+    return records
+
+
+class CassetteReplayer(object):
+    """
+    replays the Magic JSON calls of a cassette through a TouchWorks client,
+    each one at its recorded offset divided by speed. pseudonymized patients
+    are mapped onto patient ids 1 to patients, redacted parameters are sent
+    empty and a redacted Data field is padded to the recorded request size.
+
+    uses a thread pool so it works with the thread based client only
+    """
+    DEFAULT_MAX_WORKERS = 32
+
+    def __init__(self, client, records, speed=1.0, max_workers=DEFAULT_MAX_WORKERS,
+                 patients=100):
+        """
+        :param records: exchanges as returned by load
+        :param speed: optional - 2 replays twice as fast as recorded
+        :param max_workers: optional - calls in flight at once, a late call waits
+        :param patients: optional - patient ids the pseudonyms are mapped onto
+        """
+        if speed <= 0:
+            raise ValueError('speed must be greater than zero')
+        self._client = client
+        self._records = [r for r in records
+                         if r.get('api') == TouchWorksEndPoints.MAGIC_JSON and
+                         not r.get('attempt')]
+        self._speed = speed
+        self._max_workers = max_workers
+        self._patients = patients
+        self._result_keys = result_keys()
+        self._lock = threading.Lock()
+
+    def _patient_id(self, value):
+        if not value or not value.startswith(PSEUDONYM_PREFIX):
+            return ''
+        return str(int(value[len(PSEUDONYM_PREFIX):], 16) % self._patients + 1)
+
+    def _magic(self, record):
+        env = record.get('env') or {}
+
+        def value(field):
+            found = env.get(field, '')
+            return '' if found == REDACTED or str(found).startswith(PSEUDONYM_PREFIX) else found
+        magic = self._client._magic_json(action=record['action'],
+                                         app_name=value('Appname'),
+                                         patient_id=self._patient_id(env.get('PatientID')),
+                                         parameter1=value('Parameter1'),
+                                         parameter2=value('Parameter2'),
+                                         parameter3=value('Parameter3'),
+                                         parameter4=value('Parameter4'),
+                                         parameter5=value('Parameter5'),
+                                         parameter6=value('Parameter6'))
+        if env.get('Data') == REDACTED:
+            padding = record.get('req', 0) - len(self._client._codec.dumps(magic))
+            magic['Data'] = 'x' * max(padding, 1)
+        return magic
+
+    def run(self):
+        """
+        :return: dict with calls, errors by exception type, elapsed and
+            recorded_elapsed seconds and max_lag, the most a call started
+            behind its schedule
+        """
+        report = {'calls': 0, 'errors': {}, 'max_lag': 0.0,
+                  'recorded_elapsed': 0.0, 'elapsed': 0.0}
+        if not self._records:
+            return report
+        first = self._records[0]['t']
+        report['recorded_elapsed'] = self._records[-1]['t'] - first
+        started = time.time()
+
+        def call(record, due):
+            lag = time.time() - due
+            error = None
+            try:
+                self._client._invoke_magic(
+                    self._magic(record),
+                    self._result_keys.get(record['action'], record['action'].lower() + 'info'))
+            except Exception as ex:
+                error = ex
+            with self._lock:
+                report['calls'] += 1
+                report['max_lag'] = max(report['max_lag'], lag)
+                if error is not None:
+                    name = type(error).__name__
+                    report['errors'][name] = report['errors'].get(name, 0) + 1
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            for record in self._records:
+                due = started + (record['t'] - first) / self._speed
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                executor.submit(call, record, due)
+        report['elapsed'] = time.time() - started
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replays a cassette against a TouchWorks '
+                                                 'simulator or server')
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=1.0, help='2 replays twice as fast')
+    parser.add_argument('--workers', type=int, default=CassetteReplayer.DEFAULT_MAX_WORKERS)
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--url', help='server to replay against, default a local simulator')
+    parser.add_argument('--username', default=TouchWorksSimulator.DEFAULT_USERNAME)
+    parser.add_argument('--password', default=TouchWorksSimulator.DEFAULT_PASSWORD)
+    parser.add_argument('--appname', default='replay')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the local simulator adds to each request')
+    args = parser.parse_args()
+
+    simulator = None
+    url = args.url
+    if not url:
+        simulator = TouchWorksSimulator(patients=args.patients, latency=args.latency).start()
+        url = simulator.url
+    try:
+        client = TouchWorks(url, args.username, args.password, args.appname,
+                            pool_size=args.workers)
+        report = CassetteReplayer(client, load(args.path), speed=args.speed,
+                                  max_workers=args.workers, patients=args.patients).run()
+        report['metrics'] = client.metrics.snapshot()
+        print(json.dumps(report, indent=2, sort_keys=True))
+    finally:
+        if simulator is not None:
+            simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+JSON encoding of request envelopes and decoding of responses.
+
+default_codec() picks the fastest library that is installed: orjson, then
+ujson, then the standard library json module. every codec encodes to and
+decodes from UTF-8 bytes so a response body is parsed straight from
+response.content
+"""
+import json
+import sys
+
+# json.loads takes bytes from Python 3.6, Python 2 str is bytes already
+_DECODE_BYTES = (3, 0) <= sys.version_info < (3, 6)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JsonCodec(object):
+    """
+    standard library json
+    """
+    name = 'json'
+
+    def dumps(self, obj):
+        """
+        :return: obj as JSON encoded in UTF-8 bytes
+        """
+        return json.dumps(obj).encode('utf-8')
+
+    def loads(self, data):
+        """
+        :param data: bytes or text
+        """
+        if _DECODE_BYTES and isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('orjson is not installed')
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        if ujson is None:
+            raise ImportError('ujson is not installed')
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False,
+                           escape_forward_slashes=False).encode('utf-8')
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+CODECS = (OrjsonCodec, UjsonCodec, JsonCodec)
+
+_default = None
+
+
+def get_codec(name=None):
+    """
+    :param name: optional - 'orjson', 'ujson' or 'json', the fastest installed one
+        when not given
+    :return: JsonCodec
+    """
+    for codec in CODECS:
+        if name is not None and codec.name != name:
+            continue
+        try:
+            return codec()
+        except ImportError:
+            if name is not None:
+                raise
+    raise ValueError('unknown json codec %s' % name)
+
+
+def default_codec():
+    """
+    :return: the codec shared by clients that were not given one
+    """
+    global _default
+    if _default is None:
+        _default = get_codec()
+    return _default
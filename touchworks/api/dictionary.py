@@ -0,0 +1,419 @@
+from touchworks.logger import Logger
+import bisect
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+logger = Logger.get_logger(__name__)
+
+
+class DictionaryIndex(object):
+    """
+    read-only view over the entries of one GetDictionary result with lookup
+    tables built once when the dictionary is loaded:
+        EntryName (exact and lower-cased), EntryCode, EntryMnemonic, Active flag
+    and a sorted lower-cased EntryName list for prefix scans.
+    lookups return the indexed entries themselves, callers must not modify them
+    """
+    DEFAULT_MAX_SEARCHES = 256
+
+    def __init__(self, name, entries, loaded_time=None, max_searches=DEFAULT_MAX_SEARCHES):
+        """
+        :param max_searches: optional - distinct search results kept, least recently
+            used ones are dropped beyond this
+        """
+        self.name = name
+        self.entries = entries or []
+        self.loaded_time = loaded_time or time.time()
+        self._by_name = {}
+        self._by_folded_name = {}
+        self._by_code = {}
+        self._by_mnemonic = {}
+        self._by_active = {}
+        self._max_searches = max_searches
+        self._searches = collections.OrderedDict()
+        self._search_lock = threading.Lock()
+        for entry in self.entries:
+            name = entry.get('EntryName') or ''
+            self._by_name.setdefault(name, []).append(entry)
+            self._by_folded_name.setdefault(name.lower(), []).append(entry)
+            if entry.get('EntryCode') is not None:
+                self._by_code.setdefault(entry['EntryCode'], []).append(entry)
+            if entry.get('EntryMnemonic') is not None:
+                self._by_mnemonic.setdefault(entry['EntryMnemonic'], []).append(entry)
+            self._by_active.setdefault(entry.get('Active'), []).append(
+                (name, name.lower(), entry))
+        self._sorted_names = sorted(((entry.get('EntryName') or '').lower(), i)
+                                    for i, entry in enumerate(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def age(self):
+        return time.time() - self.loaded_time
+
+    @staticmethod
+    def _active(entries, active):
+        if active is None:
+            return list(entries)
+        return [e for e in entries if e.get('Active') == active]
+
+    def find_by_name(self, entry_name, active=None, match_case=True):
+        """
+        exact EntryName lookup
+        """
+        if match_case:
+            entries = self._by_name.get(entry_name, [])
+        else:
+            entries = self._by_folded_name.get(entry_name.lower(), [])
+        return self._active(entries, active)
+
+    def find_by_code(self, entry_code, active=None):
+        return self._active(self._by_code.get(entry_code, []), active)
+
+    def find_by_mnemonic(self, entry_mnemonic, active=None):
+        return self._active(self._by_mnemonic.get(entry_mnemonic, []), active)
+
+    def find_active(self, active='Y'):
+        return [entry for _, _, entry in self._by_active.get(active, [])]
+
+    def find_by_prefix(self, prefix, active=None):
+        """
+        case-insensitive EntryName prefix lookup using the sorted name index
+        """
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self._sorted_names, (prefix, -1))
+        found = []
+        for folded, i in self._sorted_names[start:]:
+            if not folded.startswith(prefix):
+                break
+            found.append(self.entries[i])
+        return self._active(found, active)
+
+    def search(self, text, active='Y', match_case=True):
+        """
+        EntryName substring search restricted to entries with the given Active flag.
+        the results of the max_searches most recent distinct searches are kept
+        """
+        key = (text, active, match_case)
+        with self._search_lock:
+            found = self._searches.get(key)
+            if found is not None:
+                # most recently used searches live at the end
+                self._searches[key] = self._searches.pop(key)
+                return list(found)
+        candidates = self._by_active.get(active, [])
+        if match_case:
+            found = [entry for name, _, entry in candidates if text in name]
+        else:
+            folded_text = text.lower()
+            found = [entry for _, folded, entry in candidates if folded_text in folded]
+        with self._search_lock:
+            self._searches.pop(key, None)
+            self._searches[key] = found
+            while len(self._searches) > self._max_searches:
+                self._searches.popitem(last=False)
+        return list(found)
+
+
+def copy_entries(entries):
+    """
+    :return: list of copies of dictionary entries, safe to hand to callers. entry
+        values are plain strings so a shallow copy is enough
+    """
+    return [dict(entry) for entry in entries]
+
+
+class DictionarySnapshot(object):
+    """
+    a dictionary as persisted by SqliteDictionaryStore. version is bumped every
+    time the saved entries differ from the previous snapshot
+    """
+
+    def __init__(self, name, entries, version, fetched_time, digest):
+        self.name = name
+        self.entries = entries
+        self.version = version
+        self.fetched_time = fetched_time
+        self.digest = digest
+
+    def age(self):
+        return time.time() - self.fetched_time
+
+
+class SqliteDictionaryStore(object):
+    """
+    persists GetDictionary results in a SQLite file so that new processes start
+    with every dictionary already available instead of downloading them again.
+    the file can be shared by many processes, snapshots are kept per scope
+    (the base_url of the client) and ignored once older than max_age
+    """
+    SCHEMA_VERSION = 1
+    DEFAULT_MAX_AGE_IN_SECS = 7 * 24 * 60 * 60
+    LOCK_TIMEOUT_IN_SECS = 10
+
+    def __init__(self, path, max_age=DEFAULT_MAX_AGE_IN_SECS):
+        """
+        :param path: SQLite file, created if it does not exist
+        :param max_age: optional - snapshots older than this many seconds are not used
+        """
+        self._path = path
+        self._max_age = max_age
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS dictionary_snapshot ('
+                         'scope TEXT NOT NULL, '
+                         'name TEXT NOT NULL, '
+                         'schema_version INTEGER NOT NULL, '
+                         'version INTEGER NOT NULL, '
+                         'fetched_time REAL NOT NULL, '
+                         'digest TEXT NOT NULL, '
+                         'entries TEXT NOT NULL, '
+                         'PRIMARY KEY (scope, name))')
+
+    @property
+    def path(self):
+        return self._path
+
+    def _connect(self):
+        # a connection per operation keeps the store usable from any thread or
+        # forked process
+        return _closing_connection(sqlite3.connect(self._path,
+                                                   timeout=self.LOCK_TIMEOUT_IN_SECS))
+
+    def load(self, scope, name):
+        """
+        :return: DictionarySnapshot or None if there is no usable snapshot
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT version, fetched_time, digest, entries '
+                               'FROM dictionary_snapshot '
+                               'WHERE scope = ? AND name = ? AND schema_version = ?',
+                               (scope, name, self.SCHEMA_VERSION)).fetchone()
+        if row is None:
+            return None
+        version, fetched_time, digest, entries = row
+        if self._max_age and time.time() - fetched_time > self._max_age:
+            return None
+        try:
+            entries = json.loads(entries)
+        except ValueError:
+            logger.error('dictionary snapshot %s is corrupt, ignoring it', name)
+            return None
+        return DictionarySnapshot(name, entries, version, fetched_time, digest)
+
+    def save(self, scope, name, entries, fetched_time=None):
+        """
+        :return: the saved DictionarySnapshot
+        """
+        fetched_time = fetched_time or time.time()
+        payload = json.dumps(entries, sort_keys=True)
+        digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+        with self._connect() as conn:
+            row = conn.execute('SELECT version, digest FROM dictionary_snapshot '
+                               'WHERE scope = ? AND name = ?', (scope, name)).fetchone()
+            version = 1
+            if row is not None:
+                version = row[0] if row[1] == digest else row[0] + 1
+            conn.execute('INSERT OR REPLACE INTO dictionary_snapshot '
+                         '(scope, name, schema_version, version, fetched_time, digest, entries) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (scope, name, self.SCHEMA_VERSION, version, fetched_time,
+                          digest, payload))
+        return DictionarySnapshot(name, entries, version, fetched_time, digest)
+
+    def delete(self, scope, name=None):
+        with self._connect() as conn:
+            if name is None:
+                conn.execute('DELETE FROM dictionary_snapshot WHERE scope = ?', (scope,))
+            else:
+                conn.execute('DELETE FROM dictionary_snapshot WHERE scope = ? AND name = ?',
+                             (scope, name))
+
+
+class _closing_connection(object):
+    """
+    commits (or rolls back) and closes a sqlite3 connection on exit
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        finally:
+            self._conn.close()
+
+
+class DictionaryCache(object):
+    """
+    per-client cache of GetDictionary results. each dictionary is loaded once,
+    indexed and served from memory until ttl seconds have passed or it is
+    invalidated. concurrent loads of the same dictionary are collapsed into one.
+
+    with a store, dictionaries missing from memory are read from the store's
+    snapshot and an expired dictionary keeps being served while it is loaded
+    again on a background thread
+    """
+    DEFAULT_TTL_IN_SECS = 60 * 60
+
+    def __init__(self, loader, ttl=DEFAULT_TTL_IN_SECS, store=None, scope=''):
+        """
+        :param loader: callable taking a dictionary name and returning its entries,
+            None if the caller loads them itself through peek() and put()
+        :param ttl: seconds a loaded dictionary is served before being loaded again.
+            0 disables caching
+        :param store: optional - SqliteDictionaryStore used for snapshots
+        :param scope: optional - key separating the snapshots of different servers
+        """
+        self._loader = loader
+        self._ttl = ttl
+        self._store = store if ttl else None
+        self._scope = scope
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._revalidating = set()
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    @property
+    def store(self):
+        return self._store
+
+    def _fresh(self, index):
+        return index is not None and bool(self._ttl) and index.age() <= self._ttl
+
+    def lookup(self, name):
+        """
+        :return: the cached DictionaryIndex or None if missing or expired
+        """
+        index = self._indexes.get(name)
+        if self._fresh(index):
+            return index
+        return None
+
+    def peek(self, name):
+        """
+        looks name up in memory then in the snapshot store, never calls the loader
+        :return: (DictionaryIndex or None, True if the index has not expired)
+        """
+        index = self._indexes.get(name)
+        if index is None and self._store is not None:
+            snapshot = self._load_snapshot(name)
+            if snapshot is not None:
+                index = self._remember(DictionaryIndex(name, snapshot.entries,
+                                                       loaded_time=snapshot.fetched_time))
+        return index, self._fresh(index)
+
+    def put(self, name, entries, loaded_time=None):
+        """
+        indexes entries and stores them as the current value of name
+        :return: DictionaryIndex
+        """
+        index = DictionaryIndex(name, entries, loaded_time=loaded_time)
+        if self._store is not None:
+            try:
+                self._store.save(self._scope, name, entries, fetched_time=index.loaded_time)
+            except sqlite3.Error as ex:
+                logger.exception(ex)
+        if self._ttl:
+            self._remember(index)
+        return index
+
+    def _remember(self, index):
+        with self._lock:
+            self._indexes[index.name] = index
+        return index
+
+    def _load_snapshot(self, name):
+        try:
+            return self._store.load(self._scope, name)
+        except sqlite3.Error as ex:
+            logger.exception(ex)
+            return None
+
+    def get(self, name):
+        """
+        :return: DictionaryIndex for name, loading it if missing or expired
+        """
+        index = self.lookup(name)
+        if index is not None:
+            return index
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            index, fresh = self.peek(name)
+            if fresh:
+                return index
+            if index is not None and self._store is not None:
+                self.revalidate_in_background(name)
+                return index
+            if self._loader is None:
+                raise ValueError('dictionary %s is not cached and there is no loader' % name)
+            logger.debug('loading dictionary %s', name)
+            return self.put(name, self._loader(name))
+
+    def start_revalidation(self, name):
+        """
+        :return: True if the caller should reload name, False if another caller
+            already is
+        """
+        with self._lock:
+            if name in self._revalidating:
+                return False
+            self._revalidating.add(name)
+            return True
+
+    def finish_revalidation(self, name):
+        with self._lock:
+            self._revalidating.discard(name)
+
+    def revalidate_in_background(self, name):
+        if self._loader is None or not self.start_revalidation(name):
+            return
+        thread = threading.Thread(target=self._revalidate, args=(name,),
+                                  name='touchworks-dictionary-%s' % name)
+        thread.daemon = True
+        thread.start()
+
+    def _revalidate(self, name):
+        try:
+            # another process sharing the store may have refreshed it already
+            snapshot = self._load_snapshot(name)
+            if snapshot is not None and snapshot.age() <= self._ttl:
+                self._remember(DictionaryIndex(name, snapshot.entries,
+                                               loaded_time=snapshot.fetched_time))
+                return
+            logger.debug('revalidating dictionary %s', name)
+            self.put(name, self._loader(name))
+        except Exception as ex:
+            # keep serving the stale dictionary, the next get() tries again
+            logger.exception(ex)
+        finally:
+            self.finish_revalidation(name)
+
+    def invalidate(self, name=None):
+        """
+        drops name, or every dictionary when name is None, from the cache and
+        from the snapshot store
+        """
+        with self._lock:
+            if name is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(name, None)
+        if self._store is not None:
+            self._store.delete(self._scope, name)
@@ -1,5 +1,19 @@
 from touchworks.logger import Logger
-import json
+from touchworks.api.transport import HttpTransport, release_on_close
+from touchworks.api.batch import BatchExecutor
+from touchworks.api.token import TokenManager
+from touchworks.api.dictionary import DictionaryCache, copy_entries
+from touchworks.api.singleflight import SingleFlight
+from touchworks.api.resilience import RetryPolicy, CircuitBreaker
+from touchworks.api.ratelimit import RateLimiter
+from touchworks.api.scheduler import Priority, call_priority, current_priority
+from touchworks.api.streaming import iter_result_rows, MagicJsonError
+from touchworks.api.codec import default_codec
+from touchworks.api import sharding
+from touchworks.api.metrics import MetricsRegistry
+from touchworks.api.tracing import NULL_TRACER
+import os
+import threading
 import uuid
 import requests
 import time
@@ -11,9 +25,34 @@ class TouchWorksException(Exception):
     pass
 
 
+class TouchWorksTokenException(TouchWorksException):
+    """
+    raised when the web service rejects the security token of a request
+    """
+    pass
+
+
+class TouchWorksCircuitOpenException(TouchWorksException):
+    """
+    raised without contacting the web service while its circuit breaker is open
+    """
+    pass
+
+
+class TouchWorksDeadlineExceededException(TouchWorksException):
+    """
+    raised when a request waited for the scheduler past its deadline
+    """
+    pass
+
+
 class TouchWorksErrorMessages(object):
     GET_TOKEN_FAILED_ERROR = 'unable to acquire the token from web service'
     MAGIC_JSON_FAILED = 'magic json api failed'
+    # lower-cased texts of the Error the web service returns for a bad or expired token
+    INVALID_TOKEN_ERRORS = ('invalid security token', 'security token has expired')
+    CIRCUIT_OPEN = 'web service is unhealthy, not sending requests to'
+    DEADLINE_EXCEEDED = 'deadline passed while waiting to send request to'
 
 
 class SecurityToken(object):
@@ -83,7 +122,7 @@ class TouchWorksMagicConstants(object):
     RESULT_GET_PATIENT_PHARAMCIES = 'getpatientpharmaciesinfo'
     ACTION_SET_PATIENT_MEDHX_FLAG = 'SetPatientMedHXFlag	'
     RESULT_SET_PATIENT_MEDHX_FLAG = 'setpatientmedhxflaginfo'
-    ACTION_GET_CHANGED_PATIENTS = 'GetChangedPatients	'
+    ACTION_GET_CHANGED_PATIENTS = 'GetChangedPatients'
     RESULT_GET_CHANGED_PATIENTS = 'getchangedpatientsinfo'
     ACTION_GET_PATIENT_LOCATIONS = 'GetPatientLocations	'
     RESULT_GET_PATIENT_LOCATIONS = 'getpatienlLocationsinfo'
@@ -101,11 +140,36 @@ class TouchWorksMagicConstants(object):
 
 class TouchWorks(object):
     TOKEN_DEFAULT_TIMEOUT_IN_SECS = 20 * 60
+    STREAM_CHUNK_SIZE = 64 * 1024
 
     def __init__(self, base_url, username,
                  password, app_name, cache_token=True,
                  token_timeout=TOKEN_DEFAULT_TIMEOUT_IN_SECS,
-                 app_username=None):
+                 app_username=None,
+                 transport=None,
+                 pool_size=HttpTransport.DEFAULT_POOL_SIZE,
+                 connect_timeout=HttpTransport.DEFAULT_CONNECT_TIMEOUT_IN_SECS,
+                 read_timeout=HttpTransport.DEFAULT_READ_TIMEOUT_IN_SECS,
+                 token_refresh_margin=TokenManager.DEFAULT_REFRESH_MARGIN_IN_SECS,
+                 lazy=False,
+                 dictionary_cache_ttl=DictionaryCache.DEFAULT_TTL_IN_SECS,
+                 dictionary_store=None,
+                 response_cache=None,
+                 single_flight=False,
+                 retry_policy=None,
+                 circuit_breaker_threshold=0,
+                 circuit_breaker_reset_timeout=CircuitBreaker.DEFAULT_RESET_TIMEOUT_IN_SECS,
+                 rate_limit=0,
+                 max_in_flight=0,
+                 adaptive_concurrency=False,
+                 latency_target=None,
+                 rate_limiter=None,
+                 scheduler=None,
+                 json_codec=None,
+                 metrics=None,
+                 tracer=None,
+                 recorder=None,
+                 request_log=None):
         """
         creates an instance of TouchWorks, connects to the TouchWorks Web Service
         and caches username, password, app_name
@@ -116,6 +180,57 @@ class TouchWorks(object):
         :param cache_token: optional
         :param token_timeout: optional
         :param app_username: optional
+        :param transport: optional - HttpTransport shared with other clients. when
+            given, pool_size, connect_timeout and read_timeout are ignored and the
+            transport is not closed by close()
+        :param pool_size: optional - max keep-alive connections kept to the server
+        :param connect_timeout: optional - seconds to wait for a connection
+        :param read_timeout: optional - seconds to wait for a response
+        :param token_refresh_margin: optional - the token is refreshed in the background
+            this many seconds before token_timeout elapses
+        :param lazy: optional - if True no request is made here, the token is acquired
+            on first use or in the background by warm(). safe to create before forking,
+            each child process acquires its own token and connection pool
+        :param dictionary_cache_ttl: optional - seconds GetDictionary results are served
+            from memory, 0 disables the dictionary cache
+        :param dictionary_store: optional - touchworks.api.dictionary.SqliteDictionaryStore
+            that persists dictionaries across processes. snapshots are used right away
+            and expired ones are revalidated in the background
+        :param response_cache: optional - touchworks.api.cache.ResponseCache serving
+            repeated read-only actions from memory
+        :param single_flight: optional - if True identical read calls made concurrently
+            share one request and its result
+        :param retry_policy: optional - touchworks.api.resilience.RetryPolicy for failed
+            requests, by default idempotent actions are retried 3 times with jittered
+            exponential backoff and writes are never retried
+        :param circuit_breaker_threshold: optional - after this many server failures in a
+            row calls to an endpoint fail fast with TouchWorksCircuitOpenException,
+            0 disables the circuit breaker
+        :param circuit_breaker_reset_timeout: optional - seconds an open circuit waits
+            before letting a trial call through
+        :param rate_limit: optional - requests per second sent to the web service, shared
+            by every client of the same base_url and app_name in this process. 0 disables
+        :param max_in_flight: optional - concurrent requests, shared like rate_limit.
+            0 disables
+        :param adaptive_concurrency: optional - shrink max_in_flight while the web service
+            throttles or fails and grow it back once it recovers
+        :param latency_target: optional - seconds, with adaptive_concurrency slower
+            requests shrink max_in_flight too
+        :param rate_limiter: optional - touchworks.api.ratelimit.RateLimiter used instead
+            of the shared one rate_limit, max_in_flight, adaptive_concurrency and
+            latency_target describe
+        :param scheduler: optional - touchworks.api.scheduler.RequestScheduler admitting
+            requests by priority, see priority()
+        :param json_codec: optional - touchworks.api.codec.JsonCodec, defaults to the
+            fastest JSON library installed
+        :param metrics: optional - touchworks.api.metrics.MetricsRegistry to record into,
+            pass the same one to several clients to aggregate them
+        :param tracer: optional - touchworks.api.tracing.Tracer notified of the start and
+            end of every stage of a call
+        :param recorder: optional - touchworks.api.cassette.CassetteRecorder every HTTP
+            exchange is recorded to
+        :param request_log: optional - touchworks.api.requestlog.RequestLog every HTTP
+            exchange is logged to
         :return:
         """
         if not base_url:
@@ -134,26 +249,191 @@ class TouchWorks(object):
         self._token_timeout = token_timeout
         self._ehr_username = app_username
         self._cache_token = cache_token
-        self._token = self.get_token(self._app_name, self._username, self._password)
+        self._token_refresh_margin = token_refresh_margin
+        self._lazy = lazy
+        self._pid = os.getpid()
+        self._pid_lock = threading.Lock()
+        self._dictionary_cache = self._create_dictionary_cache(dictionary_cache_ttl,
+                                                               dictionary_store)
+        self._response_cache = response_cache
+        self._single_flight = self._create_single_flight() if single_flight else None
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._circuit_breakers = {}
+        self._scheduler = scheduler
+        self._codec = json_codec or default_codec()
+        self._metrics = metrics if metrics is not None else MetricsRegistry()
+        self._tracer = tracer or NULL_TRACER
+        # notified of every HTTP exchange, see _record
+        self._exchange_observers = tuple(o for o in (recorder, request_log) if o is not None)
+        self._rate_limiter = rate_limiter
+        if rate_limiter is None and (rate_limit or max_in_flight):
+            self._rate_limiter = RateLimiter.shared(base_url, app_name,
+                                                    rate=rate_limit,
+                                                    max_in_flight=max_in_flight,
+                                                    adaptive=adaptive_concurrency,
+                                                    latency_target=latency_target)
+        if circuit_breaker_threshold:
+            for endpoint in (TouchWorksEndPoints.GET_TOKEN, TouchWorksEndPoints.MAGIC_JSON):
+                self._circuit_breakers[endpoint] = CircuitBreaker(
+                    failure_threshold=circuit_breaker_threshold,
+                    reset_timeout=circuit_breaker_reset_timeout)
+        self._owns_transport = transport is None
+        if transport is None:
+            transport = self._create_transport(pool_size, connect_timeout, read_timeout)
+        self._transport = transport
+        self._connect()
+
+    @property
+    def metrics(self):
+        """
+        :return: touchworks.api.metrics.MetricsRegistry of this client
+        """
+        return self._metrics
+
+    def _create_transport(self, pool_size, connect_timeout, read_timeout):
+        return HttpTransport(pool_size=pool_size,
+                             connect_timeout=connect_timeout,
+                             read_timeout=read_timeout)
+
+    def _create_single_flight(self):
+        return SingleFlight()
+
+    def _create_dictionary_cache(self, ttl, store):
+        return DictionaryCache(self._fetch_dictionary, ttl=ttl, store=store,
+                               scope=self._base_url)
+
+    def _connect(self):
+        self._token_manager = self._create_token_manager()
+        if not self._lazy:
+            self._token_manager.get()
+
+    def _create_token_manager(self):
+        return TokenManager(self._fetch_token, self._token_timeout,
+                            cache_token=self._cache_token,
+                            refresh_margin=self._token_refresh_margin)
+
+    def _check_pid(self):
+        """
+        the token manager timer and the pooled sockets belong to the process that
+        created them. a forked child starts over with its own token, the transport
+        re-creates its pool on its own
+        """
+        if self._pid == os.getpid():
+            return
+        with self._pid_lock:
+            # another thread of the child may have reset it already
+            if self._pid != os.getpid():
+                logger.debug('process was forked, resetting security token')
+                self._token_manager = self._create_token_manager()
+                self._pid = os.getpid()
+
+    def warm(self):
+        """
+        acquires the security token on a background thread so that the first
+        call does not have to wait for it
+        :return: the started thread
+        """
+        self._check_pid()
+        thread = threading.Thread(target=self._warm, name='touchworks-warm')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _warm(self):
+        try:
+            self._token_manager.get()
+        except Exception as ex:
+            # the next call acquires the token itself and raises if it still fails
+            logger.exception(ex)
+
+    def _fetch_token(self):
+        return self.get_token(self._app_name, self._username, self._password)
+
+    def close(self):
+        """
+        releases the pooled connections held by this client
+        """
+        self._token_manager.close()
+        if self._owns_transport:
+            self._transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def priority(self, priority, timeout=None):
+        """
+        context manager tagging the calls made inside it, in this thread or asyncio
+        task, for the scheduler. calls are Priority.INTERACTIVE by default
+
+            with tw.priority(Priority.BULK, timeout=600):
+                tw.get_documents(...)
+
+        :param priority: Priority.INTERACTIVE or Priority.BULK
+        :param timeout: optional - seconds after which calls still waiting for the
+            scheduler raise TouchWorksDeadlineExceededException. earlier deadlines
+            are served first within a priority
+        """
+        return call_priority(priority, timeout=timeout)
+
+    def batch(self, calls, max_workers=BatchExecutor.DEFAULT_MAX_WORKERS, ordered=False,
+              priority=Priority.BULK):
+        """
+        runs many actions concurrently on a thread pool sharing this client's
+        token and connection pool. a failing call does not stop the batch, its
+        exception is captured in the BatchResult
+
+            calls = [('get_patient', {'ehr_username': user, 'patient_id': pid})
+                     for pid in patient_ids]
+            for r in tw.batch(calls, max_workers=16):
+                if r.ok: ...
+
+        :param calls: iterable of (action name, kwargs)
+        :param max_workers: optional - number of worker threads
+        :param ordered: optional - yield results in input order instead of completion order
+        :param priority: optional - scheduler priority of the calls
+        :return: generator of touchworks.api.batch.BatchResult
+        """
+        with BatchExecutor(self, max_workers=max_workers, priority=priority) as executor:
+            for result in executor.run(calls, ordered=ordered):
+                yield result
 
     def get_token(self, appname, username, password):
         """
             get the security token by connecting to TouchWorks API
         """
-        ext_exception = TouchWorksException(
-            TouchWorksErrorMessages.GET_TOKEN_FAILED_ERROR)
         data = {'Username': username,
                 'Password': password}
-        resp = self._http_request(TouchWorksEndPoints.GET_TOKEN, data)
+        started = time.time()
+        try:
+            with self._tracer.span('touchworks.call', action='GetToken'):
+                token = self._token_from_response(
+                    self._http_request(TouchWorksEndPoints.GET_TOKEN, data))
+        except Exception as ex:
+            self._metrics.observe('GetToken', time.time() - started, error=ex)
+            raise
+        self._metrics.observe('GetToken', time.time() - started)
+        self._metrics.token_refreshed()
+        return token
+
+    def _token_from_response(self, resp):
+        """
+        validates the body of a GetToken response
+        :return: SecurityToken
+        """
+        ext_exception = TouchWorksException(
+            TouchWorksErrorMessages.GET_TOKEN_FAILED_ERROR)
         try:
-            logger.debug('token : %s' % resp)
+            logger.debug('GetToken returned %s', resp.status_code)
             if not resp.text:
                 raise ext_exception
             try:
                 uuid.UUID(resp.text, version=4)
                 return SecurityToken(resp.text)
             except ValueError:
-                logger.error('response was not valid uuid string. %s' % resp.text)
+                logger.error('response was not valid uuid string. %s', resp.text)
                 raise ext_exception
 
         except Exception as ex:
@@ -167,33 +447,160 @@ class TouchWorks(object):
         :return: True if token has not expired yet and False is token is empty or
                 it has expired
         """
-        if not self._cache_token:
-            return False
-        now = time.time()
-        if now - self._token.acquired_time > self._token_timeout:
-            logger.debug('token needs to be reset')
-            return False
-        return True
+        return self._token_manager.is_valid()
 
-    def _http_request(self, api, data, headers=None):
+    def _http_request(self, api, data, headers=None, stream=False):
         """
         internal method for handling request and response
         and raising an exception is http return status code is not success
 
-        :rtype : response object from requests.post()
+        :param stream: optional - return as soon as the headers are read and leave
+            the body to be consumed from the response
+
+        :rtype : response object from HttpTransport.post()
         """
         if not headers:
             headers = {'Content-Type': 'application/json'}
-        if not self._token_valid:
-            self._token = self.get_token(self._app_name, self._username, self._password)
-        response = requests.post(self._base_url + '/' + api, data=json.dumps(data),
-                                 headers=headers)
-        # raise an exception if the status was not 200
-        logger.debug(json.dumps(data))
-        logger.debug(response.text)
-        response.raise_for_status()
+        self._check_pid()
+        with self._tracer.span('touchworks.serialize') as span:
+            body = self._codec.dumps(data)
+            span.set_attribute('request_bytes', len(body))
+        attempt = 0
+        while True:
+            breaker = self._check_circuit(api)
+            # a half-open trial that ends in neither outcome, say a missed
+            # deadline, must not keep the circuit from letting the next one through
+            settled = False
+            try:
+                response = None
+                started = time.time()
+                try:
+                    response = self._send(api, body, headers, stream=stream)
+                    self._metrics.observe_sizes(self._action_name(api, data), len(body),
+                                                None if stream else len(response.content))
+                    # raise an exception if the status was not 200
+                    response.raise_for_status()
+                except requests.RequestException as ex:
+                    if self._exchange_observers:
+                        self._record(api, data, attempt, started, body, response, stream, ex)
+                    if stream and response is not None:
+                        # hands the connection and the slots it holds back
+                        response.close()
+                    delay = self._retry_delay(api, data, attempt, ex, breaker)
+                    settled = True
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    with self._tracer.span('touchworks.backoff', attempt=attempt, delay=delay):
+                        time.sleep(delay)
+                    continue
+                if self._exchange_observers:
+                    self._record(api, data, attempt, started, body, response, stream)
+                if breaker is not None:
+                    breaker.record_success()
+                settled = True
+                return response
+            finally:
+                if breaker is not None and not settled:
+                    breaker.release_trial()
+
+    def _send(self, api, body, headers, stream=False):
+        scheduler = self._scheduler
+        if scheduler is None:
+            return self._send_rate_limited(api, body, headers, stream)
+        priority, deadline = current_priority()
+        with self._tracer.span('touchworks.scheduler', priority=priority):
+            admitted = scheduler.acquire(priority, deadline)
+        if not admitted:
+            raise TouchWorksDeadlineExceededException(
+                '%s %s' % (TouchWorksErrorMessages.DEADLINE_EXCEEDED, api))
+        try:
+            response = self._send_rate_limited(api, body, headers, stream)
+        except BaseException:
+            scheduler.release(priority)
+            raise
+        if stream:
+            # the body is yet to be downloaded, keep the slot until it is closed
+            return release_on_close(response, lambda: scheduler.release(priority))
+        scheduler.release(priority)
         return response
 
+    def _send_rate_limited(self, api, body, headers, stream):
+        limiter = self._rate_limiter
+        if limiter is None:
+            return self._post(api, body, headers, stream)
+        with self._tracer.span('touchworks.rate_limit'):
+            limiter.acquire()
+        started = time.time()
+        try:
+            response = self._post(api, body, headers, stream)
+        except BaseException:
+            limiter.release(time.time() - started, congested=True)
+            raise
+        congested = response.status_code in self._retry_policy.retry_statuses
+        if stream:
+            return release_on_close(
+                response, lambda: limiter.release(time.time() - started, congested=congested))
+        limiter.release(time.time() - started, congested=congested)
+        return response
+
+    def _post(self, api, body, headers, stream):
+        with self._tracer.span('touchworks.http', endpoint=api) as span:
+            response = self._transport.post(self._base_url + '/' + api, data=body,
+                                            headers=headers, stream=stream)
+            span.set_attribute('status_code', response.status_code)
+            return response
+
+    def _check_circuit(self, api):
+        """
+        :return: the circuit breaker of api, if any
+        :raises TouchWorksCircuitOpenException: while the circuit is open
+        """
+        breaker = self._circuit_breakers.get(api)
+        if breaker is not None and not breaker.allow():
+            raise TouchWorksCircuitOpenException(
+                '%s %s, retry in %.1f secs' % (TouchWorksErrorMessages.CIRCUIT_OPEN,
+                                               api, breaker.retry_in()))
+        return breaker
+
+    def _record(self, api, data, attempt, started, body, response, stream, error=None):
+        if response is None:
+            response = getattr(error, 'response', None)
+        status = getattr(response, 'status_code', None)
+        response_bytes = None
+        if response is not None and not stream:
+            response_bytes = len(response.content)
+        duration = time.time() - started
+        for observer in self._exchange_observers:
+            observer.record(api, data, attempt, started, duration, len(body),
+                            response_bytes=response_bytes, status=status, error=error)
+
+    @staticmethod
+    def _action_name(api, data):
+        if api == TouchWorksEndPoints.MAGIC_JSON:
+            return data.get('Action') or api
+        return api.rsplit('/', 1)[-1]
+
+    def _retry_delay(self, api, data, attempt, exception, breaker):
+        """
+        records a failed request with the circuit breaker
+        :return: seconds to wait before sending the request again or None to give up
+        """
+        policy = self._retry_policy
+        server_failure = policy.is_server_failure(exception)
+        if breaker is not None:
+            if server_failure:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        action = data.get('Action') if api == TouchWorksEndPoints.MAGIC_JSON else None
+        if not server_failure or attempt >= policy.max_retries_for(action):
+            return None
+        delay = policy.delay(attempt, exception)
+        logger.debug('%s failed (%s), retry %s in %.2f secs',
+                     action or api, exception, attempt + 1, delay)
+        return delay
+
     def save_note(self, note_text, patient_id,
                   document_type,
                   document_status='Unsigned', wrapped_in_rtf='N'):
@@ -211,12 +618,7 @@ class TouchWorks(object):
                                  parameter2=document_type,
                                  parameter3=document_status,
                                  parameter4=wrapped_in_rtf)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_SAVE_NOTE)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_SAVE_NOTE)
 
     def search_patients(self, search_criteria,
                         include_picture='N', organization_id=None):
@@ -228,16 +630,10 @@ class TouchWorks(object):
         organization_id = organization_id or ''
         magic = self._magic_json(action=TouchWorksMagicConstants.ACTION_SEARCH_PATIENTS,
                                  app_name=self._app_name,
-                                 token=self._token.token,
                                  parameter1=search_criteria,
                                  parameter2=include_picture,
                                  parameter3=organization_id)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_SEARCH_PATIENTS)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_SEARCH_PATIENTS)
 
     def get_document_type(self, ehr_username, doc_type):
         """
@@ -248,15 +644,9 @@ class TouchWorks(object):
             action=TouchWorksMagicConstants.ACTION_GET_DOCUMENT_TYPE,
             app_name=self._app_name,
             user_id=ehr_username,
-            token=self._token.token,
             parameter1=doc_type
         )
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_DOCUMENT_TYPE)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_DOCUMENT_TYPE)
 
     def get_patient(self, ehr_username, patient_id):
         """
@@ -267,15 +657,9 @@ class TouchWorks(object):
             action=TouchWorksMagicConstants.ACTION_GET_PATIENT_INFO,
             app_name=self._app_name,
             user_id=ehr_username,
-            token=self._token.token,
             patient_id=patient_id
         )
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_PATIENT_INFO)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_PATIENT_INFO)
 
     def get_encounter(self, ehr_username, patient_id):
         """
@@ -286,28 +670,49 @@ class TouchWorks(object):
             action=TouchWorksMagicConstants.ACTION_GET_ENCOUNTER,
             app_name=self._app_name,
             user_id=ehr_username,
-            token=self._token.token,
             patient_id=patient_id
         )
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_ENCOUNTER)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_ENCOUNTER)
 
     def get_dictionary(self, dictionary_name):
+        """
+        invokes TouchWorksMagicConstants.ACTION_GET_DICTIONARY action. results are
+        cached for dictionary_cache_ttl seconds, see invalidate_dictionary
+        :return: JSON response
+        """
+        return copy_entries(self.get_dictionary_index(dictionary_name).entries)
+
+    def get_dictionary_index(self, dictionary_name):
+        """
+        :return: touchworks.api.dictionary.DictionaryIndex for dictionary_name with
+            lookups by EntryName, EntryCode, EntryMnemonic and Active flag
+        """
+        index = self._dictionary_cache.lookup(dictionary_name)
+        self._metrics.cache_access('dictionary', index is not None)
+        if index is not None:
+            return index
+        return self._dictionary_cache.get(dictionary_name)
+
+    def invalidate_cache(self, actions=None, patient_id=None):
+        """
+        drops cached results of the given actions and/or patient from the response
+        cache, everything when neither is given
+        """
+        if self._response_cache is not None:
+            self._response_cache.invalidate(actions=actions, patient_id=patient_id)
+
+    def invalidate_dictionary(self, dictionary_name=None):
+        """
+        drops dictionary_name, or every dictionary if not given, from the cache
+        """
+        self._dictionary_cache.invalidate(dictionary_name)
+
+    def _fetch_dictionary(self, dictionary_name):
         magic = self._magic_json(
             action=TouchWorksMagicConstants.ACTION_GET_DICTIONARY,
             parameter1=dictionary_name,
-            app_name=self._app_name,
-            token=self._token.token)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_DICTIONARY)
-        return result
+            app_name=self._app_name)
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_DICTIONARY)
 
     def find_document_type_by_name(self, entity_name, active='Y',
                                    match_case=True):
@@ -316,17 +721,8 @@ class TouchWorks(object):
         :param entity_name: entity name
         :return:
         """
-        all_types = self.get_dictionary('Document_Type_DE')
-        if match_case:
-            filtered = filter(
-                lambda x: x['Active'] == active and x['EntryName'].find(entity_name) >= 0,
-                all_types)
-        else:
-            token = entity_name.lower()
-            filtered = filter(
-                lambda x: x['Active'] == active and x['EntryName'].lower().find(token) >= 0,
-                all_types)
-        return filtered
+        index = self.get_dictionary_index('Document_Type_DE')
+        return copy_entries(index.search(entity_name, active=active, match_case=match_case))
 
     def get_encounter_list_for_patient(self, patient_id):
         """
@@ -336,14 +732,9 @@ class TouchWorks(object):
         magic = self._magic_json(
             action=TouchWorksMagicConstants.ACTION_GET_ENCOUNTER_LIST_FOR_PATIENT,
             app_name=self._app_name,
-            token=self._token.token,
             patient_id=patient_id)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_ENCOUNTER_LIST_FOR_PATIENT)
-        return result
+        return self._invoke_magic(
+            magic, TouchWorksMagicConstants.RESULT_GET_ENCOUNTER_LIST_FOR_PATIENT)
 
     def save_unstructured_document(self, ehr_username,
                                    patient_id,
@@ -361,19 +752,13 @@ class TouchWorks(object):
                   "<item name='accessionValue' value=''/>" + \
                   "<item name='appGroup' value='TouchWorks'/></docParams>"
         doc_xml = doc_xml.replace("@@ENCOUNTERID@@", str(encounter_id))
-        print(doc_xml)
         magic = self._magic_json(
             action=TouchWorksMagicConstants.ACTION_SAVE_UNSTRUCTURED_DATA,
             patient_id=patient_id,
             user_id=ehr_username,
             parameter1=doc_xml,
             parameter2=document_content)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_SAVE_UNSTRUCTURED_DATA)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_SAVE_UNSTRUCTURED_DATA)
 
     def set_patient_location_and_status(self, patient_id,
                                         encounter_status,
@@ -391,17 +776,14 @@ class TouchWorks(object):
             patient_id=patient_id,
             parameter1=encounter_status,
             parameter2=patient_location)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_SET_PATIENT_LOCATION_AND_STATUS)
-        return result
+        return self._invoke_magic(
+            magic, TouchWorksMagicConstants.RESULT_SET_PATIENT_LOCATION_AND_STATUS)
 
     def get_clinical_summary(self, patient_id,
                              section,
                              encounter_id_identifer,
-                             verbose=''):
+                             verbose='',
+                             stream=False):
         """
         invokes TouchWorksMagicConstants.ACTION_GET_CLINICAL_SUMMARY action
         :param patient_id:
@@ -424,6 +806,8 @@ class TouchWorks(object):
         :param encounter_id_identifer - identifier for the encounter. Used in conjunction with
             the "ChiefComplaint" when called in Parameter1. EncounterID can be acquired
             with the Unity call GetEncounterList.
+        :param stream: optional - if True return a generator yielding rows while the
+            response is downloaded
         :return: JSON response
         """
         magic = self._magic_json(
@@ -432,28 +816,22 @@ class TouchWorks(object):
             parameter1=section,
             parameter2=encounter_id_identifer,
             parameter3=verbose)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_CLINICAL_SUMMARY)
-        return result
+        if stream:
+            return self._stream_magic(magic,
+                                      TouchWorksMagicConstants.RESULT_GET_CLINICAL_SUMMARY)
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_CLINICAL_SUMMARY)
 
     def get_patient_activity(self, patient_id, since=''):
         """
-        invokes TouchWorksMagicConstants.ACTION_GET_ENCOUNTER_LIST_FOR_PATIENT action
+        invokes TouchWorksMagicConstants.ACTION_GET_PATIENT_ACTIVITY action
+        :param since: optional - only activity after this date and time
         :return: JSON response
         """
         magic = self._magic_json(
             action=TouchWorksMagicConstants.ACTION_GET_PATIENT_ACTIVITY,
             patient_id=patient_id,
             parameter1=since)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_PATIENT_ACTIVITY)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_PATIENT_ACTIVITY)
 
     def set_patient_medhx_flag(self, patient_id,
                                medhx_status):
@@ -472,12 +850,7 @@ class TouchWorks(object):
             patient_id=patient_id,
             parameter1=medhx_status
         )
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_SET_PATIENT_MEDHX_FLAG)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_SET_PATIENT_MEDHX_FLAG)
 
     def get_changes_patients(self, patient_id,
                              since,
@@ -485,9 +858,12 @@ class TouchWorks(object):
                              verbose='Y',
                              quick_scan='Y',
                              which_field='',
-                             what_value=''):
+                             what_value='',
+                             stream=False):
         """
         invokes TouchWorksMagicConstants.ACTION_GET_ENCOUNTER_LIST_FOR_PATIENT action
+        :param stream: optional - if True return a generator yielding rows while the
+            response is downloaded
         :return: JSON response
         """
         magic = self._magic_json(
@@ -500,12 +876,9 @@ class TouchWorks(object):
             parameter5=which_field,
             parameter6=what_value
         )
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_CHANGED_PATIENTS)
-        return result
+        if stream:
+            return self._stream_magic(magic, TouchWorksMagicConstants.RESULT_GET_CHANGED_PATIENTS)
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_CHANGED_PATIENTS)
 
     def get_patients_locations(self, patient_id):
         """
@@ -517,12 +890,7 @@ class TouchWorks(object):
         magic = self._magic_json(
             action=TouchWorksMagicConstants.ACTION_GET_PATIENT_LOCATIONS,
             parameter1=doc_xml)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_PATIENT_LOCATIONS)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_PATIENT_LOCATIONS)
 
     def get_patient_pharmacies(self, patient_id,
                                patients_favorite_only='N'):
@@ -534,12 +902,7 @@ class TouchWorks(object):
             action=TouchWorksMagicConstants.ACTION_GET_PATIENT_PHARAMCIES,
             patient_id=patient_id,
             parameter1=patients_favorite_only)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_PATIENT_PHARAMCIES)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_PATIENT_PHARAMCIES)
 
     def get_user_id(self):
         """
@@ -549,12 +912,7 @@ class TouchWorks(object):
         magic = self._magic_json(
             action=TouchWorksMagicConstants.ACTION_GET_USER_ID)
 
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_USER_ID)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_USER_ID)
 
     def get_provider(self, provider_id, provider_username=''):
         """
@@ -565,12 +923,7 @@ class TouchWorks(object):
             action=TouchWorksMagicConstants.ACTION_GET_PROVIDER,
             parameter1=provider_id,
             parameter2=provider_username)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_PROVIDER)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_PROVIDER)
 
     def get_provider_info(self, sought_user):
         """
@@ -580,15 +933,9 @@ class TouchWorks(object):
         magic = self._magic_json(
             action=TouchWorksMagicConstants.ACTION_GET_PROVIDER_INFO,
             app_name=self._app_name,
-            token=self._token.token,
             parameter1=sought_user)
 
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_PROVIDER_INFO)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_PROVIDER_INFO)
 
     def get_providers(self, security_filter,
                       name_filter='%',
@@ -617,12 +964,7 @@ class TouchWorks(object):
             parameter5=ordering_authority,
             parameter6=real_provider)
 
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_PROVIDERS)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_PROVIDERS)
 
     def get_task_list(self, since='', task_types='', task_status=''):
         """
@@ -640,12 +982,7 @@ class TouchWorks(object):
             parameter1=since,
             parameter2=task_types,
             parameter3=task_status)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_ENCOUNTER_LIST_FOR_PATIENT)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_TASK_LIST)
 
     def save_message_from_pat_portal(self, patient_id,
                                      p_vendor_name,
@@ -699,12 +1036,7 @@ class TouchWorks(object):
             parameter4=sent_date,
             parameter5=transaction_type)
 
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_SAVE_MSG_FROM_PAT_PORTAL)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_SAVE_MSG_FROM_PAT_PORTAL)
 
     def save_task_comment(self, task_id, task_comment):
         """
@@ -716,12 +1048,7 @@ class TouchWorks(object):
             parameter1=task_id,
             parameter6=task_comment)
 
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_SAVE_TASK_COMMENT)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_SAVE_TASK_COMMENT)
 
     def get_task(self, patient_id, task_id):
         """
@@ -732,12 +1059,7 @@ class TouchWorks(object):
             action=TouchWorksMagicConstants.ACTION_GET_TASK,
             patient_id=patient_id,
             parameter1=task_id)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_TASK)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_TASK)
 
     def save_task_status(self, task_id,
                          task_action,
@@ -754,12 +1076,7 @@ class TouchWorks(object):
             parameter2=task_action,
             parameter3=delegate_id,
             parameter4=comment)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_SAVE_TASK_STATUS)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_SAVE_TASK_STATUS)
 
     def search_task_views(self, user, search_string):
         """
@@ -771,12 +1088,7 @@ class TouchWorks(object):
             parameter1=user,
             parameter2=search_string)
 
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_SEARCH_TASK_VIEWS)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_SEARCH_TASK_VIEWS)
 
     def save_task(self, patient_id,
                   task_type,
@@ -809,12 +1121,7 @@ class TouchWorks(object):
             parameter3=work_object_id,
             parameter4=comments,
             parameter5=subject)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_ENCOUNTER_LIST_FOR_PATIENT)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_SAVE_TASK)
 
     def get_task_comments(self, patient_id, task_id):
         """
@@ -825,12 +1132,7 @@ class TouchWorks(object):
             action=TouchWorksMagicConstants.ACTION_GET_TASK_COMMENTS,
             patient_id=patient_id,
             parameter1=task_id)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_TASK_COMMENTS)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_TASK_COMMENTS)
 
     def get_delegates(self, patient_id):
         """
@@ -840,14 +1142,8 @@ class TouchWorks(object):
         magic = self._magic_json(
             action=TouchWorksMagicConstants.ACTION_GET_DELEGATES,
             app_name=self._app_name,
-            token=self._token.token,
             patient_id=patient_id)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_DELEGATES)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_DELEGATES)
 
     def get_task_list_by_view(self, patient_id, task_view_id, org_id=''):
         """
@@ -859,19 +1155,16 @@ class TouchWorks(object):
             patient_id=patient_id,
             parameter1=task_view_id,
             parameter2=org_id)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_TASKLISTBY_VIEW)
-        return result
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_TASKLISTBY_VIEW)
 
     def get_schedule(self, ehr_username, start_date,
                      changed_since, include_pix, other_user='All',
                      end_date='',
-                     appointment_types=None, status_filter='All'):
+                     appointment_types=None, status_filter='All', stream=False):
         """
         invokes TouchWorksMagicConstants.ACTION_GET_SCHEDULE action
+        :param stream: optional - if True return a generator yielding rows while the
+            response is downloaded
         :return: JSON response
         """
         if not start_date:
@@ -882,25 +1175,24 @@ class TouchWorks(object):
             changed_since = ''
         magic = self._magic_json(action=TouchWorksMagicConstants.ACTION_GET_SCHEDULE,
                                  app_name=self._app_name,
-                                 user_id=ehr_username, token=self._token.token,
+                                 user_id=ehr_username,
                                  parameter1=start_date,
                                  parameter2=changed_since,
                                  parameter3=include_pix,
                                  parameter4=other_user,
                                  parameter5=appointment_types,
                                  parameter6=status_filter)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_SCHEDULE)
-        return result
+        if stream:
+            return self._stream_magic(magic, TouchWorksMagicConstants.RESULT_GET_SCHEDULE)
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_SCHEDULE)
 
     def get_documents(self, ehr_username, patient_id, start_date=None,
                       end_date=None, document_id=None, doc_type=None,
-                      newest_document='N'):
+                      newest_document='N', stream=False):
         """
         invokes TouchWorksMagicConstants.ACTION_GET_DOCUMENTS action
+        :param stream: optional - if True return a generator yielding rows while the
+            response is downloaded
         :return: JSON response
         """
 
@@ -911,7 +1203,7 @@ class TouchWorks(object):
         if not doc_type:
             doc_type = ''
         magic = self._magic_json(action=TouchWorksMagicConstants.ACTION_GET_DOCUMENTS,
-                                 user_id=ehr_username, token=self._token.token,
+                                 user_id=ehr_username,
                                  patient_id=patient_id,
                                  app_name=self._app_name,
                                  parameter1=start_date,
@@ -919,23 +1211,93 @@ class TouchWorks(object):
                                  parameter3=document_id,
                                  parameter4=doc_type,
                                  parameter5=newest_document)
-        response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
-        result = self._get_results_or_raise_if_magic_invalid(
-            magic,
-            response,
-            TouchWorksMagicConstants.RESULT_GET_DOCUMENTS)
-        return result
+        if stream:
+            return self._stream_magic(magic, TouchWorksMagicConstants.RESULT_GET_DOCUMENTS)
+        return self._invoke_magic(magic, TouchWorksMagicConstants.RESULT_GET_DOCUMENTS)
+
+    def get_schedule_range(self, ehr_username, start_date, end_date,
+                           changed_since='', include_pix='N', other_user='All',
+                           appointment_types=None, status_filter='All',
+                           window_days=sharding.DAY,
+                           max_workers=BatchExecutor.DEFAULT_MAX_WORKERS,
+                           window_retries=2):
+        """
+        get_schedule for a long date range. the range is split into windows of
+        window_days days that are fetched concurrently, appointments returned by
+        more than one window are kept once
+        :param start_date: first day, datetime.date or 'MM/DD/YYYY'
+        :param end_date: last day, included
+        :param window_days: optional - days per window, sharding.DAY or sharding.WEEK
+        :param max_workers: optional - windows fetched at once
+        :param window_retries: optional - times the windows that failed are fetched again
+        :return: JSON response
+        """
+        calls = [('get_schedule', {'ehr_username': ehr_username,
+                                   'start_date': first, 'end_date': last,
+                                   'changed_since': changed_since,
+                                   'include_pix': include_pix,
+                                   'other_user': other_user,
+                                   'appointment_types': appointment_types,
+                                   'status_filter': status_filter})
+                 for first, last in sharding.split_date_range(start_date, end_date,
+                                                              window_days)]
+        return self._fetch_sharded(calls, sharding.SCHEDULE_ID_FIELDS,
+                                   max_workers, window_retries)
+
+    def get_documents_range(self, ehr_username, patient_id, start_date, end_date,
+                            document_id=None, doc_type=None,
+                            window_days=sharding.WEEK,
+                            max_workers=BatchExecutor.DEFAULT_MAX_WORKERS,
+                            window_retries=2):
+        """
+        get_documents for a long date range, split into windows like
+        get_schedule_range. documents are de-duplicated by DocumentID
+        :return: JSON response
+        """
+        calls = [('get_documents', {'ehr_username': ehr_username,
+                                    'patient_id': patient_id,
+                                    'start_date': first, 'end_date': last,
+                                    'document_id': document_id,
+                                    'doc_type': doc_type})
+                 for first, last in sharding.split_date_range(start_date, end_date,
+                                                              window_days)]
+        return self._fetch_sharded(calls, sharding.DOCUMENT_ID_FIELDS,
+                                   max_workers, window_retries)
+
+    def _fetch_sharded(self, calls, id_fields, max_workers, window_retries):
+        """
+        runs every window, then only the windows that failed, up to window_retries
+        more times
+        :return: merged rows of every window
+        """
+        results = [None] * len(calls)
+        pending = list(range(len(calls)))
+        priority = current_priority()[0]
+        for attempt in range(window_retries + 1):
+            failed = []
+            batch = self.batch([calls[i] for i in pending], max_workers=max_workers,
+                               priority=priority)
+            for result in batch:
+                index = pending[result.index]
+                if result.ok:
+                    results[index] = result.result
+                else:
+                    failed.append((index, result.exception))
+            if not failed:
+                return sharding.merge_rows(results, id_fields)
+            logger.debug('%s of %s windows failed', len(failed), len(calls))
+            pending = sorted(index for index, _ in failed)
+        raise failed[0][1]
 
     def _magic_json(self, action='', user_id='', app_name='', patient_id='',
                     token='', parameter1='', parameter2='',
                     parameter3='', parameter4='', parameter5='',
                     parameter6='', data=''):
         """
-        utility method to create a magic json object needed to invoke TouchWorks APIs
+        utility method to create a magic json object needed to invoke TouchWorks APIs.
+        without token, the current one is filled in when the envelope is sent
         :return: magic json
         """
-        if not token:
-            token = self._token.token
         if not app_name:
             app_name = self._app_name
         if not user_id:
@@ -957,13 +1319,146 @@ class TouchWorks(object):
             'Data': data
         }
 
+    def _invoke_magic(self, magic, result_key):
+        """
+        posts a magic json envelope to TouchWorksEndPoints.MAGIC_JSON and
+        returns the value stored under result_key in the response
+        """
+        with self._tracer.span('touchworks.call',
+                               **self._tracer.envelope_attributes(magic)) as span:
+            cache = self._response_cache
+            if cache is None:
+                return self._call_magic(magic, result_key)
+            if cache.is_cacheable(magic['Action']):
+                hit, result = cache.get(magic)
+                self._metrics.cache_access('response', hit)
+                span.set_attribute('cache_hit', hit)
+                if not hit:
+                    result = self._call_magic(magic, result_key)
+                    cache.put(magic, result)
+                return result
+            result = self._call_magic(magic, result_key)
+            cache.on_write(magic)
+            return result
+
+    def _fill_token(self, magic):
+        if not magic['Token']:
+            with self._tracer.span('touchworks.token'):
+                magic['Token'] = self._current_token()
+
+    def _call_magic(self, magic, result_key):
+        if self._single_flight is not None:
+            return self._single_flight.do(
+                magic, lambda: self._call_magic_with_token(magic, result_key))
+        return self._call_magic_with_token(magic, result_key)
+
+    def _call_magic_with_token(self, magic, result_key):
+        # resolved only now, a call answered by the cache never waits for GetToken
+        self._fill_token(magic)
+        try:
+            return self._post_magic(magic, result_key)
+        except TouchWorksTokenException:
+            # the token expired on the server, replay the call once with a new one
+            logger.debug('token rejected for %s, acquiring a new one', magic['Action'])
+            with self._tracer.span('touchworks.token', refresh=True):
+                magic['Token'] = self._token_manager.refresh(
+                    stale_token=magic['Token']).token
+            return self._post_magic(magic, result_key)
+
+    def _post_magic(self, magic, result_key):
+        started = time.time()
+        try:
+            try:
+                response = self._http_request(TouchWorksEndPoints.MAGIC_JSON, data=magic)
+            except requests.HTTPError as ex:
+                if ex.response is not None and ex.response.status_code == 401:
+                    raise TouchWorksTokenException(str(ex))
+                raise
+            with self._tracer.span('touchworks.parse'):
+                result = self._get_results_or_raise_if_magic_invalid(magic, response,
+                                                                     result_key)
+        except Exception as ex:
+            self._metrics.observe(magic['Action'], time.time() - started, error=ex)
+            raise
+        self._metrics.observe(magic['Action'], time.time() - started)
+        return result
+
+    def _stream_magic(self, magic, result_key):
+        """
+        posts a magic json envelope and yields the rows stored under result_key
+        while the response is still being downloaded. streamed calls are never
+        cached or coalesced
+        :return: generator of rows
+        """
+        started = time.time()
+        try:
+            for row in self._stream_rows(magic, result_key):
+                yield row
+        except Exception as ex:
+            self._metrics.observe(magic['Action'], time.time() - started, error=ex)
+            raise
+        self._metrics.observe(magic['Action'], time.time() - started)
+
+    def _stream_rows(self, magic, result_key):
+        for attempt in range(2):
+            try:
+                with self._tracer.span('touchworks.call', stream=True,
+                                       **self._tracer.envelope_attributes(magic)):
+                    self._fill_token(magic)
+                    response = self._http_request(TouchWorksEndPoints.MAGIC_JSON,
+                                                  data=magic, stream=True)
+            except requests.HTTPError as ex:
+                if attempt == 0 and ex.response is not None and ex.response.status_code == 401:
+                    magic['Token'] = self._token_manager.refresh(
+                        stale_token=magic['Token']).token
+                    continue
+                raise
+            try:
+                chunks = response.iter_content(chunk_size=self.STREAM_CHUNK_SIZE)
+                for row in iter_result_rows(chunks, result_key):
+                    yield row
+                return
+            except MagicJsonError as ex:
+                error = str(ex)
+                if attempt == 0 and self._is_token_error(error):
+                    # no row was yielded yet, safe to replay with a new token
+                    logger.debug('token rejected for %s, acquiring a new one',
+                                 magic['Action'])
+                    magic['Token'] = self._token_manager.refresh(
+                        stale_token=magic['Token']).token
+                    continue
+                if error:
+                    raise TouchWorksException(magic['Action'] + ' API failed' + ' : ' + error)
+                raise TouchWorksException(TouchWorksErrorMessages.MAGIC_JSON_FAILED)
+            except ValueError as ex:
+                logger.exception(ex)
+                raise TouchWorksException(TouchWorksErrorMessages.MAGIC_JSON_FAILED)
+            finally:
+                response.close()
+
+    def _current_token(self):
+        """
+        :return: the security token string used for magic json envelopes
+        """
+        self._check_pid()
+        return self._token_manager.get().token
+
+    @staticmethod
+    def _is_token_error(error):
+        # only these are replayed with a new token, an unrelated error that
+        # happens to mention a token must not send a write a second time
+        error = str(error).lower()
+        return any(message in error for message in TouchWorksErrorMessages.INVALID_TOKEN_ERRORS)
+
     def _get_results_or_raise_if_magic_invalid(self, magic, response, result_key):
         try:
-            j_response = response.json()
+            j_response = self._codec.loads(response.content)
             if j_response:
                 if result_key in j_response[0]:
                     return j_response[0][result_key]
                 elif 'Error' in j_response[0]:
+                    if self._is_token_error(j_response[0]['Error']):
+                        raise TouchWorksTokenException(j_response[0]['Error'])
                     if magic and 'Action' in magic:
                         raise TouchWorksException(
                             magic['Action'] + ' API failed' + ' : ' +
@@ -973,6 +1468,8 @@ class TouchWorks(object):
                             TouchWorksErrorMessages.MAGIC_JSON_FAILED + ' : ' +
                             j_response[0]['Error'])
             raise TouchWorksException(TouchWorksErrorMessages.MAGIC_JSON_FAILED)
+        except TouchWorksException:
+            raise
         except Exception as ex:
             logger.exception(ex)
             raise TouchWorksException(TouchWorksErrorMessages.MAGIC_JSON_FAILED)
@@ -0,0 +1,232 @@
+"""
+in-process metrics of the TouchWorks client: calls, errors, latency and
+payload sizes per Magic JSON action, token refreshes and cache hit ratios.
+
+    tw.metrics.snapshot()['actions']['GetPatient']['latency']['p95']
+    tw.metrics.to_prometheus()
+
+histograms have fixed buckets so recording is O(log buckets) and memory
+does not grow with traffic. percentiles are interpolated within a bucket
+"""
+import bisect
+import threading
+
+
+def exponential_buckets(start, factor, count):
+    """
+    :return: count upper bounds starting at start, each factor times the previous one
+    """
+    bounds = []
+    for _ in range(count):
+        bounds.append(float('%.4g' % start))
+        start *= factor
+    return tuple(bounds)
+
+
+# 1ms to about 2 minutes
+LATENCY_BUCKETS = exponential_buckets(0.001, 1.5, 30)
+# 64 bytes to about 64MB
+SIZE_BUCKETS = exponential_buckets(64, 2, 21)
+
+
+class Histogram(object):
+    """
+    counts observations in buckets of fixed upper bounds. not thread safe on
+    its own, MetricsRegistry serializes access
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def quantile(self, q):
+        """
+        :param q: 0 to 1
+        :return: estimated value below which q of the observations fall, None if empty
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if not n or seen + n < rank:
+                seen += n
+                continue
+            lower = max(self.bounds[i - 1] if i else 0.0, self.min)
+            upper = min(self.bounds[i] if i < len(self.bounds) else self.max, self.max)
+            return lower + (upper - lower) * max(rank - seen, 0) / n
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'max': self.max if self.count else None,
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99)}
+
+
+class _ActionMetrics(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_bytes = Histogram(SIZE_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+
+
+class MetricsRegistry(object):
+    """
+    metrics of one or more clients. every TouchWorks creates its own unless
+    one is passed in, a registry passed to several clients aggregates them
+    """
+    PREFIX = 'touchworks'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._actions = {}
+        self._caches = {}
+        self.token_refreshes = 0
+
+    def _action(self, action):
+        # must hold self._lock
+        metrics = self._actions.get(action)
+        if metrics is None:
+            metrics = self._actions[action] = _ActionMetrics()
+        return metrics
+
+    def observe(self, action, latency, error=None):
+        """
+        records one call of action
+        :param latency: seconds the call took, retries included
+        :param error: optional - the exception the call failed with
+        """
+        action = action.strip()
+        with self._lock:
+            metrics = self._action(action)
+            metrics.count += 1
+            metrics.latency.observe(latency)
+            if error is not None:
+                name = type(error).__name__
+                metrics.errors[name] = metrics.errors.get(name, 0) + 1
+
+    def observe_sizes(self, action, request_bytes, response_bytes=None):
+        """
+        records the body sizes of one HTTP exchange of action
+        """
+        action = action.strip()
+        with self._lock:
+            metrics = self._action(action)
+            metrics.request_bytes.observe(request_bytes)
+            if response_bytes is not None:
+                metrics.response_bytes.observe(response_bytes)
+
+    def token_refreshed(self):
+        with self._lock:
+            self.token_refreshes += 1
+
+    def cache_access(self, cache, hit):
+        """
+        :param cache: name of the cache, such as 'response' or 'dictionary'
+        """
+        with self._lock:
+            counts = self._caches.setdefault(cache, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._actions = {}
+            self._caches = {}
+            self.token_refreshes = 0
+
+    def snapshot(self):
+        """
+        :return: dict with per action count, errors by exception type, latency
+            percentiles in seconds and byte sizes, plus token refreshes and
+            cache hit ratios
+        """
+        with self._lock:
+            actions = {}
+            for action, metrics in self._actions.items():
+                actions[action] = {
+                    'count': metrics.count,
+                    'errors': dict(metrics.errors),
+                    'error_count': sum(metrics.errors.values()),
+                    'latency': metrics.latency.summary(),
+                    'request_bytes': metrics.request_bytes.summary(),
+                    'response_bytes': metrics.response_bytes.summary(),
+                }
+            caches = {}
+            for cache, (hits, misses) in self._caches.items():
+                total = hits + misses
+                caches[cache] = {'hits': hits, 'misses': misses,
+                                 'hit_ratio': float(hits) / total if total else None}
+            return {'actions': actions, 'caches': caches,
+                    'token_refreshes': self.token_refreshes}
+
+    def to_prometheus(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        p = self.PREFIX
+        lines = []
+
+        def header(name, kind, text):
+            lines.append('# HELP %s_%s %s' % (p, name, text))
+            lines.append('# TYPE %s_%s %s' % (p, name, kind))
+
+        with self._lock:
+            actions = sorted(self._actions.items())
+            header('requests_total', 'counter', 'Magic JSON calls by action')
+            for action, metrics in actions:
+                lines.append('%s_requests_total{action="%s"} %d' %
+                             (p, _escape(action), metrics.count))
+            header('errors_total', 'counter', 'failed calls by action and exception type')
+            for action, metrics in actions:
+                for error, count in sorted(metrics.errors.items()):
+                    lines.append('%s_errors_total{action="%s",type="%s"} %d' %
+                                 (p, _escape(action), _escape(error), count))
+            for name, attr, text in (
+                    ('request_duration_seconds', 'latency', 'call latency, retries included'),
+                    ('request_size_bytes', 'request_bytes', 'request body size'),
+                    ('response_size_bytes', 'response_bytes', 'response body size')):
+                header(name, 'histogram', text)
+                for action, metrics in actions:
+                    _histogram_lines(lines, '%s_%s' % (p, name), 'action="%s"' %
+                                     _escape(action), getattr(metrics, attr))
+            header('token_refreshes_total', 'counter', 'security tokens acquired')
+            lines.append('%s_token_refreshes_total %d' % (p, self.token_refreshes))
+            header('cache_requests_total', 'counter', 'cache lookups by cache and result')
+            for cache, (hits, misses) in sorted(self._caches.items()):
+                for result, count in (('hit', hits), ('miss', misses)):
+                    lines.append('%s_cache_requests_total{cache="%s",result="%s"} %d' %
+                                 (p, _escape(cache), result, count))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.bounds, histogram.counts):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%r"} %d' % (name, labels, bound, cumulative))
+    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, histogram.count))
+    lines.append('%s_sum{%s} %r' % (name, labels, histogram.sum))
+    lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
@@ -0,0 +1,156 @@
+from touchworks.logger import Logger
+import threading
+import time
+
+logger = Logger.get_logger(__name__)
+
+
+class RateLimiter(object):
+    """
+    paces requests sent to one TouchWorks web service with a token bucket
+    (rate requests per second, bursts up to burst) and a limit on the number
+    of requests in flight.
+
+    with adaptive=True the in-flight limit follows AIMD: it is halved when a
+    request is throttled, fails on the server side or is slower than
+    latency_target, and grows back by about one per round of successful
+    requests, up to max_in_flight.
+
+    RateLimiter.shared returns one limiter per (base_url, app_name) so every
+    client of the same app in a process draws from the same budget. asking
+    for it again with other settings raises ValueError
+    """
+    DEFAULT_MIN_IN_FLIGHT = 1
+    DECREASE_FACTOR = 0.5
+    POLL_INTERVAL_IN_SECS = 0.01
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, rate=0, burst=None, max_in_flight=0, adaptive=False,
+                 min_in_flight=DEFAULT_MIN_IN_FLIGHT, latency_target=None):
+        """
+        :param rate: optional - requests per second, 0 for no rate limit
+        :param burst: optional - requests that may be sent at once, defaults to rate
+        :param max_in_flight: optional - concurrent requests, 0 for no limit
+        :param adaptive: optional - adjust the in-flight limit to throttling and latency.
+            requires max_in_flight
+        :param min_in_flight: optional - lowest in-flight limit adaptive mode goes to
+        :param latency_target: optional - seconds, slower requests count as congestion
+        """
+        if adaptive and not max_in_flight:
+            raise ValueError('adaptive concurrency requires max_in_flight')
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min(min_in_flight, max_in_flight) if max_in_flight else 0
+        self.adaptive = adaptive
+        self.latency_target = latency_target
+        self._tokens = self.burst
+        self._refilled_time = time.time()
+        self._limit = float(max_in_flight)
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition(threading.Lock())
+        self.throttled = 0
+
+    @classmethod
+    def shared(cls, base_url, app_name, **kwargs):
+        """
+        :return: the limiter of (base_url, app_name), created with kwargs the first time
+        :raise ValueError: if the limiter exists with settings other than kwargs
+        """
+        key = (base_url, app_name)
+        requested = cls(**kwargs)
+        with cls._registry_lock:
+            limiter = cls._registry.get(key)
+            if limiter is None:
+                limiter = cls._registry[key] = requested
+            elif limiter.settings() != requested.settings():
+                raise ValueError('the rate limiter of %s %s is shared with settings %s, '
+                                 'not %s' % (base_url, app_name, limiter.settings(),
+                                             requested.settings()))
+            return limiter
+
+    def settings(self):
+        """
+        :return: dict of the settings the limiter was created with
+        """
+        return {'rate': self.rate,
+                'burst': self.burst,
+                'max_in_flight': self.max_in_flight,
+                'min_in_flight': self.min_in_flight,
+                'adaptive': self.adaptive,
+                'latency_target': self.latency_target}
+
+    @property
+    def limit(self):
+        """
+        :return: the current in-flight limit, 0 when unlimited
+        """
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_time) * self.rate)
+        self._refilled_time = now
+
+    def _try_acquire(self):
+        # must hold self._cond. returns 0 when a slot was taken, else seconds to wait
+        if self.max_in_flight and self._in_flight >= max(int(self._limit), 1):
+            return self.POLL_INTERVAL_IN_SECS
+        if self.rate:
+            self._refill(time.time())
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        self._in_flight += 1
+        return 0
+
+    def acquire(self):
+        """
+        blocks until a request may be sent, call release() once it completes
+        """
+        with self._cond:
+            wait = self._try_acquire()
+            while wait:
+                self._cond.wait(wait)
+                wait = self._try_acquire()
+
+    def try_acquire(self):
+        """
+        :return: 0 if a request may be sent now (call release() once it completes),
+            otherwise the seconds to wait before trying again
+        """
+        with self._cond:
+            return self._try_acquire()
+
+    def release(self, latency=None, congested=False):
+        """
+        :param latency: optional - seconds the request took
+        :param congested: optional - True if the request was throttled or the server failed
+        """
+        with self._cond:
+            self._in_flight -= 1
+            if congested:
+                self.throttled += 1
+            if self.adaptive:
+                slow = self.latency_target and latency is not None and \
+                    latency > self.latency_target
+                self._adapt(congested or slow)
+            self._cond.notify()
+
+    def _adapt(self, congested):
+        if congested:
+            now = time.time()
+            # one decrease per round trip, a burst of failures is one congestion event
+            if now - self._last_decrease >= (self.latency_target or 1):
+                self._limit = max(self.min_in_flight, self._limit * self.DECREASE_FACTOR)
+                self._last_decrease = now
+                logger.debug('in-flight limit decreased to %s', self.limit)
+        else:
+            self._limit = min(self.max_in_flight, self._limit + 1.0 / max(self._limit, 1))
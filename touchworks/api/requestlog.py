@@ -0,0 +1,73 @@
+"""
+opt-in structured log of the HTTP exchanges of a client, one record per
+exchange on the 'touchworks.requests' logger:
+
+    touchworks.requests INFO {"action":"GetPatient","attempt":0,"ms":41.2,...}
+
+envelopes are redacted like tracing spans: only safe_fields keep their value,
+the other fields are reported as present, and request or response bodies are
+never logged. the message is cut to max_length characters, the full record is
+attached to the log record as its touchworks_request attribute for structured
+handlers.
+
+    logging.getLogger('touchworks.requests').addHandler(handler)
+    tw = TouchWorks(..., request_log=RequestLog())
+"""
+from touchworks.api.tracing import Tracer, redact_envelope
+import json
+import logging
+
+LOGGER_NAME = 'touchworks.requests'
+
+
+class RequestLog(object):
+    """
+    costs one isEnabledFor check per exchange while its logger is not enabled
+    for level
+    """
+    DEFAULT_MAX_LENGTH = 1024
+
+    def __init__(self, logger=None, level=logging.INFO, max_length=DEFAULT_MAX_LENGTH,
+                 safe_fields=Tracer.DEFAULT_SAFE_FIELDS):
+        """
+        :param logger: optional - logging.Logger, defaults to 'touchworks.requests'
+        :param level: optional - level the records are logged at
+        :param max_length: optional - longest message in characters
+        :param safe_fields: optional - envelope fields logged with their value
+        """
+        self._logger = logger or logging.getLogger(LOGGER_NAME)
+        self._level = level
+        self._max_length = max_length
+        self._safe_fields = frozenset(safe_fields)
+
+    def envelope(self, data):
+        """
+        :return: copy of a magic json envelope without PHI
+        """
+        return redact_envelope(data, self._safe_fields)
+
+    def record(self, api, data, attempt, started, duration, request_bytes,
+               response_bytes=None, status=None, error=None):
+        """
+        logs one exchange, same parameters as CassetteRecorder.record
+        """
+        if not self._logger.isEnabledFor(self._level):
+            return
+        fields = {'api': api,
+                  'attempt': attempt,
+                  'ms': round(duration * 1000, 2),
+                  'req': request_bytes,
+                  'resp': response_bytes,
+                  'status': status}
+        if api.endswith('MagicJson'):
+            fields['action'] = (data.get('Action') or '').strip()
+            fields['env'] = self.envelope(data)
+        else:
+            # GetToken, its body holds the service password
+            fields['action'] = api.rsplit('/', 1)[-1]
+        if error is not None:
+            fields['error'] = type(error).__name__
+        message = json.dumps(fields, sort_keys=True, separators=(',', ':'))
+        if len(message) > self._max_length:
+            message = message[:max(self._max_length - 3, 0)] + '...'
+        self._logger.log(self._level, message, extra={'touchworks_request': fields})
@@ -0,0 +1,183 @@
+from touchworks.logger import Logger
+import random
+import requests
+import threading
+import time
+
+logger = Logger.get_logger(__name__)
+
+
+class RetryPolicy(object):
+    """
+    decides if and when a failed request is sent again. connection errors,
+    timeouts and the status codes in retry_statuses are retried up to
+    max_retries times with full-jitter exponential backoff, or after the delay
+    given by the server in Retry-After.
+
+    only idempotent actions are retried: GetToken and every Get* or Search*
+    action by default. writes such as SaveNote are never sent twice unless
+    listed in overrides
+    """
+    DEFAULT_MAX_RETRIES = 3
+    DEFAULT_BACKOFF_BASE_IN_SECS = 0.2
+    DEFAULT_BACKOFF_MAX_IN_SECS = 10
+    DEFAULT_RETRY_AFTER_MAX_IN_SECS = 60
+    DEFAULT_RETRY_STATUSES = (429, 500, 502, 503, 504)
+    IDEMPOTENT_ACTION_PREFIXES = ('Get', 'Search')
+
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_base=DEFAULT_BACKOFF_BASE_IN_SECS,
+                 backoff_max=DEFAULT_BACKOFF_MAX_IN_SECS,
+                 retry_statuses=DEFAULT_RETRY_STATUSES,
+                 retry_after_max=DEFAULT_RETRY_AFTER_MAX_IN_SECS,
+                 overrides=None):
+        """
+        :param max_retries: optional - retries of an idempotent action
+        :param backoff_base: optional - seconds, the backoff ceiling doubles from here
+        :param backoff_max: optional - seconds, upper bound of the backoff ceiling
+        :param retry_statuses: optional - HTTP status codes worth retrying
+        :param retry_after_max: optional - longest Retry-After in seconds that is honored
+        :param overrides: optional - dict of Action name to max retries for that action,
+            0 disables retries of an action, a write action has to be listed here to
+            be retried at all
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = frozenset(retry_statuses)
+        self.retry_after_max = retry_after_max
+        self._overrides = dict((a.strip(), n) for a, n in (overrides or {}).items())
+
+    def max_retries_for(self, action):
+        """
+        :param action: Action name, None for GetToken
+        :return: number of times a failed call of action may be retried
+        """
+        if action is None:
+            return self.max_retries
+        action = action.strip()
+        if action in self._overrides:
+            return self._overrides[action]
+        if action.startswith(self.IDEMPOTENT_ACTION_PREFIXES):
+            return self.max_retries
+        return 0
+
+    @staticmethod
+    def _status(exception):
+        response = getattr(exception, 'response', None)
+        return getattr(response, 'status_code', None)
+
+    def is_server_failure(self, exception):
+        """
+        :return: True if exception means the server is unreachable or unhealthy
+        """
+        if isinstance(exception, (requests.ConnectionError, requests.Timeout)):
+            return True
+        if isinstance(exception, requests.HTTPError):
+            return self._status(exception) in self.retry_statuses
+        return False
+
+    def delay(self, attempt, exception=None):
+        """
+        :param attempt: 0 for the first retry
+        :return: seconds to wait before the next attempt
+        """
+        retry_after = self._retry_after(exception)
+        if retry_after is not None:
+            return min(retry_after, self.retry_after_max)
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    @staticmethod
+    def _retry_after(exception):
+        response = getattr(exception, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        value = headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            # an HTTP-date, fall back to our own backoff
+            return None
+
+
+class CircuitBreaker(object):
+    """
+    fails fast while an endpoint is unhealthy. after failure_threshold server
+    failures in a row the circuit opens and calls are refused for reset_timeout
+    seconds. then a single trial call is let through: success closes the
+    circuit, failure opens it again
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    DEFAULT_FAILURE_THRESHOLD = 5
+    DEFAULT_RESET_TIMEOUT_IN_SECS = 30
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT_IN_SECS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_time = 0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self._reset_elapsed():
+                return self.HALF_OPEN
+            return self._state
+
+    def _reset_elapsed(self):
+        return time.time() - self._opened_time >= self.reset_timeout
+
+    def retry_in(self):
+        """
+        :return: seconds until the open circuit lets a trial call through
+        """
+        return max(self._opened_time + self.reset_timeout - time.time(), 0)
+
+    def allow(self):
+        """
+        :return: True if a call may be made now
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and self._reset_elapsed():
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.debug('circuit closed')
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.error('circuit opened after %s failures', self._failures)
+                self._state = self.OPEN
+                self._opened_time = time.time()
+
+    def release_trial(self):
+        """
+        lets the next trial call through after the trial in flight ended in an
+        error that is neither a success nor a server failure, such as a missed
+        deadline. the circuit stays as it is
+        """
+        with self._lock:
+            self._trial_in_flight = False
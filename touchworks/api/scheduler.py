@@ -0,0 +1,165 @@
+from touchworks.logger import Logger
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+logger = Logger.get_logger(__name__)
+
+
+class Priority(object):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+if contextvars is not None:
+    # a context variable follows asyncio tasks as well as threads
+    _current_priority = contextvars.ContextVar('touchworks_priority', default=None)
+
+    def current_priority():
+        """
+        :return: (priority, absolute deadline or None) of the calling thread or task
+        """
+        return _current_priority.get() or (Priority.INTERACTIVE, None)
+
+    @contextlib.contextmanager
+    def call_priority(priority, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        token = _current_priority.set((priority, deadline))
+        try:
+            yield
+        finally:
+            _current_priority.reset(token)
+else:
+    _local = threading.local()
+
+    def current_priority():
+        """
+        :return: (priority, absolute deadline or None) of the calling thread
+        """
+        return getattr(_local, 'priority', None) or (Priority.INTERACTIVE, None)
+
+    @contextlib.contextmanager
+    def call_priority(priority, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        previous = getattr(_local, 'priority', None)
+        _local.priority = (priority, deadline)
+        try:
+            yield
+        finally:
+            _local.priority = previous
+
+
+class _Waiter(object):
+    def __init__(self, priority, deadline, seq, wake):
+        self.priority = priority
+        self.deadline = deadline
+        self.key = (priority, deadline if deadline is not None else float('inf'), seq)
+        self.wake = wake
+        self.admitted = False
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class RequestScheduler(object):
+    """
+    admits requests into max_concurrency slots. waiting requests are served by
+    priority class then by deadline, and reserved_interactive slots are kept
+    free for Priority.INTERACTIVE requests so a running bulk job can never
+    take every slot away from the UI
+    """
+    DEFAULT_MAX_CONCURRENCY = 16
+    DEFAULT_RESERVED_INTERACTIVE = 4
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 reserved_interactive=DEFAULT_RESERVED_INTERACTIVE):
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be greater than zero')
+        if not 0 <= reserved_interactive < max_concurrency:
+            raise ValueError('reserved_interactive must be lower than max_concurrency')
+        self.max_concurrency = max_concurrency
+        self.reserved_interactive = reserved_interactive
+        self._lock = threading.Lock()
+        self._queue = []
+        self._seq = itertools.count()
+        self._in_flight = {Priority.INTERACTIVE: 0, Priority.BULK: 0}
+
+    def in_flight(self, priority=None):
+        if priority is None:
+            return sum(self._in_flight.values())
+        return self._in_flight.get(priority, 0)
+
+    def queued(self):
+        return len([w for w in self._queue if not w.cancelled])
+
+    def _can_admit(self, priority):
+        total = self.in_flight()
+        if total >= self.max_concurrency:
+            return False
+        if priority != Priority.INTERACTIVE:
+            non_interactive = total - self._in_flight[Priority.INTERACTIVE]
+            return non_interactive < self.max_concurrency - self.reserved_interactive
+        return True
+
+    def _dispatch(self):
+        # must hold self._lock
+        while self._queue:
+            waiter = self._queue[0]
+            if waiter.cancelled:
+                heapq.heappop(self._queue)
+                continue
+            if not self._can_admit(waiter.priority):
+                return
+            heapq.heappop(self._queue)
+            self._in_flight[waiter.priority] = self._in_flight.get(waiter.priority, 0) + 1
+            waiter.admitted = True
+            waiter.wake()
+
+    def enqueue(self, priority, deadline, wake):
+        """
+        queues a request. wake() is called, possibly from another thread, once it
+        is admitted
+        :return: waiter to pass to cancel()
+        """
+        with self._lock:
+            waiter = _Waiter(priority, deadline, next(self._seq), wake)
+            heapq.heappush(self._queue, waiter)
+            self._dispatch()
+        return waiter
+
+    def cancel(self, waiter):
+        """
+        withdraws a queued request
+        :return: False if it had already been admitted and holds a slot
+        """
+        with self._lock:
+            if waiter.admitted:
+                return False
+            waiter.cancelled = True
+            return True
+
+    def acquire(self, priority=Priority.INTERACTIVE, deadline=None):
+        """
+        blocks until the request is admitted, call release(priority) once it completes
+        :param deadline: optional - absolute time after which to stop waiting
+        :return: False if deadline passed before the request was admitted
+        """
+        event = threading.Event()
+        waiter = self.enqueue(priority, deadline, event.set)
+        timeout = max(deadline - time.time(), 0) if deadline is not None else None
+        if event.wait(timeout):
+            return True
+        return not self.cancel(waiter)
+
+    def release(self, priority=Priority.INTERACTIVE):
+        with self._lock:
+            self._in_flight[priority] -= 1
+            self._dispatch()
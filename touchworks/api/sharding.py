@@ -0,0 +1,74 @@
+"""
+splitting of date-range queries such as GetSchedule and GetDocuments into
+windows that are fetched concurrently and merged back into one result
+"""
+import datetime
+import json
+
+DAY = 1
+WEEK = 7
+DATE_FORMAT = '%m/%d/%Y'
+
+SCHEDULE_ID_FIELDS = ('id', 'apptid', 'appointmentid', 'scheduleid')
+DOCUMENT_ID_FIELDS = ('documentid', 'id')
+
+
+def _to_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value.strip(), DATE_FORMAT).date()
+
+
+def split_date_range(start_date, end_date, window_days=DAY):
+    """
+    :param start_date: first day, datetime.date or 'MM/DD/YYYY'
+    :param end_date: last day, included
+    :param window_days: optional - days per window, DAY or WEEK for instance
+    :return: list of (first day, last day) of each window as 'MM/DD/YYYY'
+    """
+    if window_days < 1:
+        raise ValueError('window_days must be greater than zero')
+    start, end = _to_date(start_date), _to_date(end_date)
+    if end < start:
+        raise ValueError('end_date is before start_date')
+    windows = []
+    step = datetime.timedelta(days=window_days)
+    while start <= end:
+        last = min(start + step - datetime.timedelta(days=1), end)
+        windows.append((start.strftime(DATE_FORMAT), last.strftime(DATE_FORMAT)))
+        start = last + datetime.timedelta(days=1)
+    return windows
+
+
+def _row_key(row, id_fields):
+    if isinstance(row, dict):
+        for key, value in row.items():
+            if key.lower() in id_fields and value not in (None, ''):
+                return str(value).strip()
+    # no id, rows are only duplicates if they are identical
+    return json.dumps(row, sort_keys=True)
+
+
+def merge_rows(results, id_fields):
+    """
+    concatenates the rows of every window in order, a row whose id was seen in
+    an earlier window is dropped
+    :param results: list of the results of each window
+    :param id_fields: lower-cased names of the field holding the row id
+    :return: list of rows
+    """
+    merged = []
+    seen = set()
+    for rows in results:
+        if not rows:
+            continue
+        if isinstance(rows, dict):
+            rows = [rows]
+        for row in rows:
+            key = _row_key(row, id_fields)
+            if key not in seen:
+                seen.add(key)
+                merged.append(row)
+    return merged
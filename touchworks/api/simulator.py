@@ -0,0 +1,472 @@
+"""
+local stand-in for the TouchWorks web service. serves json/GetToken and
+json/MagicJson on localhost with synthetic, deterministic data so the whole
+client stack (pooling, retries, caching, rate limiting) can be exercised and
+measured without a network or a sandbox account.
+
+    with TouchWorksSimulator(patients=500, latency=0.02, error_rate=0.01) as sim:
+        tw = TouchWorks(sim.url, sim.username, sim.password, 'app')
+        tw.search_patients('J*')
+
+or from a shell:
+
+    python -m touchworks.api.simulator --port 8080 --patients 1000 --latency 0.05
+
+every action of TouchWorksMagicConstants is answered under its result key.
+reads return generated patients, encounters, documents, schedules, tasks and
+dictionaries, writes succeed and return an id
+"""
+from __future__ import print_function
+from touchworks.api.http import TouchWorksMagicConstants
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+FIRST_NAMES = ('James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael',
+               'Linda', 'William', 'Elizabeth', 'David', 'Barbara', 'Richard', 'Susan',
+               'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen')
+LAST_NAMES = ('Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller',
+              'Davis', 'Rodriguez', 'Martinez', 'Hernandez', 'Lopez', 'Gonzalez',
+              'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin')
+DOCUMENT_TYPES = ('Consult', 'Chart', 'Progress Note', 'SpecReport', 'ChartCopy',
+                  'Discharge Summary', 'Radiology Report', 'Lab Report', 'Referral Letter')
+TASK_STATUSES = ('Active', 'In Progress', 'Complete')
+SECTIONS = ('Vitals', 'Problems', 'Medications', 'Allergies', 'Results', 'History',
+            'Immunizations', 'Orders', 'Alerts')
+DATE_FORMAT = '%m/%d/%Y'
+
+
+def result_keys():
+    """
+    :return: dict of Action name to result key, from TouchWorksMagicConstants
+    """
+    constants = vars(TouchWorksMagicConstants)
+    keys = {}
+    for name, action in constants.items():
+        if not name.startswith('ACTION_'):
+            continue
+        suffix = name[len('ACTION_'):]
+        key = constants.get('RESULT_' + suffix) or \
+            constants.get('RESULT_' + suffix.replace('_BY_', 'BY_'))
+        keys[action.strip()] = key or action.strip().lower() + 'info'
+    return keys
+
+
+class TouchWorksSimulator(object):
+    """
+    threaded HTTP/1.1 keep-alive server answering like TouchWorks.
+
+    latency is added to every request, a (min, max) tuple draws it uniformly.
+    error_rate of the requests fail with error_status. beyond throttle_rate
+    requests per second the server answers 429 with a Retry-After header.
+    tokens expire token_ttl seconds after they are issued and are then
+    rejected the way TouchWorks does, with an Error mentioning the token
+    """
+    DEFAULT_USERNAME = 'simulator'
+    DEFAULT_PASSWORD = 'simulator'
+    DEFAULT_TOKEN_TTL_IN_SECS = 20 * 60
+
+    def __init__(self, host='127.0.0.1', port=0, patients=100, encounters_per_patient=3,
+                 documents_per_patient=10, dictionary_size=200, appointments_per_day=40,
+                 latency=0, error_rate=0.0, error_status=500,
+                 token_ttl=DEFAULT_TOKEN_TTL_IN_SECS, throttle_rate=0, retry_after=1,
+                 username=DEFAULT_USERNAME, password=DEFAULT_PASSWORD, seed=0):
+        """
+        :param port: optional - 0 picks a free port, see url
+        :param patients: optional - number of synthetic patients
+        :param dictionary_size: optional - entries of every GetDictionary result
+        :param latency: optional - seconds, or (min, max) seconds, added to each request
+        :param error_rate: optional - 0 to 1, share of requests failing with error_status
+        :param token_ttl: optional - seconds before an issued token is rejected
+        :param throttle_rate: optional - requests per second before answering 429, 0 for none
+        :param retry_after: optional - seconds sent in the Retry-After header of a 429
+        :param seed: optional - seed of the synthetic data and of the injected faults
+        """
+        self.host = host
+        self.port = port
+        self.patients = patients
+        self.encounters_per_patient = encounters_per_patient
+        self.documents_per_patient = documents_per_patient
+        self.dictionary_size = dictionary_size
+        self.appointments_per_day = appointments_per_day
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.token_ttl = token_ttl
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.username = username
+        self.password = password
+        self.seed = seed
+        self._result_keys = result_keys()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._window = (0, 0)
+        self._server = None
+        self._thread = None
+        self.requests = {}
+        self.errors = 0
+        self.throttled = 0
+
+    @property
+    def url(self):
+        """
+        :return: base_url to give to TouchWorks
+        """
+        return 'http://%s:%s' % (self.host, self.port)
+
+    def start(self):
+        """
+        starts serving on a daemon thread
+        :return: self
+        """
+        simulator = self
+
+        class Handler(_Handler):
+            pass
+        Handler.simulator = simulator
+        self._server = _ThreadingServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='touchworks-simulator')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def expire_tokens(self):
+        """
+        makes every issued token invalid, as a server restart would
+        """
+        with self._lock:
+            self._tokens.clear()
+
+    # request handling
+
+    def handle(self, path, body):
+        """
+        :return: (status, headers, body bytes) of the response to a POST of body to path
+        """
+        endpoint = path.rstrip('/').rsplit('/', 1)[-1]
+        action = 'GetToken'
+        try:
+            data = json.loads(body.decode('utf-8') or '{}')
+        except ValueError:
+            return 400, {}, b'malformed json'
+        if endpoint == 'MagicJson':
+            action = (data.get('Action') or '').strip()
+        with self._lock:
+            self.requests[action] = self.requests.get(action, 0) + 1
+            fail = self.error_rate and self._random.random() < self.error_rate
+            latency = self.latency
+            if isinstance(latency, (tuple, list)):
+                latency = self._random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+        if self._throttle():
+            return 429, {'Retry-After': str(self.retry_after)}, b'too many requests'
+        if fail:
+            with self._lock:
+                self.errors += 1
+            return self.error_status, {}, b'simulated failure'
+        if endpoint == 'GetToken':
+            return 200, {}, self._get_token(data).encode('utf-8')
+        if endpoint != 'MagicJson':
+            return 404, {}, b'not found'
+        if not self._token_valid(data.get('Token')):
+            return 200, {}, self._dumps([{'Error': 'Error: Invalid security token.'}])
+        return 200, {}, self._dumps([{self._result_keys.get(action, action.lower() + 'info'):
+                                      self.result(action, data)}])
+
+    @staticmethod
+    def _dumps(value):
+        return json.dumps(value).encode('utf-8')
+
+    def _throttle(self):
+        if not self.throttle_rate:
+            return False
+        now = int(time.time())
+        with self._lock:
+            second, count = self._window
+            if second != now:
+                second, count = now, 0
+            count += 1
+            self._window = (second, count)
+            if count > self.throttle_rate:
+                self.throttled += 1
+                return True
+        return False
+
+    def _get_token(self, data):
+        if data.get('Username') != self.username or data.get('Password') != self.password:
+            return 'Error: Invalid username or password.'
+        token = str(uuid.uuid4())
+        with self._lock:
+            self._tokens[token] = time.time()
+        return token
+
+    def _token_valid(self, token):
+        with self._lock:
+            issued = self._tokens.get(token)
+            if issued is None:
+                return False
+            if time.time() - issued > self.token_ttl:
+                del self._tokens[token]
+                return False
+            return True
+
+    # synthetic data
+
+    def result(self, action, data):
+        """
+        :return: the value served under the result key of action
+        """
+        handler = getattr(self, '_' + action.lower(), None)
+        if handler is not None:
+            return handler(data)
+        if action.lower().startswith(('save', 'set')):
+            return [{'Status': 'Success', 'ID': str(self._random_id())}]
+        return []
+
+    def _random_id(self):
+        with self._lock:
+            return self._random.randint(100000, 999999)
+
+    def _patient_id(self, data):
+        try:
+            patient_id = int(data.get('PatientID') or 0)
+        except ValueError:
+            return None
+        return patient_id if 1 <= patient_id <= self.patients else None
+
+    def patient(self, patient_id):
+        rng = random.Random('%s:patient:%s' % (self.seed, patient_id))
+        birth = datetime.date(1930, 1, 1) + datetime.timedelta(days=rng.randint(0, 30000))
+        return {'ID': str(patient_id),
+                'FirstName': rng.choice(FIRST_NAMES),
+                'LastName': rng.choice(LAST_NAMES),
+                'MiddleName': '',
+                'DateofBirth': birth.strftime(DATE_FORMAT),
+                'gender': rng.choice(('M', 'F')),
+                'mrn': str(1000000 + patient_id),
+                'ssn': 'XXX-XX-%04d' % rng.randint(0, 9999),
+                'Addressline1': '%s Main St' % rng.randint(1, 9999),
+                'City': 'Springfield',
+                'State': 'IL',
+                'ZipCode': '%05d' % rng.randint(10000, 99999),
+                'PhoneNumber': '555-%04d' % rng.randint(0, 9999)}
+
+    def _getpatient(self, data):
+        patient_id = self._patient_id(data)
+        return [self.patient(patient_id)] if patient_id else []
+
+    def _searchpatients(self, data):
+        term = (data.get('Parameter1') or '').rstrip('*').lower()
+        found = []
+        for patient_id in range(1, self.patients + 1):
+            patient = self.patient(patient_id)
+            if patient['LastName'].lower().startswith(term) or \
+                    patient['FirstName'].lower().startswith(term):
+                found.append(patient)
+        return found
+
+    def _getchangedpatients(self, data):
+        rng = random.Random('%s:changed:%s' % (self.seed, int(time.time() // 60)))
+        count = min(self.patients, max(1, self.patients // 20))
+        return [{'patientid': str(pid)} for pid in
+                sorted(rng.sample(range(1, self.patients + 1), count))]
+
+    def _getencounterlistforpatient(self, data):
+        patient_id = self._patient_id(data)
+        if not patient_id:
+            return []
+        rng = random.Random('%s:encounters:%s' % (self.seed, patient_id))
+        encounters = []
+        for i in range(self.encounters_per_patient):
+            when = datetime.date(2015, 1, 1) + datetime.timedelta(days=rng.randint(0, 1500))
+            encounters.append({'Encounterid': str(patient_id * 1000 + i),
+                               'patientID': str(patient_id),
+                               'EncounterDate': when.strftime(DATE_FORMAT),
+                               'EncounterType': rng.choice(('Office Visit', 'Telephone',
+                                                            'Follow Up'))})
+        return encounters
+
+    def _getencounter(self, data):
+        return self._getencounterlistforpatient(data)[:1]
+
+    def _getdocuments(self, data):
+        patient_id = self._patient_id(data)
+        if not patient_id:
+            return []
+        rng = random.Random('%s:documents:%s' % (self.seed, patient_id))
+        start, end = _parse_date(data.get('Parameter1')), _parse_date(data.get('Parameter2'))
+        documents = []
+        for i in range(self.documents_per_patient):
+            when = datetime.date(2015, 1, 1) + datetime.timedelta(days=rng.randint(0, 1500))
+            if (start and when < start) or (end and when > end):
+                continue
+            documents.append({'DocumentID': str(patient_id * 10000 + i),
+                              'patientID': str(patient_id),
+                              'DocumentType': rng.choice(DOCUMENT_TYPES),
+                              'DocumentDate': when.strftime(DATE_FORMAT),
+                              'Status': rng.choice(('Final', 'Preliminary')),
+                              'AuthorName': '%s, %s' % (rng.choice(LAST_NAMES),
+                                                        rng.choice(FIRST_NAMES)),
+                              'Description': 'Synthetic document %s of patient %s' %
+                                             (i, patient_id)})
+        return documents
+
+    def _getschedule(self, data):
+        dates = (data.get('Parameter1') or '').split('|')
+        start = _parse_date(dates[0]) or datetime.date.today()
+        end = _parse_date(dates[-1]) or start
+        appointments = []
+        day = start
+        while day <= end and self.patients:
+            rng = random.Random('%s:schedule:%s' % (self.seed, day.toordinal()))
+            for slot in range(self.appointments_per_day):
+                patient_id = rng.randint(1, self.patients)
+                appointments.append({'ID': '%s%03d' % (day.toordinal(), slot),
+                                     'patientID': str(patient_id),
+                                     'ApptDate': day.strftime(DATE_FORMAT),
+                                     'ApptTime': '%02d:%02d' % (8 + slot * 10 // 60 % 10,
+                                                                slot * 10 % 60),
+                                     'Status': rng.choice(('Scheduled', 'Arrived',
+                                                           'Completed'))})
+            day += datetime.timedelta(days=1)
+        return appointments
+
+    def _getdictionary(self, data):
+        name = data.get('Parameter1') or ''
+        rng = random.Random('%s:dictionary:%s' % (self.seed, name))
+        entries = []
+        for i in range(self.dictionary_size):
+            label = DOCUMENT_TYPES[i % len(DOCUMENT_TYPES)]
+            entries.append({'ID': str(i + 1),
+                            'EntryName': '%s %s' % (label, i // len(DOCUMENT_TYPES))
+                            if i >= len(DOCUMENT_TYPES) else label,
+                            'EntryCode': '%s%04d' % (name[:3].upper(), i),
+                            'EntryMnemonic': label.replace(' ', '')[:8].upper() + str(i),
+                            'Active': 'N' if rng.random() < 0.1 else 'Y'})
+        return entries
+
+    def _getdocumenttype(self, data):
+        return [{'ID': str(i + 1), 'DocumentType': t, 'Active': 'Y'}
+                for i, t in enumerate(DOCUMENT_TYPES)]
+
+    def _gettasklist(self, data):
+        rng = random.Random('%s:tasks:%s' % (self.seed, int(time.time() // 60)))
+        return [{'TaskID': str(i + 1),
+                 'patientID': str(rng.randint(1, max(self.patients, 1))),
+                 'Status': rng.choice(TASK_STATUSES),
+                 'TaskType': rng.choice(('Sign Note', 'Verify Result', 'MedRenewal'))}
+                for i in range(max(self.patients // 5, 1))]
+
+    def _gettasklistbyview(self, data):
+        return self._gettasklist(data)
+
+    def _getclinicalsummary(self, data):
+        patient_id = self._patient_id(data)
+        if not patient_id:
+            return []
+        sections = [s for s in (data.get('Parameter1') or '').split('|') if s] or SECTIONS
+        rng = random.Random('%s:summary:%s' % (self.seed, patient_id))
+        return [{'section': section, 'description': '%s item %s' % (section, i),
+                 'detail': 'synthetic value %s' % rng.randint(1, 500)}
+                for section in sections for i in range(3)]
+
+    def _getpatientactivity(self, data):
+        return []
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value.strip().split(' ')[0], DATE_FORMAT).date()
+    except ValueError:
+        return None
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without this every response
+    # waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+    simulator = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, headers, content = self.simulator.handle(self.path, body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if status == 200
+                         else 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='local TouchWorks stand-in server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--dictionary-size', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0, help='seconds per request')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--token-ttl', type=float,
+                        default=TouchWorksSimulator.DEFAULT_TOKEN_TTL_IN_SECS)
+    parser.add_argument('--throttle-rate', type=int, default=0,
+                        help='requests per second before answering 429')
+    args = parser.parse_args()
+    simulator = TouchWorksSimulator(host=args.host, port=args.port, patients=args.patients,
+                                    dictionary_size=args.dictionary_size,
+                                    latency=args.latency, error_rate=args.error_rate,
+                                    token_ttl=args.token_ttl,
+                                    throttle_rate=args.throttle_rate)
+    simulator.start()
+    print('serving TouchWorks simulator on %s, username %s password %s' %
+          (simulator.url, simulator.username, simulator.password))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+from touchworks.logger import Logger
+from touchworks.api.cache import ResponseCache
+import copy
+import threading
+
+logger = Logger.get_logger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    collapses identical concurrent Magic JSON calls. while an envelope is in
+    flight, other threads asking for the same envelope wait for it and get a
+    copy of its result (or its exception) instead of sending their own request.
+    only read actions are collapsed, two identical writes are always two requests
+    """
+    READ_ACTION_PREFIXES = ('Get', 'Search')
+
+    def __init__(self, actions=None):
+        """
+        :param actions: optional - Action names that may be collapsed, defaults to
+            every Get* and Search* action
+        """
+        self._actions = set(a.strip() for a in actions) if actions else None
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def is_collapsible(self, action):
+        action = (action or '').strip()
+        if self._actions is not None:
+            return action in self._actions
+        return action.startswith(self.READ_ACTION_PREFIXES)
+
+    def do(self, magic, fn):
+        """
+        runs fn() unless an identical envelope is already in flight, in which
+        case its outcome is shared
+        """
+        if not self.is_collapsible(magic.get('Action')):
+            return fn()
+        key = ResponseCache.key(magic)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return copy.deepcopy(call.result)
+        try:
+            call.result = fn()
+        except Exception as ex:
+            call.exception = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        if call.waiters:
+            # followers copy call.result, it must stay untouched by our caller
+            return copy.deepcopy(call.result)
+        return call.result
@@ -0,0 +1,204 @@
+"""
+incremental parser for Magic JSON responses. a response looks like
+
+    [{"getdocumentsinfo": [{...row...}, {...row...}, ...]}]
+
+ResultRowParser is fed the body chunk by chunk and hands back each row of the
+result array as soon as it is complete, so only one row (plus the unread part
+of the current chunk) is held in memory at a time
+"""
+import codecs
+import json
+
+
+class MagicJsonError(ValueError):
+    """
+    the response carried an Error instead of the expected result
+    """
+    pass
+
+
+class ResultRowParser(object):
+    _WHITESPACE = ' \t\n\r'
+    # states
+    _START = 0
+    _OBJECT = 1
+    _KEY = 2
+    _COLON = 3
+    _VALUE = 4
+    _ROWS = 5
+    _ROW = 6
+    _AFTER_ROW = 7
+    _AFTER_VALUE = 8
+    _DONE = 9
+
+    def __init__(self, result_key):
+        self._result_key = result_key
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._state = self._START
+        self._key = None
+        self._others = {}
+        self._found = False
+        # bytes to wait for before trying to decode a value again
+        self._wanted = 0
+
+    def feed(self, chunk):
+        """
+        :param chunk: next bytes of the response body
+        :return: list of the rows completed by this chunk
+        """
+        if self._pos:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        self._buf += self._text.decode(chunk)
+        if len(self._buf) < self._wanted:
+            return []
+        return self._parse(final=False)
+
+    def close(self):
+        """
+        signals the end of the body
+        :return: list of the remaining rows
+        :raises MagicJsonError: if the response had no result_key
+        """
+        self._buf = self._buf[self._pos:] + self._text.decode(b'', final=True)
+        self._pos = 0
+        rows = self._parse(final=True)
+        if not self._found:
+            raise MagicJsonError(self._others.get('Error', ''))
+        if self._state != self._DONE:
+            raise ValueError('incomplete magic json response')
+        return rows
+
+    def _skip_ws(self):
+        buf, pos, ws = self._buf, self._pos, self._WHITESPACE
+        while pos < len(buf) and buf[pos] in ws:
+            pos += 1
+        self._pos = pos
+        return pos < len(buf)
+
+    def _expect(self, chars):
+        if not self._skip_ws():
+            return None
+        c = self._buf[self._pos]
+        if c not in chars:
+            raise ValueError('unexpected %r in magic json response' % c)
+        self._pos += 1
+        return c
+
+    def _decode(self, final):
+        """
+        :return: (True, value) or (False, None) when more data is needed
+        """
+        if not self._skip_ws():
+            return False, None
+        try:
+            value, end = self._decoder.raw_decode(self._buf, self._pos)
+        except ValueError:
+            if final:
+                raise
+            # wait for at least as much data again before retrying, this keeps
+            # decoding of one very large value from going quadratic
+            self._wanted = 2 * (len(self._buf) - self._pos)
+            return False, None
+        if end == len(self._buf) and not final:
+            # a number (or anything) touching the end may still continue
+            return False, None
+        self._wanted = 0
+        self._pos = end
+        return True, value
+
+    def _parse(self, final):
+        rows = []
+        while True:
+            state = self._state
+            if state == self._START:
+                c = self._expect('[')
+                if c is None:
+                    return rows
+                self._state = self._OBJECT
+            elif state == self._OBJECT:
+                c = self._expect('{]')
+                if c is None:
+                    return rows
+                self._state = self._KEY if c == '{' else self._DONE
+            elif state == self._KEY:
+                if not self._skip_ws():
+                    return rows
+                if self._buf[self._pos] == '}':
+                    self._pos += 1
+                    self._state = self._DONE
+                    continue
+                ok, key = self._decode(final)
+                if not ok:
+                    return rows
+                self._key = key
+                self._state = self._COLON
+            elif state == self._COLON:
+                if self._expect(':') is None:
+                    return rows
+                self._state = self._VALUE
+            elif state == self._VALUE:
+                if self._key == self._result_key:
+                    if not self._skip_ws():
+                        return rows
+                    if self._buf[self._pos] == '[':
+                        self._pos += 1
+                        self._found = True
+                        self._state = self._ROWS
+                        continue
+                ok, value = self._decode(final)
+                if not ok:
+                    return rows
+                if self._key == self._result_key:
+                    # not an array, hand the value back as a single row
+                    self._found = True
+                    rows.append(value)
+                else:
+                    self._others[self._key] = value
+                self._state = self._AFTER_VALUE
+            elif state == self._ROWS:
+                if not self._skip_ws():
+                    return rows
+                if self._buf[self._pos] == ']':
+                    self._pos += 1
+                    self._state = self._AFTER_VALUE
+                    continue
+                self._state = self._ROW
+            elif state == self._ROW:
+                ok, row = self._decode(final)
+                if not ok:
+                    return rows
+                rows.append(row)
+                self._state = self._AFTER_ROW
+            elif state == self._AFTER_ROW:
+                c = self._expect(',]')
+                if c is None:
+                    return rows
+                self._state = self._ROW if c == ',' else self._AFTER_VALUE
+            elif state == self._AFTER_VALUE:
+                c = self._expect(',}')
+                if c is None:
+                    return rows
+                self._state = self._KEY if c == ',' else self._DONE
+            else:
+                # only the first object of the response is used
+                self._pos = len(self._buf)
+                return rows
+
+
+def iter_result_rows(chunks, result_key):
+    """
+    :param chunks: iterable of bytes, e.g. requests' response.iter_content()
+    :return: generator of the rows stored under result_key
+    :raises MagicJsonError: if the response had no result_key
+    """
+    parser = ResultRowParser(result_key)
+    for chunk in chunks:
+        for row in parser.feed(chunk):
+            yield row
+    for row in parser.close():
+        yield row
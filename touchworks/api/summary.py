@@ -0,0 +1,235 @@
+"""
+clinical summary assembled from per-section GetClinicalSummary calls.
+each section of each patient is cached on its own with its own ttl, and
+GetPatientActivity decides whether expired sections really have to be
+downloaded again
+"""
+from touchworks.logger import Logger
+from touchworks.api.scheduler import current_priority
+import collections
+import copy
+import threading
+import time
+
+logger = Logger.get_logger(__name__)
+
+
+class ClinicalSummaryAggregator(object):
+    """
+    fetches the requested sections of a patient's clinical summary
+    concurrently and keeps each one for ttls[section] seconds.
+
+    once a cached section has expired, GetPatientActivity is asked what
+    happened since the section was fetched, one call for the expired sections
+    fetched at the same time. expired sections without activity are kept for
+    another ttl, those with activity are downloaded again. sections that have
+    not expired are left alone. activity that can not be mapped to a section
+    refreshes every expired section it was asked for.
+
+    uses TouchWorks.batch so it works with the thread based client only
+
+        summary = ClinicalSummaryAggregator(tw)
+        chart = summary.get(patient_id, ['Vitals', 'Problems', 'Medications'])
+        chart['Vitals']
+    """
+    SECTIONS = ('ChiefComplaint', 'Vitals', 'Activities', 'Alerts', 'Problems', 'Results',
+                'History', 'Medications', 'Allergies', 'Immunizations', 'Orders')
+    DEFAULT_TTLS = {
+        'ChiefComplaint': 5 * 60,
+        'Vitals': 60,
+        'Activities': 5 * 60,
+        'Alerts': 5 * 60,
+        'Problems': 30 * 60,
+        'Results': 5 * 60,
+        'History': 24 * 60 * 60,
+        'Medications': 15 * 60,
+        'Allergies': 60 * 60,
+        'Immunizations': 24 * 60 * 60,
+        'Orders': 5 * 60,
+    }
+    DEFAULT_MAX_PATIENTS = 256
+    DEFAULT_MAX_WORKERS = 8
+    SINCE_FORMAT = '%m/%d/%Y %H:%M:%S'
+    # GetPatientActivity fields naming what kind of item changed, and the
+    # section each kind belongs to
+    ACTIVITY_TYPE_FIELDS = ('section', 'type', 'activitytype', 'itemtype', 'category')
+    ACTIVITY_SECTIONS = (
+        ('chief', 'ChiefComplaint'),
+        ('vital', 'Vitals'),
+        ('alert', 'Alerts'),
+        ('problem', 'Problems'),
+        ('result', 'Results'),
+        ('histor', 'History'),
+        ('medication', 'Medications'),
+        ('allerg', 'Allergies'),
+        ('immuniz', 'Immunizations'),
+        ('order', 'Orders'),
+        ('activit', 'Activities'),
+    )
+
+    def __init__(self, client, ttls=None, max_patients=DEFAULT_MAX_PATIENTS,
+                 max_workers=DEFAULT_MAX_WORKERS, check_activity=True, verbose=''):
+        """
+        :param client: TouchWorks
+        :param ttls: optional - dict of section to seconds it is cached, merged over
+            DEFAULT_TTLS
+        :param max_patients: optional - least recently used patients are evicted beyond this
+        :param max_workers: optional - sections fetched at once
+        :param check_activity: optional - ask GetPatientActivity before downloading an
+            expired section again
+        :param verbose: optional - passed to GetClinicalSummary
+        """
+        if max_patients < 1:
+            raise ValueError('max_patients must be greater than zero')
+        self._client = client
+        self._ttls = dict(self.DEFAULT_TTLS)
+        self._ttls.update(ttls or {})
+        self._max_patients = max_patients
+        self._max_workers = max_workers
+        self._check_activity = check_activity
+        self._verbose = verbose
+        self._patients = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.downloads = 0
+        self.revalidations = 0
+
+    def get(self, patient_id, sections=None, encounter_id=''):
+        """
+        :param sections: optional - list of section names, defaults to SECTIONS
+        :param encounter_id: optional - encounter of the ChiefComplaint section
+        :return: dict of section name to its rows
+        """
+        sections = list(sections or self.SECTIONS)
+        patient_id = str(patient_id)
+        now = time.time()
+        cached = self._entries(patient_id, sections, encounter_id)
+        missing = [s for s in sections if s not in cached]
+        expired = [s for s in sections if s in cached and
+                   now - cached[s][1] > self._ttls.get(s, 0)]
+        refresh = set(missing)
+        if expired and self._check_activity:
+            # sections fetched together share their fetched time and one activity check
+            by_since = collections.OrderedDict()
+            for section in expired:
+                by_since.setdefault(cached[section][1], []).append(section)
+            unchanged = []
+            for since, group in by_since.items():
+                changed = self._changed_sections(patient_id, since)
+                if changed is None:
+                    refresh.update(group)
+                else:
+                    refresh.update(s for s in group if s in changed)
+                    unchanged.extend(s for s in group if s not in changed)
+            self._touch(patient_id, unchanged, encounter_id, now)
+        elif expired:
+            refresh.update(expired)
+        if refresh:
+            self._download(patient_id, [s for s in sections if s in refresh],
+                           encounter_id, now)
+            cached = self._entries(patient_id, sections, encounter_id)
+        return dict((s, copy.deepcopy(cached[s][0])) for s in sections if s in cached)
+
+    def invalidate(self, patient_id=None, sections=None):
+        """
+        drops cached sections so the next get downloads them
+        :param patient_id: optional - defaults to every patient
+        :param sections: optional - defaults to every section
+        """
+        with self._lock:
+            patients = [str(patient_id)] if patient_id is not None else list(self._patients)
+            for pid in patients:
+                entries = self._patients.get(pid)
+                if entries is None:
+                    continue
+                if sections is None:
+                    del self._patients[pid]
+                    continue
+                for key in [k for k in entries if k[0] in sections]:
+                    del entries[key]
+
+    @staticmethod
+    def _key(section, encounter_id):
+        # the chief complaint is the only section that depends on the encounter
+        return section, encounter_id if section == 'ChiefComplaint' else ''
+
+    def _entries(self, patient_id, sections, encounter_id):
+        with self._lock:
+            entries = self._patients.get(patient_id)
+            if entries is None:
+                return {}
+            self._patients[patient_id] = self._patients.pop(patient_id)
+            result = {}
+            for section in sections:
+                entry = entries.get(self._key(section, encounter_id))
+                if entry is not None:
+                    result[section] = entry
+            return result
+
+    def _store(self, patient_id, section, encounter_id, rows, fetched_time):
+        # counted here, under the lock, the aggregator is refreshed from several threads
+        with self._lock:
+            self.downloads += 1
+            entries = self._patients.pop(patient_id, None) or {}
+            entries[self._key(section, encounter_id)] = (rows, fetched_time)
+            self._patients[patient_id] = entries
+            while len(self._patients) > self._max_patients:
+                self._patients.popitem(last=False)
+
+    def _touch(self, patient_id, sections, encounter_id, checked_time):
+        with self._lock:
+            entries = self._patients.get(patient_id) or {}
+            for section in sections:
+                key = self._key(section, encounter_id)
+                if key in entries:
+                    entries[key] = (entries[key][0], checked_time)
+                    self.revalidations += 1
+
+    def _changed_sections(self, patient_id, since):
+        """
+        :return: set of sections with activity since, or None if the activity
+            could not be attributed to sections
+        """
+        since = time.strftime(self.SINCE_FORMAT, time.localtime(since))
+        rows = self._client.get_patient_activity(patient_id, since=since) or []
+        if isinstance(rows, dict):
+            rows = [rows]
+        changed = set()
+        for row in rows:
+            section = self._activity_section(row)
+            if section is None:
+                logger.debug('activity of patient %s not attributable to a section',
+                             patient_id)
+                return None
+            changed.add(section)
+        return changed
+
+    def _activity_section(self, row):
+        if not isinstance(row, dict):
+            return None
+        for key, value in row.items():
+            if key.lower() not in self.ACTIVITY_TYPE_FIELDS or not value:
+                continue
+            value = str(value).lower()
+            for marker, section in self.ACTIVITY_SECTIONS:
+                if marker in value:
+                    return section
+        return None
+
+    def _download(self, patient_id, sections, encounter_id, started):
+        calls = [('get_clinical_summary', {'patient_id': patient_id,
+                                           'section': section,
+                                           'encounter_id_identifer':
+                                               encounter_id if section == 'ChiefComplaint'
+                                               else '',
+                                           'verbose': self._verbose})
+                 for section in sections]
+        failed = None
+        for result in self._client.batch(calls, max_workers=self._max_workers,
+                                         priority=current_priority()[0]):
+            if not result.ok:
+                failed = failed or result.exception
+                continue
+            self._store(patient_id, sections[result.index], encounter_id,
+                        result.result, started)
+        if failed is not None:
+            raise failed
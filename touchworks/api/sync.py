@@ -0,0 +1,277 @@
+"""
+incremental mirroring of patient demographics.
+
+PatientSync keeps a high-water mark per sync in a SqliteSyncStore. every run
+asks GetChangedPatients for the patients changed since the mark, journals
+their ids, fetches them concurrently with GetPatient and hands them to the
+sink a page at a time. the journal is trimmed after each page and the mark
+only moves once every page has been delivered, so a run that crashes is
+resumed with the pages it had not delivered yet.
+
+a page that was being delivered when the process died is delivered again,
+sinks should upsert.
+
+GetChangedPatients has no paging, neither a page size nor a continuation
+marker: one call returns every patient changed since the given time. the
+change list is streamed so only the patient ids are held in memory, the
+paging is done on the client side when the patients are fetched
+"""
+from touchworks.logger import Logger
+from touchworks.api.dictionary import _closing_connection
+from touchworks.api.scheduler import Priority
+import sqlite3
+import threading
+import time
+
+logger = Logger.get_logger(__name__)
+
+
+class PatientChange(object):
+    """
+    a changed patient and the result of GetPatient for it
+    """
+
+    def __init__(self, patient_id, patient):
+        self.patient_id = patient_id
+        self.patient = patient
+
+    def __repr__(self):
+        return '<PatientChange %s>' % self.patient_id
+
+
+class SqliteSyncStore(object):
+    """
+    persists the high-water mark and the journal of patient ids still to be
+    delivered of every named sync
+    """
+    LOCK_TIMEOUT_IN_SECS = 10
+
+    def __init__(self, path):
+        """
+        :param path: SQLite file, created if it does not exist
+        """
+        self._path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS sync_checkpoint ('
+                         'name TEXT PRIMARY KEY, '
+                         'mark REAL, '
+                         'pending_mark REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS sync_pending ('
+                         'name TEXT NOT NULL, '
+                         'seq INTEGER NOT NULL, '
+                         'patient_id TEXT NOT NULL, '
+                         'PRIMARY KEY (name, seq))')
+
+    @property
+    def path(self):
+        return self._path
+
+    def _connect(self):
+        return _closing_connection(sqlite3.connect(self._path,
+                                                   timeout=self.LOCK_TIMEOUT_IN_SECS))
+
+    def load_mark(self, name):
+        """
+        :return: the high-water mark of name as seconds since the epoch, or None
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT mark FROM sync_checkpoint WHERE name = ?',
+                               (name,)).fetchone()
+        return row[0] if row else None
+
+    def save_mark(self, name, mark):
+        """
+        sets the high-water mark and drops any run in progress
+        """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM sync_pending WHERE name = ?', (name,))
+            conn.execute('INSERT OR REPLACE INTO sync_checkpoint (name, mark, pending_mark) '
+                         'VALUES (?, ?, NULL)', (name, mark))
+
+    def begin(self, name, pending_mark, patient_ids):
+        """
+        journals the patient ids of a new run that moves the mark to pending_mark
+        """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM sync_pending WHERE name = ?', (name,))
+            conn.executemany('INSERT INTO sync_pending (name, seq, patient_id) '
+                             'VALUES (?, ?, ?)',
+                             [(name, seq, pid) for seq, pid in enumerate(patient_ids)])
+            conn.execute('INSERT OR IGNORE INTO sync_checkpoint (name) VALUES (?)', (name,))
+            conn.execute('UPDATE sync_checkpoint SET pending_mark = ? WHERE name = ?',
+                         (pending_mark, name))
+
+    def pending(self, name):
+        """
+        :return: (pending_mark, patient ids not delivered yet) of the run in
+            progress, or None
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT pending_mark FROM sync_checkpoint WHERE name = ?',
+                               (name,)).fetchone()
+            if row is None or row[0] is None:
+                return None
+            ids = conn.execute('SELECT patient_id FROM sync_pending WHERE name = ? '
+                               'ORDER BY seq', (name,)).fetchall()
+        return row[0], [pid for pid, in ids]
+
+    def ack(self, name, patient_ids):
+        """
+        removes delivered patient ids from the journal
+        """
+        with self._connect() as conn:
+            conn.executemany('DELETE FROM sync_pending WHERE name = ? AND patient_id = ?',
+                             [(name, pid) for pid in patient_ids])
+
+    def commit(self, name):
+        """
+        completes the run in progress, its pending_mark becomes the mark
+        """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM sync_pending WHERE name = ?', (name,))
+            conn.execute('UPDATE sync_checkpoint SET mark = pending_mark, pending_mark = NULL '
+                         'WHERE name = ? AND pending_mark IS NOT NULL', (name,))
+
+    def reset(self, name):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM sync_pending WHERE name = ?', (name,))
+            conn.execute('DELETE FROM sync_checkpoint WHERE name = ?', (name,))
+
+
+class PatientSync(object):
+    """
+    mirrors changed patients into a sink:
+
+        def upsert(changes):
+            for change in changes:
+                db.save(change.patient_id, change.patient)
+
+        sync = PatientSync(tw, ehr_username, upsert, SqliteSyncStore('sync.db'))
+        sync.run_forever(interval=300)
+
+    the mark is taken from the local clock when a run starts, GetChangedPatients
+    is asked for changes since the mark minus overlap seconds to cover clock
+    skew with the server
+    """
+    DEFAULT_NAME = 'patients'
+    DEFAULT_PAGE_SIZE = 100
+    DEFAULT_MAX_WORKERS = 8
+    DEFAULT_OVERLAP_IN_SECS = 5 * 60
+    SINCE_FORMAT = '%m/%d/%Y %H:%M:%S'
+    PATIENT_ID_FIELD = 'patientid'
+
+    def __init__(self, client, ehr_username, sink, store, name=DEFAULT_NAME,
+                 since=None, page_size=DEFAULT_PAGE_SIZE,
+                 max_workers=DEFAULT_MAX_WORKERS, overlap=DEFAULT_OVERLAP_IN_SECS):
+        """
+        :param client: TouchWorks
+        :param ehr_username: EHR user GetPatient is called as
+        :param sink: callable taking a list of PatientChange, an exception raised by
+            the sink stops the run and the page is delivered again by the next one
+        :param store: SqliteSyncStore
+        :param name: optional - key of this sync in the store
+        :param since: optional - seconds since the epoch to start from when the store
+            has no mark. without it the first run only records the mark
+        :param page_size: optional - patients handed to the sink at once
+        :param max_workers: optional - concurrent GetPatient calls
+        :param overlap: optional - seconds subtracted from the mark
+        """
+        if page_size < 1:
+            raise ValueError('page_size must be greater than zero')
+        self._client = client
+        self._ehr_username = ehr_username
+        self._sink = sink
+        self._store = store
+        self._name = name
+        self._since = since
+        self._page_size = page_size
+        self._max_workers = max_workers
+        self._overlap = overlap
+
+    @property
+    def mark(self):
+        """
+        :return: the high-water mark as seconds since the epoch, or None
+        """
+        return self._store.load_mark(self._name)
+
+    def run_once(self):
+        """
+        delivers every patient changed since the mark, resuming the previous run
+        first if it did not complete
+        :return: number of patients delivered
+        """
+        pending = self._store.pending(self._name)
+        if pending is not None:
+            pending_mark, patient_ids = pending
+            logger.debug('resuming sync %s, %s patients left', self._name, len(patient_ids))
+        else:
+            mark = self._store.load_mark(self._name)
+            pending_mark = time.time()
+            if mark is None:
+                mark = self._since
+            if mark is None:
+                self._store.save_mark(self._name, pending_mark)
+                return 0
+            patient_ids = self._changed_patient_ids(mark - self._overlap)
+            self._store.begin(self._name, pending_mark, patient_ids)
+        delivered = 0
+        for start in range(0, len(patient_ids), self._page_size):
+            page = patient_ids[start:start + self._page_size]
+            self._sink(self._fetch(page))
+            self._store.ack(self._name, page)
+            delivered += len(page)
+        self._store.commit(self._name)
+        logger.debug('sync %s delivered %s patients', self._name, delivered)
+        return delivered
+
+    def run_forever(self, interval=60, stop_event=None):
+        """
+        calls run_once every interval seconds until stop_event is set. a failed
+        run is logged and retried at the next interval
+        :param stop_event: optional - threading.Event
+        """
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as ex:
+                logger.exception(ex)
+            stop_event.wait(interval)
+
+    def _changed_patient_ids(self, since):
+        """
+        :return: ids of the patients changed since, in a single GetChangedPatients call
+            as the action can not be paged
+        """
+        since = time.strftime(self.SINCE_FORMAT, time.localtime(max(since, 0)))
+        rows = self._client.get_changes_patients('', since, stream=True)
+        patient_ids = []
+        seen = set()
+        for row in rows:
+            patient_id = self._patient_id(row)
+            if patient_id and patient_id not in seen:
+                seen.add(patient_id)
+                patient_ids.append(patient_id)
+        return patient_ids
+
+    def _patient_id(self, row):
+        if not isinstance(row, dict):
+            # an empty result streams back as a single null or empty row
+            return None
+        for key, value in row.items():
+            if key.lower() == self.PATIENT_ID_FIELD:
+                return str(value).strip()
+        return None
+
+    def _fetch(self, patient_ids):
+        calls = [('get_patient', {'ehr_username': self._ehr_username, 'patient_id': pid})
+                 for pid in patient_ids]
+        changes = []
+        for result in self._client.batch(calls, max_workers=self._max_workers,
+                                         ordered=True, priority=Priority.BULK):
+            if not result.ok:
+                raise result.exception
+            changes.append(PatientChange(result.kwargs['patient_id'], result.result))
+        return changes
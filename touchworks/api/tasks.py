@@ -0,0 +1,224 @@
+"""
+incremental task polling. one TaskWatcher polls GetTaskList (or
+GetTaskListByView) and fans the tasks that are new, changed or closed since
+the previous poll out to every subscriber
+"""
+from touchworks.logger import Logger
+import json
+import threading
+import time
+import zlib
+
+logger = Logger.get_logger(__name__)
+
+
+class TaskEvent(object):
+    """
+    a task that appeared, changed or was closed. previous_status is None for a
+    task not seen before, task is None for a task that dropped out of a watched
+    view
+    """
+    NEW = 'new'
+    CHANGED = 'changed'
+    CLOSED = 'closed'
+
+    def __init__(self, kind, task_id, status, previous_status=None, task=None):
+        self.kind = kind
+        self.task_id = task_id
+        self.status = status
+        self.previous_status = previous_status
+        self.task = task
+
+    def __repr__(self):
+        return '<TaskEvent %s %s %s>' % (self.kind, self.task_id, self.status)
+
+
+class TaskWatcher(object):
+    """
+    polls the task list and keeps a compact index of task id to
+    (status, fingerprint of the row, closed time) so only differences are
+    reported.
+
+    without view_id GetTaskList is asked for the tasks modified since the
+    previous poll (minus overlap seconds for clock skew). with view_id the
+    whole GetTaskListByView view is fetched and tasks that left the view are
+    reported as closed
+
+        watcher = TaskWatcher(tw)
+        watcher.subscribe(notify_ui, kinds=(TaskEvent.NEW,))
+        watcher.subscribe(audit)
+        watcher.run_forever(interval=30)
+    """
+    DEFAULT_OVERLAP_IN_SECS = 60
+    SINCE_FORMAT = '%m/%d/%Y %H:%M:%S'
+    TASK_ID_FIELDS = ('taskid', 'id')
+    STATUS_FIELDS = ('status', 'taskstatus')
+    CLOSED_STATUSES = ('complete', 'completed', 'closed', 'cancelled', 'canceled',
+                       'deleted', 'removed')
+
+    def __init__(self, client, since=None, task_types='', task_status='',
+                 view_id=None, patient_id='', org_id='',
+                 overlap=DEFAULT_OVERLAP_IN_SECS):
+        """
+        :param client: TouchWorks
+        :param since: optional - seconds since the epoch of the first poll, defaults
+            to every task
+        :param task_types: optional - pipe-delimited task type names for GetTaskList
+        :param task_status: optional - pipe-delimited task status names for GetTaskList
+        :param view_id: optional - poll this GetTaskListByView view instead
+        :param patient_id: optional - patient for GetTaskListByView
+        :param org_id: optional - organization for GetTaskListByView
+        :param overlap: optional - seconds subtracted from since
+        """
+        self._client = client
+        self._since = since
+        self._task_types = task_types
+        self._task_status = task_status
+        self._view_id = view_id
+        self._patient_id = patient_id
+        self._org_id = org_id
+        self._overlap = overlap
+        self._polled = None
+        self._index = {}
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    @property
+    def since(self):
+        """
+        :return: start of the last successful poll as seconds since the epoch
+        """
+        return self._since
+
+    def __len__(self):
+        return len(self._index)
+
+    def status_of(self, task_id):
+        """
+        :return: last seen status of a task, or None
+        """
+        entry = self._index.get(str(task_id))
+        return entry[0] if entry else None
+
+    def subscribe(self, callback, kinds=None):
+        """
+        :param callback: called with each TaskEvent
+        :param kinds: optional - TaskEvent kinds to receive, defaults to all
+        :return: callback, for unsubscribe
+        """
+        with self._lock:
+            self._subscribers.append((callback, frozenset(kinds) if kinds else None))
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [(c, k) for c, k in self._subscribers if c is not callback]
+
+    def poll(self):
+        """
+        fetches the task list once and notifies the subscribers
+        :return: list of TaskEvent
+        """
+        # the lock is not held across the network call, a slow server must not
+        # block subscribe and the other users of the watcher
+        started = time.time()
+        rows = self._fetch()
+        with self._lock:
+            if self._polled is not None and started < self._polled:
+                # a poll started after this one has been applied already
+                return []
+            events = self._diff(rows, full=self._view_id is not None)
+            self._since = self._polled = started
+            subscribers = list(self._subscribers)
+        for event in events:
+            for callback, kinds in subscribers:
+                if kinds is not None and event.kind not in kinds:
+                    continue
+                try:
+                    callback(event)
+                except Exception as ex:
+                    # one failing listener must not starve the others
+                    logger.exception(ex)
+        return events
+
+    def run_forever(self, interval=30, stop_event=None):
+        """
+        polls every interval seconds until stop_event is set. a failed poll is
+        logged and retried at the next interval
+        :param stop_event: optional - threading.Event
+        """
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as ex:
+                logger.exception(ex)
+            stop_event.wait(interval)
+
+    def _fetch(self):
+        if self._view_id is not None:
+            rows = self._client.get_task_list_by_view(self._patient_id, self._view_id,
+                                                      org_id=self._org_id)
+        else:
+            since = ''
+            if self._since is not None:
+                since = time.strftime(self.SINCE_FORMAT,
+                                      time.localtime(max(self._since - self._overlap, 0)))
+            rows = self._client.get_task_list(since=since, task_types=self._task_types,
+                                              task_status=self._task_status)
+        if isinstance(rows, dict):
+            rows = [rows]
+        return rows or []
+
+    @staticmethod
+    def _field(row, names):
+        for key, value in row.items():
+            if key.lower() in names:
+                return value
+        return None
+
+    @staticmethod
+    def _fingerprint(row):
+        return zlib.crc32(json.dumps(row, sort_keys=True).encode('utf-8')) & 0xffffffff
+
+    def _diff(self, rows, full):
+        # must hold self._lock. closed tasks stay in the index, marked with the time
+        # they were closed, until they can no longer come back through the overlap
+        events = []
+        seen = set()
+        now = time.time()
+        for row in rows:
+            task_id = self._field(row, self.TASK_ID_FIELDS)
+            if task_id is None:
+                continue
+            task_id = str(task_id).strip()
+            seen.add(task_id)
+            status = self._field(row, self.STATUS_FIELDS)
+            fingerprint = self._fingerprint(row)
+            previous = self._index.get(task_id)
+            if previous is not None and previous[1] == fingerprint:
+                continue
+            closed = str(status or '').strip().lower() in self.CLOSED_STATUSES
+            previous_status = previous[0] if previous is not None else None
+            if closed:
+                # on the first poll only report what is open
+                if previous is not None or self._since is not None:
+                    events.append(TaskEvent(TaskEvent.CLOSED, task_id, status,
+                                            previous_status, row))
+                self._index[task_id] = (status, fingerprint, now)
+            elif previous is None or previous[2] is not None:
+                events.append(TaskEvent(TaskEvent.NEW, task_id, status, previous_status, row))
+                self._index[task_id] = (status, fingerprint, None)
+            else:
+                events.append(TaskEvent(TaskEvent.CHANGED, task_id, status,
+                                        previous_status, row))
+                self._index[task_id] = (status, fingerprint, None)
+        expired = now - 2 * self._overlap
+        for task_id, (status, fingerprint, closed_time) in list(self._index.items()):
+            if closed_time is not None:
+                if (task_id not in seen) if full else closed_time < expired:
+                    del self._index[task_id]
+            elif full and task_id not in seen:
+                del self._index[task_id]
+                events.append(TaskEvent(TaskEvent.CLOSED, task_id, status, status))
+        return events
@@ -0,0 +1,133 @@
+from touchworks.logger import Logger
+import threading
+import time
+
+logger = Logger.get_logger(__name__)
+
+
+class TokenManager(object):
+    """
+    owns the SecurityToken of a TouchWorks client.
+
+    the token is refreshed on a background timer refresh_margin seconds
+    before token_timeout elapses so callers never wait on GetToken once the
+    first token has been acquired. a lock makes sure concurrent threads that
+    find the token missing or rejected trigger a single GetToken call
+    """
+    DEFAULT_REFRESH_MARGIN_IN_SECS = 60
+    RETRY_DELAY_IN_SECS = 5
+
+    def __init__(self, fetch_token, token_timeout, cache_token=True,
+                 refresh_margin=DEFAULT_REFRESH_MARGIN_IN_SECS,
+                 background_refresh=True):
+        """
+        :param fetch_token: callable returning a new SecurityToken
+        :param token_timeout: seconds a token stays valid on the server
+        :param cache_token: optional - if False a new token is acquired for every call
+        :param refresh_margin: optional - seconds before expiry to refresh the token
+        :param background_refresh: optional - refresh the token on a timer thread
+        """
+        self._fetch_token = fetch_token
+        self._token_timeout = token_timeout
+        self._cache_token = cache_token
+        self._refresh_margin = min(refresh_margin, token_timeout / 2.0)
+        self._background_refresh = background_refresh and cache_token
+        self._lock = threading.Lock()
+        self._token = None
+        self._timer = None
+        self._closed = False
+        self.refresh_count = 0
+
+    @property
+    def token(self):
+        """
+        :return: the cached SecurityToken or None, never contacts the server
+        """
+        return self._token
+
+    def is_valid(self, token=None):
+        """
+        :return: True if token (the cached token by default) has not expired yet
+        """
+        token = token or self._token
+        if token is None or not self._cache_token:
+            return False
+        if time.time() - token.acquired_time > self._token_timeout:
+            logger.debug('token needs to be reset')
+            return False
+        return True
+
+    def get(self):
+        """
+        :return: a valid SecurityToken, acquiring one if needed
+        """
+        token = self._token
+        if self.is_valid(token):
+            return token
+        if not self._cache_token:
+            return self._fetch_token()
+        return self.refresh(stale_token=token)
+
+    def refresh(self, stale_token=None):
+        """
+        acquires a new token unless another thread already replaced stale_token
+        :param stale_token: the SecurityToken (or token string) found invalid
+        :return: SecurityToken
+        """
+        with self._lock:
+            current = self._token
+            if current is not None and self.is_valid(current) and \
+                    not self._same_token(current, stale_token):
+                return current
+            token = self._fetch_token()
+            self.refresh_count += 1
+            if self._cache_token:
+                self._token = token
+                self._schedule_refresh(token)
+            return token
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+            self._cancel_timer()
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            self._cancel_timer()
+
+    @staticmethod
+    def _same_token(token, other):
+        if other is None:
+            return False
+        other = getattr(other, 'token', other)
+        return token.token == other
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _schedule_refresh(self, token, delay=None):
+        if not self._background_refresh or self._closed:
+            return
+        self._cancel_timer()
+        if delay is None:
+            expires_at = token.acquired_time + self._token_timeout
+            delay = max(expires_at - self._refresh_margin - time.time(), 0)
+        timer = threading.Timer(delay, self._refresh_in_background, args=(token,))
+        timer.daemon = True
+        self._timer = timer
+        timer.start()
+
+    def _refresh_in_background(self, token):
+        if self._closed:
+            return
+        try:
+            self.refresh(stale_token=token)
+        except Exception as ex:
+            logger.exception(ex)
+            # keep serving the current token while it lasts and try again shortly
+            with self._lock:
+                if self._token is token:
+                    self._schedule_refresh(token, delay=self.RETRY_DELAY_IN_SECS)
@@ -0,0 +1,227 @@
+"""
+tracing hooks around the stages of a TouchWorks call. a Tracer is told when
+each span starts and ends:
+
+    touchworks.call            one action, from the cache lookup to the result
+      touchworks.token         waiting for the security token
+      touchworks.serialize     encoding the envelope
+      touchworks.scheduler     waiting for a RequestScheduler slot
+      touchworks.rate_limit    waiting for the RateLimiter
+      touchworks.http          one HTTP exchange, connection setup included
+      touchworks.backoff       sleeping before a retry
+      touchworks.parse         decoding the response
+
+spans carry the action name and the envelope metadata. every envelope field
+other than safe_fields (Action and Appname by default) may hold PHI, so only
+its presence is reported, never its value.
+
+    class OpenTelemetryTracer(Tracer):
+        def on_start(self, span):
+            span.context = otel.start_span(span.name, attributes=span.attributes)
+
+        def on_end(self, span):
+            span.context.set_attributes(span.attributes)
+            span.context.end()
+
+    tw = TouchWorks(..., tracer=OpenTelemetryTracer())
+"""
+import threading
+import time
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+REDACTED = '[redacted]'
+ATTRIBUTE_PREFIX = 'touchworks.'
+
+
+def redact_envelope(data, safe_fields, transform=None):
+    """
+    the one redaction of magic json envelopes shared by spans, the request log
+    and cassettes, so that a field is kept out of all of them or none
+    :param data: magic json envelope
+    :param safe_fields: fields kept with their value, Action is stripped
+    :param transform: optional - callable (field, value) returning what to report
+        instead of an unsafe value, REDACTED when not given
+    :return: copy of data without the token, empty fields and PHI
+    """
+    envelope = {}
+    for field, value in data.items():
+        if field == 'Token' or value in (None, ''):
+            continue
+        if field in safe_fields:
+            envelope[field] = value.strip() if field == 'Action' else value
+        elif transform is not None:
+            envelope[field] = transform(field, value)
+        else:
+            envelope[field] = REDACTED
+    return envelope
+
+
+if contextvars is not None:
+    # follows asyncio tasks as well as threads
+    _current_span = contextvars.ContextVar('touchworks_span', default=None)
+
+    def current_span():
+        """
+        :return: the innermost open Span of the calling thread or task, or None
+        """
+        return _current_span.get()
+
+    def _enter(span):
+        return _current_span.set(span)
+
+    def _exit(token):
+        _current_span.reset(token)
+else:
+    _local = threading.local()
+
+    def current_span():
+        """
+        :return: the innermost open Span of the calling thread, or None
+        """
+        return getattr(_local, 'span', None)
+
+    def _enter(span):
+        previous = getattr(_local, 'span', None)
+        _local.span = span
+        return previous
+
+    def _exit(previous):
+        _local.span = previous
+
+
+class Span(object):
+    """
+    one timed stage. attributes may be added until the span ends, context is
+    free for the tracer to keep its own span object in
+    """
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.end_time = None
+        self.error = None
+        self.context = None
+
+    @property
+    def action(self):
+        return self.attributes.get(ATTRIBUTE_PREFIX + 'action')
+
+    @property
+    def duration(self):
+        """
+        :return: seconds, None while the span is open
+        """
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def set_attribute(self, key, value):
+        self.attributes[ATTRIBUTE_PREFIX + key] = value
+
+    def __repr__(self):
+        return '<Span %s %s>' % (self.name, self.action)
+
+
+class _SpanScope(object):
+    def __init__(self, tracer, name, attributes):
+        self._tracer = tracer
+        self._name = name
+        self._attributes = attributes
+        self._span = None
+        self._token = None
+
+    def __enter__(self):
+        parent = current_span()
+        attributes = {}
+        if parent is not None and parent.action is not None:
+            # stages inherit the action of the call they belong to
+            attributes[ATTRIBUTE_PREFIX + 'action'] = parent.action
+        for key, value in self._attributes.items():
+            attributes[ATTRIBUTE_PREFIX + key] = value
+        self._span = Span(self._name, parent, attributes)
+        self._token = _enter(self._span)
+        self._tracer.on_start(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        span = self._span
+        span.end_time = time.time()
+        span.error = exc_val
+        _exit(self._token)
+        self._tracer.on_end(span)
+
+
+class _NullSpan(object):
+    def set_attribute(self, key, value):
+        pass
+
+
+class _NullScope(object):
+    _span = _NullSpan()
+
+    def __enter__(self):
+        return self._span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class NullTracer(object):
+    """
+    used when no tracer is given, spans cost one method call
+    """
+    _scope = _NullScope()
+
+    def span(self, name, **attributes):
+        return self._scope
+
+    def envelope_attributes(self, magic):
+        return {}
+
+
+class Tracer(object):
+    """
+    base tracer, override on_start and on_end or pass them as callbacks.
+    the hooks run inline with the call, they should be quick and must not raise
+    """
+    DEFAULT_SAFE_FIELDS = ('Action', 'Appname')
+
+    def __init__(self, on_start=None, on_end=None, safe_fields=DEFAULT_SAFE_FIELDS):
+        """
+        :param on_start: optional - callable taking the Span that started
+        :param on_end: optional - callable taking the Span that ended
+        :param safe_fields: optional - envelope fields reported with their value
+        """
+        self._on_start = on_start
+        self._on_end = on_end
+        self._safe_fields = frozenset(safe_fields)
+
+    def on_start(self, span):
+        if self._on_start is not None:
+            self._on_start(span)
+
+    def on_end(self, span):
+        if self._on_end is not None:
+            self._on_end(span)
+
+    def span(self, name, **attributes):
+        """
+        :return: context manager timing a span, yielding the Span
+        """
+        return _SpanScope(self, name, attributes)
+
+    def envelope_attributes(self, magic):
+        """
+        :return: span attributes describing a magic json envelope with PHI redacted
+        """
+        envelope = redact_envelope(magic, self._safe_fields)
+        return dict((field.lower(), value) for field, value in envelope.items())
+
+
+NULL_TRACER = NullTracer()
@@ -0,0 +1,130 @@
+from touchworks.logger import Logger
+import os
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+
+logger = Logger.get_logger(__name__)
+
+
+def release_on_close(response, release):
+    """
+    makes response.close() also call release, once. a streamed response keeps
+    the scheduler and rate limiter slots it was sent with until its body has
+    been read and it is closed
+    :return: response
+    """
+    close = response.close
+    lock = threading.Lock()
+    released = [False]
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            with lock:
+                first = not released[0]
+                released[0] = True
+            if first:
+                release()
+    response.close = close_and_release
+    return response
+
+
+class HttpTransport(object):
+    """
+    pooled, keep-alive HTTP transport used by TouchWorks to talk to the
+    TouchWorks Web Service. a single requests.Session is shared by every call
+    so TCP connections and TLS sessions are reused instead of being set up
+    again for each Magic JSON request.
+    """
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_POOL_CONNECTIONS = 4
+    DEFAULT_CONNECT_TIMEOUT_IN_SECS = 5
+    DEFAULT_READ_TIMEOUT_IN_SECS = 60
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT_IN_SECS,
+                 read_timeout=DEFAULT_READ_TIMEOUT_IN_SECS,
+                 pool_block=False):
+        """
+        :param pool_size: optional - max number of keep-alive connections kept per host
+        :param pool_connections: optional - number of distinct hosts to keep pools for
+        :param connect_timeout: optional - seconds to wait for a connection to be established
+        :param read_timeout: optional - seconds to wait for the server to send a response
+        :param pool_block: optional - if True callers wait for a free connection instead of
+            opening a connection that will not be returned to the pool
+        """
+        if pool_size < 1:
+            raise ValueError('pool_size must be greater than zero')
+        self._pool_size = pool_size
+        self._pool_connections = pool_connections
+        self._pool_block = pool_block
+        self._timeout = (connect_timeout, read_timeout)
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        # must hold self._lock, or be called from __init__
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self._pool_connections,
+                              pool_maxsize=self._pool_size,
+                              pool_block=self._pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self._session = session
+        # set last, a session is only used once the pid matches
+        self._pid = os.getpid()
+
+    def _process_session(self):
+        """
+        :return: the session of the current process, opened if missing
+        """
+        if self._pid == os.getpid():
+            session = self._session
+            if session is not None:
+                return session
+        with self._lock:
+            if self._session is None:
+                self._open()
+            elif self._pid != os.getpid():
+                # sockets inherited from the parent process must not be shared with it
+                logger.debug('process was forked, creating a new connection pool')
+                self._open()
+            return self._session
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @property
+    def pool_size(self):
+        return self._pool_size
+
+    def post(self, url, data, headers=None, stream=False):
+        """
+        posts data to url over a pooled connection
+        :rtype : response object from requests.Session.post()
+        """
+        return self._process_session().post(url, data=data, headers=headers,
+                                            timeout=self._timeout, stream=stream)
+
+    def close(self):
+        """
+        closes every pooled connection. the transport can still be used
+        afterwards, a new pool is created on the next request
+        """
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            logger.debug('closing http transport')
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
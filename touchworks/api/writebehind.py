@@ -0,0 +1,669 @@
+"""
+write-behind delivery of note, document and task comment saves.
+
+WriteBehindQueue appends every write to a SqliteWriteJournal and returns at
+once with a future of the eventual server result. background workers deliver
+the journaled writes in the order they were submitted per patient (per task
+for task comments), retry them while the web service is unreachable and
+record the outcome in the journal. writes still pending when the process
+stops are delivered by the next queue opened on the same journal.
+
+TouchWorks has no idempotency key for saves, so a write is only sent again
+when the previous attempt surely did not reach it: the connection could not
+be opened, the circuit breaker or the scheduler held it back, or the web
+service answered 429 or 503. a write that failed after it may have been
+processed, a read timeout or a 500 for instance, is marked unknown instead.
+it is kept in the journal for reconciliation and only sent again through
+resend(), so a note is never saved twice behind the caller's back.
+
+several queues, in one process or in the workers of a pre-fork server, may
+share a journal. a queue claims a write with a lease before sending it, the
+other queues leave it alone until it is finished. a write whose lease runs
+out first is marked unknown, its queue may have sent it before dying.
+
+every write has a write_id, generated unless the caller gives one. a write
+whose id is already journaled is not queued again, so a caller retrying a
+submit, a double click for instance, does not save twice. the id only lives
+in the journal, TouchWorks never sees it.
+
+    queue = WriteBehindQueue(tw, SqliteWriteJournal('/var/lib/app/writes.db'))
+    queue.start()
+    pending = queue.save_note('hello there', patient_id, 'Consult')
+    ...
+    pending.result(timeout=30)
+
+the journal holds note text until the note is delivered, it should be
+stored where PHI may be stored
+"""
+from touchworks.logger import Logger
+from touchworks.api.dictionary import _closing_connection
+from touchworks.api.http import (TouchWorksCircuitOpenException,
+                                 TouchWorksDeadlineExceededException)
+from touchworks.api.ratelimit import RateLimiter
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib3.exceptions import NewConnectionError
+import json
+import os
+import random
+import requests
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = Logger.get_logger(__name__)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+
+
+class JournaledWrite(object):
+    """
+    a write as stored in the journal
+    """
+
+    def __init__(self, seq, write_id, method, kwargs, key, state=PENDING, attempts=0,
+                 not_before=0.0, result=None, error=None, claimed_by=None, lease_until=None):
+        self.seq = seq
+        self.write_id = write_id
+        self.method = method
+        self.kwargs = kwargs
+        self.key = key
+        self.state = state
+        self.attempts = attempts
+        self.not_before = not_before
+        self.result = result
+        self.error = error
+        self.claimed_by = claimed_by
+        self.lease_until = lease_until
+        # (result, error) of a delivery the journal failed to record, not journaled
+        self.outcome = None
+
+    def __repr__(self):
+        return '<JournaledWrite %s %s %s>' % (self.write_id, self.method, self.state)
+
+
+class SqliteWriteJournal(object):
+    """
+    durable, WAL mode journal of the writes of a WriteBehindQueue
+    """
+    LOCK_TIMEOUT_IN_SECS = 10
+    COLUMNS = ('seq, write_id, method, kwargs, key, state, attempts, not_before, '
+               'result, error, claimed_by, lease_until')
+    # added after the first release, journals created before lack them
+    LEASE_COLUMNS = (('claimed_by', 'TEXT'), ('lease_until', 'REAL'))
+
+    def __init__(self, path):
+        """
+        :param path: SQLite file, created if it does not exist
+        """
+        self._path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS write_journal ('
+                         'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'write_id TEXT NOT NULL UNIQUE, '
+                         'method TEXT NOT NULL, '
+                         'kwargs TEXT, '
+                         'key TEXT NOT NULL, '
+                         'state TEXT NOT NULL, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, '
+                         'not_before REAL NOT NULL DEFAULT 0, '
+                         'created_time REAL NOT NULL, '
+                         'finished_time REAL, '
+                         'result TEXT, '
+                         'error TEXT, '
+                         'claimed_by TEXT, '
+                         'lease_until REAL)')
+            columns = set(row[1] for row in conn.execute('PRAGMA table_info(write_journal)'))
+            for column, kind in self.LEASE_COLUMNS:
+                if column not in columns:
+                    conn.execute('ALTER TABLE write_journal ADD COLUMN %s %s' % (column, kind))
+
+    @property
+    def path(self):
+        return self._path
+
+    def _connect(self):
+        return _closing_connection(sqlite3.connect(self._path,
+                                                   timeout=self.LOCK_TIMEOUT_IN_SECS))
+
+    @staticmethod
+    def _write(row):
+        (seq, write_id, method, kwargs, key, state, attempts, not_before, result, error,
+         claimed_by, lease_until) = row
+        return JournaledWrite(seq, write_id, method,
+                              json.loads(kwargs) if kwargs is not None else None, key,
+                              state=state, attempts=attempts, not_before=not_before,
+                              result=json.loads(result) if result is not None else None,
+                              error=error, claimed_by=claimed_by, lease_until=lease_until)
+
+    def append(self, write_id, method, kwargs, key):
+        """
+        journals a new pending write
+        :return: the JournaledWrite, or the one already journaled under write_id
+        """
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO write_journal '
+                         '(write_id, method, kwargs, key, state, created_time) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (write_id, method, json.dumps(kwargs), key, PENDING, time.time()))
+            row = conn.execute('SELECT %s FROM write_journal WHERE write_id = ?' %
+                               self.COLUMNS, (write_id,)).fetchone()
+        return self._write(row)
+
+    def get(self, write_id):
+        """
+        :return: JournaledWrite or None
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT %s FROM write_journal WHERE write_id = ?' %
+                               self.COLUMNS, (write_id,)).fetchone()
+        return self._write(row) if row else None
+
+    def pending(self):
+        """
+        :return: list of the writes not delivered yet, oldest first
+        """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT %s FROM write_journal WHERE state = ? ORDER BY seq' %
+                                self.COLUMNS, (PENDING,)).fetchall()
+        return [self._write(row) for row in rows]
+
+    def unknown(self):
+        """
+        :return: list of the writes that may or may not have reached the server,
+            oldest first. they keep their content until resent or finished
+        """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT %s FROM write_journal WHERE state = ? ORDER BY seq' %
+                                self.COLUMNS, (UNKNOWN,)).fetchall()
+        return [self._write(row) for row in rows]
+
+    def claim(self, write_id, owner, lease):
+        """
+        takes a pending write for owner unless another owner claimed it. an owner
+        claiming its own write again renews the lease. a write whose owner let
+        the lease run out may have been sent before that owner died, it is
+        marked unknown instead of being taken over
+        :param lease: seconds the claim holds
+        :return: True if owner holds the write for the next lease seconds
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('UPDATE write_journal SET state = ?, error = ?, '
+                         'claimed_by = NULL, lease_until = NULL '
+                         'WHERE write_id = ? AND state = ? AND claimed_by != ? AND '
+                         'lease_until < ?',
+                         (UNKNOWN, 'abandoned by %s while in flight' % owner, write_id,
+                          PENDING, owner, now))
+            return conn.execute('UPDATE write_journal SET claimed_by = ?, lease_until = ? '
+                                'WHERE write_id = ? AND state = ? AND (claimed_by IS NULL OR '
+                                'claimed_by = ?)',
+                                (owner, now + lease, write_id, PENDING, owner)).rowcount == 1
+
+    def retry_later(self, write_id, not_before, error):
+        """
+        records a failed attempt and gives the claim on the write up
+        """
+        with self._connect() as conn:
+            conn.execute('UPDATE write_journal SET attempts = attempts + 1, not_before = ?, '
+                         'error = ?, claimed_by = NULL, lease_until = NULL '
+                         'WHERE write_id = ?', (not_before, error, write_id))
+
+    def mark_unknown(self, write_id, error):
+        """
+        records an attempt that may have reached the server, keeps the content
+        """
+        with self._connect() as conn:
+            conn.execute('UPDATE write_journal SET state = ?, attempts = attempts + 1, '
+                         'error = ?, claimed_by = NULL, lease_until = NULL '
+                         'WHERE write_id = ?', (UNKNOWN, error, write_id))
+
+    def requeue(self, write_id):
+        """
+        makes an unknown write pending again
+        :return: the JournaledWrite or None if write_id is not an unknown write
+        """
+        with self._connect() as conn:
+            updated = conn.execute('UPDATE write_journal SET state = ?, not_before = 0 '
+                                   'WHERE write_id = ? AND state = ?',
+                                   (PENDING, write_id, UNKNOWN)).rowcount
+        return self.get(write_id) if updated else None
+
+    def finish(self, write_id, result=None, error=None):
+        """
+        records the outcome of a write and drops its content
+        """
+        with self._connect() as conn:
+            conn.execute('UPDATE write_journal SET state = ?, attempts = attempts + 1, '
+                         'kwargs = NULL, finished_time = ?, result = ?, error = ? '
+                         'WHERE write_id = ?',
+                         (FAILED if error is not None else DONE, time.time(),
+                          json.dumps(result) if error is None else None, error, write_id))
+
+    def purge(self, older_than):
+        """
+        removes delivered and failed writes finished more than older_than seconds ago
+        :return: number of writes removed
+        """
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM write_journal WHERE state IN (?, ?) AND '
+                                'finished_time < ?',
+                                (DONE, FAILED, time.time() - older_than)).rowcount
+
+
+class WriteBehindError(Exception):
+    """
+    a write the web service rejected, delivered by a previous queue
+    """
+
+
+class WriteOutcomeUnknownError(WriteBehindError):
+    """
+    a write that failed after it may have reached the server. it is not sent
+    again unless WriteBehindQueue.resend is called for it
+    """
+
+
+class WriteBehindQueue(object):
+    """
+    delivers journaled writes with up to max_workers at once and at most
+    rate writes per second. a write that did not reach the web service,
+    because it was unreachable, throttling or unavailable, is retried with
+    exponential backoff, later writes of the same patient wait for it. a
+    write rejected by TouchWorks fails its future and is not retried. after
+    max_attempts tries a write fails with the last error. a write that may
+    have reached the server fails its future with WriteOutcomeUnknownError
+    and stays in the journal until it is resent
+
+    a write claimed by another queue of the same journal waits until that
+    queue finishes it, its future then gets the journaled outcome
+    """
+    WRITE_METHODS = ('save_note', 'save_unstructured_document', 'save_task_comment')
+    DEFAULT_MAX_WORKERS = 4
+    DEFAULT_MAX_ATTEMPTS = 10
+    DEFAULT_BACKOFF_BASE_IN_SECS = 1
+    DEFAULT_BACKOFF_MAX_IN_SECS = 5 * 60
+    DEFAULT_LEASE_IN_SECS = 10 * 60
+    POLL_INTERVAL_IN_SECS = 1
+
+    def __init__(self, client, journal, max_workers=DEFAULT_MAX_WORKERS, rate=0,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff_base=DEFAULT_BACKOFF_BASE_IN_SECS,
+                 backoff_max=DEFAULT_BACKOFF_MAX_IN_SECS,
+                 lease=DEFAULT_LEASE_IN_SECS):
+        """
+        :param client: TouchWorks
+        :param journal: SqliteWriteJournal
+        :param max_workers: optional - writes delivered at once
+        :param rate: optional - writes per second, 0 for no limit
+        :param max_attempts: optional - tries of a write before it fails
+        :param backoff_base: optional - seconds, the retry delay doubles from here
+        :param backoff_max: optional - seconds, upper bound of the retry delay
+        :param lease: optional - seconds a write this queue claimed stays claimed, longer
+            than the slowest delivery. once it runs out the write is marked unknown
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than zero')
+        self._client = client
+        self._journal = journal
+        self._max_workers = max_workers
+        self._limiter = RateLimiter(rate=rate) if rate else None
+        self._max_attempts = max_attempts
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._lease = lease
+        self._id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._queue = []
+        self._futures = {}
+        self._busy_keys = set()
+        self._in_flight = 0
+        self._executor = None
+        self._dispatcher = None
+        self._stopping = False
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+
+    # submitting
+
+    def save_note(self, note_text, patient_id, document_type, document_status='Unsigned',
+                  wrapped_in_rtf='N', write_id=None):
+        """
+        queues TouchWorks.save_note
+        :return: concurrent.futures.Future of its result, with a write_id attribute
+        """
+        return self.submit('save_note', write_id=write_id, note_text=note_text,
+                           patient_id=patient_id, document_type=document_type,
+                           document_status=document_status, wrapped_in_rtf=wrapped_in_rtf)
+
+    def save_unstructured_document(self, ehr_username, patient_id, encounter_id,
+                                   document_content, write_id=None):
+        """
+        queues TouchWorks.save_unstructured_document
+        :return: concurrent.futures.Future of its result, with a write_id attribute
+        """
+        return self.submit('save_unstructured_document', write_id=write_id,
+                           ehr_username=ehr_username, patient_id=patient_id,
+                           encounter_id=encounter_id, document_content=document_content)
+
+    def save_task_comment(self, task_id, task_comment, write_id=None):
+        """
+        queues TouchWorks.save_task_comment
+        :return: concurrent.futures.Future of its result, with a write_id attribute
+        """
+        return self.submit('save_task_comment', write_id=write_id, task_id=task_id,
+                           task_comment=task_comment)
+
+    def submit(self, method, write_id=None, **kwargs):
+        """
+        journals a call of the TouchWorks write method with kwargs
+        :param write_id: optional - idempotency marker, a uuid4 by default
+        :return: concurrent.futures.Future of its result, with a write_id attribute
+        """
+        if method not in self.WRITE_METHODS:
+            raise ValueError('%s is not one of %s' % (method, ', '.join(self.WRITE_METHODS)))
+        write_id = write_id or str(uuid.uuid4())
+        write = self._journal.append(write_id, method, kwargs, self._ordering_key(method, kwargs))
+        with self._lock:
+            future = self._futures.get(write_id)
+            if future is not None:
+                return future
+            future = self._future(write)
+            if write.state == PENDING:
+                self._queue.append(write)
+                self._wakeup.notify()
+        return future
+
+    def resend(self, write_id):
+        """
+        queues an unknown write again, once it is known not to have been saved
+        :return: Future of its result
+        :raises KeyError: if write_id is not an unknown write
+        """
+        write = self._journal.requeue(write_id)
+        if write is None:
+            raise KeyError(write_id)
+        with self._lock:
+            future = self._futures.get(write_id)
+            if future is None or future.done():
+                # a handle() taken meanwhile holds the unknown outcome
+                future = self._future(write)
+            self._queue.append(write)
+            self._queue.sort(key=lambda w: w.seq)
+            self._wakeup.notify()
+        return future
+
+    def handle(self, write_id):
+        """
+        :return: Future of a write submitted earlier, possibly by another process
+        :raises KeyError: if write_id is not journaled
+        """
+        with self._lock:
+            future = self._futures.get(write_id)
+            if future is not None:
+                return future
+        write = self._journal.get(write_id)
+        if write is None:
+            raise KeyError(write_id)
+        with self._lock:
+            return self._futures.get(write_id) or self._future(write)
+
+    @staticmethod
+    def _ordering_key(method, kwargs):
+        if method == 'save_task_comment':
+            return 'task:%s' % kwargs.get('task_id')
+        return 'patient:%s' % kwargs.get('patient_id')
+
+    def _future(self, write):
+        # must hold self._lock
+        future = Future()
+        future.write_id = write.write_id
+        if write.state == DONE:
+            future.set_result(write.result)
+        elif write.state == FAILED:
+            future.set_exception(WriteBehindError(write.error))
+        elif write.state == UNKNOWN:
+            future.set_exception(WriteOutcomeUnknownError(write.error))
+        self._futures[write.write_id] = future
+        return future
+
+    # delivering
+
+    def start(self):
+        """
+        loads the writes left pending in the journal and starts delivering
+        :return: self
+        """
+        with self._lock:
+            if self._dispatcher is not None:
+                return self
+            queued = set(w.write_id for w in self._queue)
+            for write in self._journal.pending():
+                if write.write_id not in queued:
+                    self._queue.append(write)
+                    if write.write_id not in self._futures:
+                        self._future(write)
+            self._queue.sort(key=lambda w: w.seq)
+            self._stopping = False
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+            self._dispatcher = threading.Thread(target=self._dispatch,
+                                                name='touchworks-write-behind')
+            self._dispatcher.daemon = True
+            self._dispatcher.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        stops delivering once the writes in flight are done, writes still
+        queued stay in the journal for the next start
+        """
+        with self._lock:
+            dispatcher = self._dispatcher
+            if dispatcher is None:
+                return
+            self._stopping = True
+            self._wakeup.notify_all()
+        dispatcher.join(timeout)
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._dispatcher = None
+            self._executor = None
+
+    def flush(self, timeout=None):
+        """
+        waits until every queued write is delivered or failed
+        :return: True if the queue drained before timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._queue:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._wakeup.wait(remaining)
+        return True
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def backlog(self):
+        """
+        :return: number of writes not delivered yet
+        """
+        with self._lock:
+            return len(self._queue)
+
+    def _ready(self, now):
+        """
+        must hold self._lock
+        :return: (writes that may be sent now, seconds until the next one may be)
+        """
+        ready = []
+        blocked = set()
+        wait = self.POLL_INTERVAL_IN_SECS
+        for write in self._queue:
+            if self._in_flight + len(ready) >= self._max_workers:
+                break
+            if write.key in blocked or write.key in self._busy_keys:
+                blocked.add(write.key)
+                continue
+            # only the oldest write of a patient may go, the others wait behind it
+            blocked.add(write.key)
+            if write.not_before > now:
+                wait = min(wait, write.not_before - now)
+                continue
+            ready.append(write)
+        return ready, wait
+
+    def _dispatch(self):
+        with self._lock:
+            while not self._stopping:
+                ready, wait = self._ready(time.time())
+                for write in ready:
+                    self._busy_keys.add(write.key)
+                    self._in_flight += 1
+                    self._executor.submit(self._deliver, write)
+                self._wakeup.wait(wait)
+
+    @property
+    def _owner(self):
+        # a queue inherited by forked workers is one owner per process
+        return '%s:%s' % (self._id, os.getpid())
+
+    def _deliver(self, write):
+        if write.outcome is not None:
+            # sent already, only recording the outcome failed
+            self._record(write, *write.outcome)
+            return
+        try:
+            if not self._journal.claim(write.write_id, self._owner, self._lease):
+                self._skip(write)
+                return
+        except Exception as ex:
+            logger.exception(ex)
+            write.not_before = time.time() + self._backoff_base
+            self._release(write, None)
+            return
+        error = None
+        result = None
+        started = time.time()
+        if self._limiter is not None:
+            self._limiter.acquire()
+        try:
+            result = getattr(self._client, write.method)(**write.kwargs)
+        except Exception as ex:
+            error = ex
+        finally:
+            if self._limiter is not None:
+                self._limiter.release(time.time() - started, congested=error is not None)
+        self._record(write, result, error)
+
+    def _record(self, write, result, error):
+        try:
+            self._settle(write, result, error)
+            write.outcome = None
+        except Exception as ex:
+            # the journal is unusable, keep the outcome and record it later
+            logger.exception(ex)
+            write.outcome = (result, error)
+            write.not_before = time.time() + self._backoff_base
+            self._release(write, None)
+
+    def _skip(self, write):
+        """
+        follows a write another queue claimed: checks on it again while it is
+        pending, takes its journaled outcome once it is finished
+        """
+        journaled = self._journal.get(write.write_id)
+        if journaled is None:
+            # finished and purged already
+            self._release(write, None, done=True, counted=False)
+        elif journaled.state == PENDING:
+            # the other queue may finish it long before its lease runs out
+            write.not_before = time.time() + self.POLL_INTERVAL_IN_SECS
+            self._release(write, None)
+        elif journaled.state == DONE:
+            self._release(write, journaled.result, done=True, counted=False)
+        elif journaled.state == UNKNOWN:
+            self._release(write, WriteOutcomeUnknownError(journaled.error), done=True,
+                          counted=False)
+        else:
+            self._release(write, WriteBehindError(journaled.error), done=True, counted=False)
+
+    def _settle(self, write, result, error):
+        if error is not None and not self._not_sent(error) and self._transient(error):
+            logger.warning('write %s may have reached the server (%s), '
+                           'left for reconciliation', write.write_id, error)
+            self._journal.mark_unknown(write.write_id, str(error))
+            self._release(write, WriteOutcomeUnknownError(str(error)), done=True)
+            return
+        if error is not None and self._transient(error) and \
+                write.attempts + 1 < self._max_attempts:
+            delay = random.uniform(0, min(self._backoff_max,
+                                          self._backoff_base * (2 ** write.attempts)))
+            logger.debug('write %s failed (%s), retry in %.2f secs',
+                         write.write_id, error, delay)
+            write.attempts += 1
+            write.not_before = time.time() + delay
+            self._journal.retry_later(write.write_id, write.not_before, str(error))
+            self.retried += 1
+            self._release(write, None)
+            return
+        self._journal.finish(write.write_id, result=result,
+                             error=str(error) if error is not None else None)
+        self._release(write, error if error is not None else result, done=True)
+
+    def _release(self, write, outcome, done=False, counted=True):
+        with self._lock:
+            self._in_flight -= 1
+            self._busy_keys.discard(write.key)
+            if done:
+                self._queue.remove(write)
+                future = self._futures.pop(write.write_id, None)
+            self._wakeup.notify_all()
+        if not done:
+            return
+        if isinstance(outcome, Exception):
+            if counted:
+                self.failed += 1
+            if future is not None:
+                future.set_exception(outcome)
+        else:
+            if counted:
+                self.delivered += 1
+            if future is not None:
+                future.set_result(outcome)
+
+    @staticmethod
+    def _not_sent(error):
+        """
+        :return: True if error means the web service surely did not process the write
+        """
+        if isinstance(error, (TouchWorksCircuitOpenException,
+                              TouchWorksDeadlineExceededException, requests.ConnectTimeout)):
+            return True
+        if isinstance(error, requests.ConnectionError):
+            reason = getattr(error.args[0] if error.args else None, 'reason', None)
+            return isinstance(reason, NewConnectionError)
+        if isinstance(error, requests.HTTPError):
+            response = getattr(error, 'response', None)
+            return getattr(response, 'status_code', None) in (429, 503)
+        return False
+
+    def _transient(self, error):
+        if isinstance(error, (TouchWorksCircuitOpenException,
+                              TouchWorksDeadlineExceededException)):
+            return True
+        if isinstance(error, requests.RequestException):
+            return self._client._retry_policy.is_server_failure(error)
+        return False
@@ -1,17 +1,14 @@
 import logging
-import logging.config
+
+# a library leaves handlers, formats and levels to the application. records of
+# every touchworks logger end here unless the application configures logging
+logging.getLogger('touchworks').addHandler(logging.NullHandler())
 
 
 class Logger(object):
     @staticmethod
     def get_logger(name):
-        logging.getLogger("requests").setLevel(logging.WARNING)
-        logger = logging.getLogger(name)
-        logger.setLevel(logging.ERROR)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.ERROR)
-        formatter = logging.Formatter('%(asctime)s - ' +
-                                      '%(name)s - %(levelname)s - %(message)s')
-        ch.setFormatter(formatter)
-        logger.addHandler(ch)
-        return logger
+        """
+        :return: logging.Logger of name, without handlers or a level of its own
+        """
+        return logging.getLogger(name)